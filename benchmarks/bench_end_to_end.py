@@ -0,0 +1,324 @@
+"""
+End-to-end benchmark of the pipeline: extraction, track and artist enrichment, transform, validation and load run
+exactly as in production, against the local fake Spotify server (with simulated latency and 429s) and a
+throwaway PostgreSQL cluster created with initdb in a temporary directory.
+
+Each stage runs in its own process over a temporary data directory, so its peak RSS is its own. The
+JSON report holds, per stage, the wall time, throughput (plays per second), latency percentiles (of API
+requests for the extraction stages, of batches for the others) and peak RSS. Given --baseline, stages whose
+throughput dropped by more than --tolerance are listed and the exit code is 1.
+
+Usage:
+    python benchmarks/bench_end_to_end.py --plays 20000 --users 2 --latency 0.02 --quota 50
+    python benchmarks/bench_end_to_end.py --report new.json --baseline old.json
+    python benchmarks/bench_end_to_end.py --skip-load  # Without PostgreSQL binaries
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from benchmarks.fake_spotify_server import FakeSpotifyServer
+from scripts.auth.stub_spotify_client import STUB_PLAY_INTERVAL_MS, STUB_START_MS
+
+STAGES = ["extract", "enrich_tracks", "enrich_artists", "transform", "validate", "load"]
+SCOPES = ["user-read-recently-played", "user-library-read"]  # The scopes the extractors request
+
+
+class EphemeralPostgres:
+    """A PostgreSQL cluster in a temporary directory, reachable only through its Unix socket."""
+
+    def __init__(self, bin_dir=None):
+        self.bin_dir = bin_dir or self._find_bin_dir()
+        self.directory = None
+        self.port = None
+
+    @staticmethod
+    def _find_bin_dir():
+        initdb = shutil.which("initdb")
+        if initdb:
+            return os.path.dirname(initdb)
+        if shutil.which("pg_config"):
+            return subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True, check=True).stdout.strip()
+        raise SystemExit("PostgreSQL binaries not found: pass --pg-bin, or --skip-load to benchmark without the load.")
+
+    def _run(self, program, *args):
+        result = subprocess.run([os.path.join(self.bin_dir, program), *args], capture_output=True, text=True)
+        if result.returncode != 0:
+            # initdb refuses to run as root
+            raise SystemExit(f"{program} failed: {result.stderr.strip() or result.stdout.strip()}")
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="spotify_bench_pg_")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        data_dir = os.path.join(self.directory, "data")
+        self._run("initdb", "-D", data_dir, "-U", "bench", "--auth=trust", "-E", "UTF8")
+        self._run("pg_ctl", "-D", data_dir, "-l", os.path.join(self.directory, "postgres.log"), "-w", "-o",
+                  f"-p {self.port} -k {self.directory} -c listen_addresses=''", "start")
+        return self
+
+    def env(self):
+        """Connection settings for scripts.database.connection."""
+        return {"DB_HOST": self.directory, "DB_PORT": str(self.port), "DB_USER": "bench", "DB_PASSWORD": "bench",
+                "DB_NAME": "spotify_db"}
+
+    def stop(self):
+        if self.directory:
+            self._run("pg_ctl", "-D", os.path.join(self.directory, "data"), "-m", "fast", "-w", "stop")
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def use_data_dir(data_dir):
+    """Points every stage at data_dir instead of the project's data/ directory."""
+    from scripts.database import insert_spotify_data
+    from scripts.extraction import entity_cache, extract_artist_data, extract_listening_history, extract_track_features
+    from scripts.monitoring import metrics
+    from scripts.storage import watermarks
+    from scripts.transformation import transform_listening_history as transform
+    from scripts.validation import validate_processed_data
+
+    raw_dir = os.path.join(data_dir, "raw", "spotify_api")
+    processed_dir = os.path.join(data_dir, "processed")
+    for module in (extract_listening_history, extract_track_features, extract_artist_data, transform):
+        module.RAW_DATA_DIR = raw_dir
+    for module in (transform, validate_processed_data, insert_spotify_data):
+        module.PROCESSED_DATA_DIR = processed_dir
+        module.BATCHES_DIR = os.path.join(processed_dir, "_batches")
+    validate_processed_data.QUARANTINE_DIR = os.path.join(processed_dir, "_quarantine")
+    transform.LISTENING_HISTORY_DIR = os.path.join(processed_dir, "listening_history_fact")
+    transform.LISTENING_HISTORY_ARTISTS_DIR = os.path.join(processed_dir, "listening_history_artists")
+    transform.TRACK_DIMENSION_DIR = os.path.join(processed_dir, "track_dimension")
+    transform.ARTIST_DIMENSION_DIR = os.path.join(processed_dir, "artist_dimension")
+    watermarks.METADATA_DIR = os.path.join(data_dir, "metadata")
+    entity_cache.CACHE_FILE = os.path.join(data_dir, "metadata", "entity_cache.sqlite")
+    metrics.METRICS_DIR = os.path.join(data_dir, "metrics")
+    metrics.METRICS_LOG_FILE = os.path.join(metrics.METRICS_DIR, "metrics.jsonl")
+
+
+def percentiles(values):
+    """Returns the count, p50, p90, p99 and max of a list of seconds, in milliseconds."""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+
+    def pick(q):
+        return round(values[min(len(values) - 1, math.ceil(q * len(values)) - 1)] * 1000, 2)
+
+    return {"count": len(values), "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99),
+            "max_ms": round(values[-1] * 1000, 2)}
+
+
+def run_stage(stage, data_dir, intervals):
+    """
+    Runs one stage in this (fresh) process and measures it.
+
+    Returns:
+        dict: seconds, latencies (seconds per request or per batch), peak_rss_mb and, for the extraction,
+            the number of plays extracted.
+    """
+    import logging
+    import resource
+    logging.getLogger("spotipy").setLevel(logging.CRITICAL)  # 429s are expected and retried
+    use_data_dir(data_dir)
+
+    from scripts.auth.connect_spotify_api import get_session
+    latencies = []
+    # Every API client shares this session, so its hook sees every request (429s included)
+    get_session().hooks["response"].append(lambda response, *args, **kwargs: latencies.append(
+        response.elapsed.total_seconds()))
+
+    start = time.perf_counter()
+    if stage == "extract":
+        from scripts.extraction.extract_listening_history import extract_all_users
+        files = [f for start_dt, end_dt in intervals for f in extract_all_users(start_dt, end_dt).values() if f]
+    elif stage == "enrich_tracks":
+        from scripts.extraction.extract_track_features import extract_track_features
+        extract_track_features()
+    elif stage == "enrich_artists":
+        from scripts.extraction.extract_artist_data import extract_artist_features
+        extract_artist_features()
+    elif stage == "transform":
+        from scripts.extraction.extract_track_features import get_pending_listening_history_files
+        from scripts.transformation.transform_listening_history import transform_listening_history
+        for history_file in get_pending_listening_history_files("transform"):
+            batch_start = time.perf_counter()
+            if not transform_listening_history(history_files=[history_file]):
+                raise RuntimeError(f"{history_file} could not be transformed")
+            latencies.append(time.perf_counter() - batch_start)
+    elif stage == "validate":
+        from scripts.validation.validate_processed_data import get_pending_batches, validate_processed_data
+        for batch in get_pending_batches():
+            batch_start = time.perf_counter()
+            if not validate_processed_data(batches=[batch]):
+                raise RuntimeError(f"{batch} failed validation")
+            latencies.append(time.perf_counter() - batch_start)
+    elif stage == "load":
+        from scripts.database.create_spotify_db import create_db, create_tables
+        from scripts.database.insert_spotify_data import get_pending_batches, insert_spotify_data
+        create_db()
+        create_tables()
+        for batch in get_pending_batches():
+            batch_start = time.perf_counter()
+            if not insert_spotify_data(batches=[batch]):
+                raise RuntimeError(f"{batch} could not be loaded")
+            latencies.append(time.perf_counter() - batch_start)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = rss / 1e6 if platform.system() == "Darwin" else rss / 1e3
+    result = {"seconds": seconds, "latencies": latencies, "peak_rss_mb": round(peak_rss_mb, 1)}
+    if stage == "extract":
+        from scripts.storage.raw_sink import read_raw_records
+        result["plays"] = sum(len(read_raw_records(f)) for f in files)
+    return result
+
+
+def get_intervals(plays, batch_hours):
+    """Splits the span of the fake history into the data intervals the DAG would run."""
+    start = datetime.fromtimestamp(STUB_START_MS / 1000, tz=timezone.utc)
+    end = start + timedelta(milliseconds=plays * STUB_PLAY_INTERVAL_MS)
+    step = timedelta(hours=batch_hours)
+    return [(start + i * step, min(start + (i + 1) * step, end)) for i in range(math.ceil((end - start) / step))]
+
+
+def prepare_data_dir(data_dir, users):
+    """Writes the user registry and a valid token for every user and scope, so no OAuth flow runs."""
+    user_ids = ["default"] if users == 1 else [f"user{i:03d}" for i in range(users)]
+    os.makedirs(os.path.join(data_dir, "metadata"), exist_ok=True)
+    with open(os.path.join(data_dir, "metadata", "users.json"), "w") as f:
+        json.dump([{"user_id": user_id} for user_id in user_ids], f)
+
+    for user_id in user_ids:
+        token_dir = os.path.join(data_dir, "metadata", "" if user_id == "default" else f"user_id={user_id}")
+        os.makedirs(token_dir, exist_ok=True)
+        for scope in SCOPES:
+            token = {"access_token": "bench", "token_type": "Bearer", "expires_in": 3600,
+                     "expires_at": int(time.time()) + 86400, "scope": scope, "refresh_token": "bench"}
+            with open(os.path.join(token_dir, f"spotify_token_{scope}.json"), "w") as f:
+                json.dump(token, f)
+
+
+def compare(report, baseline, tolerance):
+    """Returns the stages whose throughput is more than tolerance below the baseline's."""
+    regressions = []
+    for stage, result in report["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before and result["plays_per_second"] < before["plays_per_second"] * (1 - tolerance):
+            regressions.append(f"{stage}: {result['plays_per_second']:,.0f} plays/s "
+                               f"(baseline {before['plays_per_second']:,.0f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plays", type=int, default=20000, help="Plays in every user's history")
+    parser.add_argument("--tracks", type=int, default=3000, help="Distinct tracks in the history")
+    parser.add_argument("--users", type=int, default=1, help="Registered users (1 runs the default user only)")
+    parser.add_argument("--batch-hours", type=int, default=24, help="Length of each extraction interval")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated response latency (s)")
+    parser.add_argument("--quota", type=float, default=None, help="Server quota in requests per second (429 above)")
+    parser.add_argument("--rate", type=float, default=50, help="Client token bucket rate (requests per second)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the fake 429 responses (s)")
+    parser.add_argument("--pg-bin", default=None, help="Directory of initdb and pg_ctl (default: from PATH)")
+    parser.add_argument("--skip-load", action="store_true", help="Skip the load stage (no PostgreSQL needed)")
+    parser.add_argument("--report", default="bench_end_to_end.json", help="Where to write the JSON report")
+    parser.add_argument("--baseline", default=None, help="Earlier report to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed throughput drop vs the baseline")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary data directory")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="spotify_bench_data_")
+    prepare_data_dir(data_dir, args.users)
+    server = FakeSpotifyServer(latency=args.latency, quota=args.quota, retry_after=args.retry_after, plays=args.plays,
+                               track_count=args.tracks).start()
+    database = None if args.skip_load else EphemeralPostgres(args.pg_bin).start()
+
+    # Stage processes inherit these before importing any pipeline module
+    os.environ.update({
+        "SPOTIFY_CLIENT": "spotipy",
+        "CLIENT_ID": "bench", "CLIENT_SECRET": "bench", "REDIRECT_URI": "http://127.0.0.1/callback",
+        "SPOTIFY_API_URL": server.prefix,
+        "SPOTIFY_TOKEN_CACHE_DIR": os.path.join(data_dir, "metadata"),
+        "SPOTIFY_USERS_FILE": os.path.join(data_dir, "metadata", "users.json"),
+        "SPOTIFY_RATE_LIMIT": str(args.rate),
+        "SPOTIFY_BURST": str(max(1, int(args.rate))),
+        **(database.env() if database else {}),
+    })
+
+    intervals = get_intervals(args.plays, args.batch_hours)
+    stages = [stage for stage in STAGES if not (args.skip_load and stage == "load")]
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("report", "baseline", "keep")},
+        "stages": {},
+    }
+    expected_plays = args.plays * args.users
+    try:
+        for stage in stages:
+            server.requests = server.throttled = 0
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                result = executor.submit(run_stage, stage, data_dir, intervals).result()
+            if stage == "extract" and result["plays"] != expected_plays:
+                raise RuntimeError(f"Extracted {result['plays']} plays, expected {expected_plays}")
+
+            # Every stage handles each play once
+            report["stages"][stage] = {
+                "seconds": round(result["seconds"], 3),
+                "plays": expected_plays,
+                "plays_per_second": round(expected_plays / result["seconds"], 1) if result["seconds"] else None,
+                "latency": {"unit": "batch" if stage in ("transform", "validate", "load") else "request",
+                            **percentiles(result["latencies"])},
+                "api_requests": server.requests,
+                "api_throttled": server.throttled,
+                "peak_rss_mb": result["peak_rss_mb"],
+            }
+    finally:
+        server.stop()
+        if database:
+            database.stop()
+        if args.keep:
+            print(f"Data kept in {data_dir}")
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print(f"{'stage':<16}{'seconds':>10}{'plays/s':>12}{'p50 (ms)':>10}{'p99 (ms)':>10}{'429s':>7}{'RSS (MB)':>10}")
+    for stage, result in report["stages"].items():
+        latency = result["latency"]
+        print(f"{stage:<16}{result['seconds']:>10.2f}{result['plays_per_second'] or 0:>12,.0f}"
+              f"{latency.get('p50_ms', 0):>10.1f}{latency.get('p99_ms', 0):>10.1f}{result['api_throttled']:>7}"
+              f"{result['peak_rss_mb']:>10.1f}")
+    print(f"Report written to {args.report}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("⚠️ The baseline was run with different settings; throughputs may not be comparable.")
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"❌ Throughput regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
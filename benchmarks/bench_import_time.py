@@ -0,0 +1,94 @@
+"""
+Measures the cold import time of the DAG file and of every stage's module, each in a fresh interpreter,
+against a budget: a time limit and the heavy dependencies the module must not import. The DAG file is
+parsed by the scheduler over and over and every task starts a new process, so both stay small only as
+long as heavy imports stay inside the stages that use them. Exits with status 1 if a budget is exceeded.
+
+Time limits are generous, to hold on slower machines; the forbidden imports are the strict part.
+
+Usage:
+    python benchmarks/bench_import_time.py --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+HEAVY_MODULES = ["pandas", "numpy", "pyarrow", "spotipy", "requests", "psycopg2", "duckdb", "zstandard", "ijson",
+                 "dotenv"]
+
+# Module: (milliseconds, heavy modules it must not import)
+IMPORT_BUDGETS = {
+    "dags.spotify_dag": (100, HEAVY_MODULES),  # On top of airflow itself
+    "scripts.cli": (50, HEAVY_MODULES),
+    "scripts.extraction.extract_listening_history": (400, ["pandas", "numpy", "pyarrow", "psycopg2", "dotenv"]),
+    "scripts.extraction.extract_track_features": (400, ["pandas", "numpy", "pyarrow", "psycopg2", "dotenv"]),
+    "scripts.extraction.extract_artist_data": (400, ["pandas", "numpy", "pyarrow", "psycopg2", "dotenv"]),
+    "scripts.transformation.transform_listening_history": (800, ["spotipy", "requests", "psycopg2", "dotenv"]),
+    "scripts.validation.validate_processed_data": (800, ["spotipy", "requests", "psycopg2", "dotenv"]),
+    "scripts.analytics.query_processed_data": (150, HEAVY_MODULES),
+    "scripts.database.create_spotify_db": (150, ["pandas", "numpy", "pyarrow", "spotipy", "requests", "dotenv"]),
+    "scripts.database.insert_spotify_data": (800, ["spotipy", "requests", "dotenv"]),
+}
+
+# Imports the module in a fresh interpreter and prints its import time and the heavy modules it loaded.
+# Modules the file needs before the measured import (airflow for the DAG) are imported first.
+PROBE = """
+import importlib, json, sys, time
+for module in sys.argv[2:]:
+    importlib.import_module(module)
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({"ms": seconds * 1000, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure(module, preload, repeat):
+    """Returns the fastest of repeat cold imports of a module (ms) and the modules it loaded."""
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", PROBE, module, *preload], capture_output=True, text=True,
+                                cwd=PROJECT_DIR, env={**os.environ, "PYTHONPATH": PROJECT_DIR})
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip()}")
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return min(run["ms"] for run in runs), set(runs[0]["modules"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Imports per module (the fastest counts)")
+    args = parser.parse_args()
+
+    try:
+        import airflow  # noqa: F401
+        has_airflow = True
+    except ImportError:
+        has_airflow = False
+
+    over_budget = []
+    print(f"{'module':<54}{'ms':>8}{'budget':>8}  forbidden imports")
+    for module, (budget_ms, forbidden) in IMPORT_BUDGETS.items():
+        preload = []
+        if module.startswith("dags."):
+            if not has_airflow:
+                print(f"{module:<54}{'-':>8}{budget_ms:>8}  skipped (airflow is not installed)")
+                continue
+            preload = ["airflow", "airflow.operators.python"]
+        ms, modules = measure(module, preload, args.repeat)
+        loaded = [name for name in forbidden if name in modules]
+        print(f"{module:<54}{ms:>8.0f}{budget_ms:>8}  {', '.join(loaded) or '-'}")
+        if ms > budget_ms or loaded:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"Over budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Compares analytical queries on listening_history before and after the schema redesign, on a synthetic
+dataset generated inside PostgreSQL (10M plays by default):
+
+- legacy: the original tables (comma-separated artist_ids, unindexed genres, only the UNIQUE constraint)
+- redesigned: the tables and indexes of create_spotify_db (play-to-artist bridge, GIN index on genres,
+  BRIN index on played_at)
+
+Each layout is built in its own schema of DB_NAME (connection settings come from .env) and dropped
+afterwards unless --keep is given. Both layouts must return the same results for every query.
+
+Usage:
+    python benchmarks/bench_listening_history_queries.py --plays 10000000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scripts.database.connection import connection
+from scripts.database.create_spotify_db import TABLE_STATEMENTS, INDEX_STATEMENTS, BACKFILL_ARTISTS_STATEMENT
+
+LEGACY_SCHEMA = "bench_legacy"
+REDESIGNED_SCHEMA = "bench_redesigned"
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+SPAN_SECONDS = 2 * 365 * 86400  # Plays are spread evenly over two years, in played_at order
+
+# The tables as they were before the redesign
+LEGACY_TABLE_STATEMENTS = [
+    """
+    CREATE TABLE artists (
+        artist_id VARCHAR PRIMARY KEY,
+        artist_name TEXT NOT NULL,
+        genres JSONB,
+        followers INT,
+        popularity INT
+    );
+    """,
+    """
+    CREATE TABLE tracks (
+        track_id VARCHAR PRIMARY KEY,
+        track_name TEXT NOT NULL,
+        album_name TEXT,
+        popularity INT,
+        duration_ms INT,
+        album_release_date TEXT,
+        explicit BOOLEAN
+    );
+    """,
+    """
+    CREATE TABLE listening_history (
+        played_at TIMESTAMPTZ NOT NULL,
+        track_id VARCHAR NOT NULL,
+        artist_ids TEXT NOT NULL,
+        FOREIGN KEY (track_id) REFERENCES tracks(track_id),
+        UNIQUE (track_id, played_at)
+    );
+    """,
+]
+
+# Same SQL on both layouts; only the BRIN index on played_at differs
+DAILY_PLAYS_SQL = """
+    SELECT date_trunc('day', played_at) AS day, count(*) FROM listening_history
+    WHERE played_at >= %(week_start)s AND played_at < %(week_end)s
+    GROUP BY day ORDER BY day
+"""
+
+# name: (legacy SQL, redesigned SQL)
+QUERIES = {
+    "artist plays in a month": (
+        """
+        SELECT count(*) FROM listening_history
+        WHERE played_at >= %(month_start)s AND played_at < %(month_end)s
+          AND %(artist)s = ANY(string_to_array(artist_ids, ','))
+        """,
+        """
+        SELECT count(*) FROM listening_history_artists
+        WHERE artist_id = %(artist)s AND played_at >= %(month_start)s AND played_at < %(month_end)s
+        """,
+    ),
+    "top 10 artists in a week": (
+        """
+        SELECT a.artist_id, count(*) AS plays
+        FROM listening_history h
+        CROSS JOIN LATERAL unnest(string_to_array(h.artist_ids, ',')) AS a(artist_id)
+        WHERE h.played_at >= %(week_start)s AND h.played_at < %(week_end)s
+        GROUP BY a.artist_id ORDER BY plays DESC, a.artist_id LIMIT 10
+        """,
+        """
+        SELECT artist_id, count(*) AS plays
+        FROM listening_history_artists
+        WHERE played_at >= %(week_start)s AND played_at < %(week_end)s
+        GROUP BY artist_id ORDER BY plays DESC, artist_id LIMIT 10
+        """,
+    ),
+    "genre plays in a month": (
+        """
+        SELECT count(*)
+        FROM listening_history h
+        JOIN artists a ON a.artist_id = ANY(string_to_array(h.artist_ids, ','))
+        WHERE a.genres @> %(genre)s::jsonb
+          AND h.played_at >= %(month_start)s AND h.played_at < %(month_end)s
+        """,
+        """
+        SELECT count(*)
+        FROM artists a
+        JOIN listening_history_artists b ON b.artist_id = a.artist_id
+        WHERE a.genres @> %(genre)s::jsonb
+          AND b.played_at >= %(month_start)s AND b.played_at < %(month_end)s
+        """,
+    ),
+    "daily plays in a week": (DAILY_PLAYS_SQL, DAILY_PLAYS_SQL),
+}
+
+
+def generate_statements(plays, tracks, artists, genres):
+    """Returns the INSERT statements that build the synthetic dataset (all arguments are ints)."""
+    step = max(SPAN_SECONDS // plays, 1)
+    return [
+        f"""
+        INSERT INTO artists
+        SELECT 'artist' || a, 'Artist ' || a,
+               (SELECT jsonb_agg(DISTINCT 'genre' || ((a + k * 7919) % {genres}))
+                FROM generate_series(0, a % 3) AS k),
+               (a * 7919) % 1000000, a % 100
+        FROM generate_series(0, {artists - 1}) AS a;
+        """,
+        f"""
+        INSERT INTO tracks
+        SELECT 'track' || t, 'Track ' || t, 'Album ' || (t / 10), t % 100, 120000 + (t * 37) % 240000,
+               '2020-01-01', t % 7 = 0
+        FROM generate_series(0, {tracks - 1}) AS t;
+        """,
+        # Every fourth track has a second, different artist
+        f"""
+        INSERT INTO listening_history
+        SELECT timestamptz '{START.isoformat()}' + g * interval '{step} seconds', 'track' || t,
+               'artist' || (t % {artists})
+               || CASE WHEN t % 4 = 0 THEN ',artist' || ((t + 1 + (t * 13) % {artists - 1}) % {artists}) ELSE '' END
+        FROM (SELECT g, (g * 2654435761) % {tracks} AS t FROM generate_series(0, {plays - 1}) AS g) AS p;
+        """,
+    ]
+
+
+def build_schema(conn, schema, table_statements, after_load, sizes):
+    """Creates a schema, fills it with the synthetic dataset and runs the post-load statements."""
+    start = time.perf_counter()
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {schema};")
+        cursor.execute(f"SET search_path TO {schema};")
+        for statement in table_statements + generate_statements(**sizes) + after_load:
+            cursor.execute(statement)
+        conn.commit()
+
+        # VACUUM (which also sets the visibility map for index-only scans) cannot run in a transaction
+        cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = %s;", (schema,))
+        tables = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        conn.autocommit = True
+        for table in tables:
+            cursor.execute(f"VACUUM ANALYZE {schema}.{table};")
+        conn.autocommit = False
+
+        cursor.execute("""
+            SELECT coalesce(sum(pg_total_relation_size(c.oid)), 0) FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relkind = 'r';
+        """, (schema,))
+        size = cursor.fetchone()[0]
+    print(f"Built {schema} in {time.perf_counter() - start:.1f}s ({size / 1e6:,.0f} MB with indexes)")
+
+
+def time_query(conn, schema, sql, params, repeat):
+    """Runs a query once to warm the cache, then repeat times; returns (median seconds, rows)."""
+    timings = []
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET search_path TO {schema};")
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            timings.append(time.perf_counter() - start)
+    conn.rollback()
+    return statistics.median(timings), rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plays", type=int, default=10_000_000, help="Number of synthetic plays")
+    parser.add_argument("--tracks", type=int, default=200_000, help="Number of distinct tracks")
+    parser.add_argument("--artists", type=int, default=20_000, help="Number of distinct artists")
+    parser.add_argument("--genres", type=int, default=500, help="Number of distinct genres")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per query (the median is reported)")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark schemas afterwards")
+    args = parser.parse_args()
+
+    sizes = {"plays": args.plays, "tracks": args.tracks, "artists": args.artists, "genres": args.genres}
+    month_start = START + timedelta(days=365)
+    week_start = month_start + timedelta(days=10)
+    params = {
+        "artist": "artist42",
+        "genre": '["genre7"]',
+        "month_start": month_start,
+        "month_end": month_start + timedelta(days=30),
+        "week_start": week_start,
+        "week_end": week_start + timedelta(days=7),
+    }
+
+    with connection() as conn:
+        try:
+            build_schema(conn, LEGACY_SCHEMA, LEGACY_TABLE_STATEMENTS, [], sizes)
+            build_schema(conn, REDESIGNED_SCHEMA, TABLE_STATEMENTS, [BACKFILL_ARTISTS_STATEMENT] + INDEX_STATEMENTS,
+                         sizes)
+
+            print(f"{'query':<28}{'legacy (ms)':>14}{'redesigned (ms)':>18}{'speedup':>10}")
+            for name, (legacy_sql, redesigned_sql) in QUERIES.items():
+                legacy_time, legacy_rows = time_query(conn, LEGACY_SCHEMA, legacy_sql, params, args.repeat)
+                redesigned_time, redesigned_rows = time_query(conn, REDESIGNED_SCHEMA, redesigned_sql, params,
+                                                              args.repeat)
+                assert legacy_rows == redesigned_rows, f"{name}: results differ between layouts"
+                print(f"{name:<28}{legacy_time * 1000:>14.1f}{redesigned_time * 1000:>18.1f}"
+                      f"{legacy_time / redesigned_time:>9.1f}x")
+        finally:
+            if not args.keep:
+                conn.rollback()
+                with conn.cursor() as cursor:
+                    cursor.execute(f"DROP SCHEMA IF EXISTS {LEGACY_SCHEMA}, {REDESIGNED_SCHEMA} CASCADE;")
+                conn.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares the raw sink formats on synthetic recently-played payloads: disk usage, write time
+and the time the transform stage needs to read the file back into a flattened DataFrame.
+Synthetic payloads repeat far more than real ones, so compression ratios here are optimistic.
+
+Usage:
+    python benchmarks/bench_raw_formats.py --plays 50000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scripts.auth.stub_spotify_client import fake_play
+from scripts.storage.raw_sink import RAW_EXTENSIONS, read_raw_frame, write_raw
+
+FORMATS = ["json", "jsonl", "jsonl.zst", "parquet"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plays", type=int, default=50000, help="Number of recently-played items")
+    args = parser.parse_args()
+
+    records = [fake_play(i) for i in range(args.plays)]
+    print(f"{'format':<12}{'size (MB)':>12}{'vs json':>10}{'write (s)':>12}{'read (s)':>11}{'columns':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_size = None
+        for raw_format in FORMATS:
+            base_path = os.path.join(tmp_dir, f"listening_history_{raw_format.replace('.', '_')}")
+
+            start = time.perf_counter()
+            path = write_raw(records, base_path, "listening_history", raw_format=raw_format)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            df = read_raw_frame(path)
+            read_time = time.perf_counter() - start
+
+            size = os.path.getsize(path)
+            json_size = json_size or size
+            assert path.endswith(RAW_EXTENSIONS[raw_format]) and len(df) == args.plays
+            print(f"{raw_format:<12}{size / 1e6:>12.1f}{json_size / size:>9.1f}x{write_time:>12.2f}{read_time:>11.2f}"
+                  f"{len(df.columns):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Micro-benchmark for the artist_ids and genres derivations in the transform stage.
+
+Compares the original per-row .apply() implementations with the batched Arrow versions on
+synthetic data, starting from Python objects (json_normalize output) and from Arrow arrays
+(columnar raw input), and checks that every variant produces identical strings.
+
+Usage:
+    python benchmarks/bench_transform_flatten.py --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pandas as pd
+import pyarrow as pa
+from scripts.transformation.transform_listening_history import join_artist_ids, genres_to_json
+
+GENRES = ["pop", "rock", "indie pop", "k-pop", "hip hop", "música mexicana", "lo-fi", "jazz", "r&b", "edm"]
+
+
+def make_artists(rows, rng):
+    """Per-play artist lists shaped like the recently-played payload (mostly one artist per track)."""
+    def artist(i):
+        return {"external_urls": {"spotify": f"https://open.spotify.com/artist/{i}"}, "href": "",
+                "id": f"{i:022d}", "name": f"Artist {i}", "type": "artist", "uri": f"spotify:artist:{i}"}
+
+    return pd.Series([[artist(rng.randrange(50000)) for _ in range(rng.choice((1, 1, 1, 1, 2, 3)))]
+                      for _ in range(rows)], dtype=object)
+
+
+def make_genres(rows, rng):
+    """Genre lists per artist, including empty lists and missing values."""
+    return pd.Series([rng.sample(GENRES, rng.randrange(4)) if rng.random() > 0.05 else None
+                      for _ in range(rows)], dtype=object)
+
+
+def old_artist_ids(artists):
+    return artists.apply(lambda x: ",".join([artist["id"] for artist in x]) if isinstance(x, list) else "")
+
+
+def old_genres(genres):
+    return genres.apply(lambda x: json.dumps(x) if isinstance(x, list) else None)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'column':<12}{'rows':>10}{'old apply':>12}{'new (pandas)':>14}{'new (arrow)':>13}{'speedup pandas/arrow':>22}")
+    for rows in args.sizes:
+        rng = random.Random(args.seed)
+        cases = [
+            ("artist_ids", make_artists(rows, rng), old_artist_ids, join_artist_ids),
+            ("genres", make_genres(rows, rng), old_genres, genres_to_json),
+        ]
+        for name, column, old, new in cases:
+            arrow_column = pa.array(column.to_numpy(dtype=object), from_pandas=True)
+
+            expected, old_time = timed(old, column)
+            from_pandas, pandas_time = timed(new, column)
+            from_arrow, arrow_time = timed(new, arrow_column)
+
+            if not (from_pandas.equals(expected) and from_arrow.equals(expected.reset_index(drop=True))):
+                raise AssertionError(f"{name}: batched output differs from the .apply() output at {rows} rows")
+            print(f"{name:<12}{rows:>10}{old_time:>11.3f}s{pandas_time:>13.3f}s{arrow_time:>12.3f}s"
+                  f"{old_time / pandas_time:>14.1f}x /{old_time / arrow_time:>5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Local stand-in for the Spotify Web API endpoints used by the extractors.
+
+Serves deterministic artist and track payloads for any ID and a recently-played history of
+configurable length, with simulated latency and a requests-per-second quota that answers
+429 + Retry-After once exceeded.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from scripts.auth.stub_spotify_client import STUB_TRACK_COUNT, StubSpotifyClient, fake_artist, fake_track
+
+
+def get_int(query, name):
+    """Returns an integer query parameter, or None if it is missing."""
+    value = query.get(name, [None])[0]
+    return int(value) if value is not None else None
+
+
+class FakeSpotifyServer:
+    """Threaded HTTP server that mimics /v1/artists, /v1/tracks and /v1/me/player/recently-played."""
+
+    def __init__(self, latency=0.05, quota=None, retry_after=1, host="127.0.0.1", port=0, plays=None,
+                 track_count=STUB_TRACK_COUNT):
+        self.latency = latency  # Seconds added to every response
+        self.quota = quota  # Requests per second before answering 429, None for unlimited
+        self.retry_after = retry_after
+        # Every user gets the same history: `plays` plays (None: up to now), one every 3 minutes from 2025-01-01
+        self.history = StubSpotifyClient(track_count=track_count, play_count=plays)
+        self.requests = 0
+        self.throttled = 0
+        self.window = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def prefix(self):
+        """Base URL to assign to spotipy.Spotify.prefix."""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def _over_quota(self):
+        if self.quota is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.window = [t for t in self.window if now - t < 1]
+            if len(self.window) >= self.quota:
+                self.throttled += 1
+                return True
+            self.window.append(now)
+            return False
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                if server._over_quota():
+                    self._send(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                               {"Retry-After": str(server.retry_after)})
+                    return
+
+                time.sleep(server.latency)
+                url = urlparse(self.path)
+                path = url.path.rstrip("/")
+                query = parse_qs(url.query)
+                ids = [i for i in query.get("ids", [""])[0].split(",") if i]
+                if path == "/v1/artists":
+                    self._send(200, {"artists": [fake_artist(i) for i in ids]})
+                elif path == "/v1/tracks":
+                    self._send(200, {"tracks": [fake_track(i) for i in ids]})
+                elif path == "/v1/me/player/recently-played":
+                    self._send(200, server.history.current_user_recently_played(
+                        limit=get_int(query, "limit") or 20, after=get_int(query, "after"),
+                        before=get_int(query, "before")))
+                else:
+                    self._send(404, {"error": {"status": 404, "message": "Not found"}})
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_client(server, pool_size=16):
+    """
+    Returns a spotipy client pointed at the fake server. The session has no urllib3 retries so
+    429 responses (and their Retry-After header) reach the fetch scheduler.
+    """
+    import requests
+    import spotipy
+
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    sp = spotipy.Spotify(auth="fake-token", requests_session=session)
+    sp.prefix = server.prefix
+    return sp
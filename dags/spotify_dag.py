@@ -1,18 +1,93 @@
+"""
+Hourly Spotify ETL. Each run extracts the plays of its data interval for every registered user, enriches
+them with track features and artist details in parallel, transforms and validates the batches and loads
+them, so a run takes about as long as its longest branch. Rows that fail validation are quarantined in
+data/processed/_quarantine/ instead of being loaded.
+
+- catchup=True backfills every interval since SPOTIFY_DAG_START_DATE, one run at a time, so the stage
+  watermarks only move forward. Re-running an interval rewrites and reloads the same batch.
+- Spotify API tasks run in the SPOTIFY_API_POOL pool and the load in SPOTIFY_DB_POOL, so a backlog of
+  API calls never takes the worker slots the database tasks need. Create the pools once:
+      airflow pools set spotify_api 2 "Spotify Web API"
+      airflow pools set spotify_db 1 "Spotify PostgreSQL"
+- SPOTIFY_CLIENT=stub runs every API task offline against deterministic data, e.g.:
+      SPOTIFY_CLIENT=stub airflow dags test spotify_workflow_dag 2025-01-02T00:00:00+00:00
+- Parsing this file imports nothing from the pipeline: each task loads .env and imports its stage when it
+  runs, so the scheduler never pays for pandas, spotipy or psycopg2 and parses without credentials.
+"""
+import os
 import sys
 from airflow import DAG
+from airflow.exceptions import AirflowSkipException
 from airflow.operators.python import PythonOperator
 sys.path.append("/opt/airflow")
-from datetime import datetime, timedelta
-from scripts.etl.fetch_listening_history import fetch_listening_history
-from scripts.auth.connect_spotify_api import connect_to_spotify_api
+from datetime import datetime, timedelta, timezone
+from scripts.env import load_env
+
+SPOTIFY_API_POOL = os.getenv("SPOTIFY_API_POOL", "spotify_api")
+SPOTIFY_DB_POOL = os.getenv("SPOTIFY_DB_POOL", "spotify_db")
+START_DATE = datetime.fromisoformat(os.getenv("SPOTIFY_DAG_START_DATE", "2025-01-01")).replace(tzinfo=timezone.utc)
+
+
+def get_history_files(ti):
+    """Returns the raw history files the extraction task wrote for this run (one per user who played something)."""
+    return [f for f in ti.xcom_pull(task_ids="extract_listening_history").values() if f is not None]
+
+
+def get_batches(ti):
+    """Returns the processed batch manifests of this run."""
+    from scripts.transformation.transform_listening_history import get_manifest_file
+    return [get_manifest_file(history_file) for history_file in get_history_files(ti)]
+
+
+def extract(data_interval_start, data_interval_end):
+    """Extracts every user's plays of the run's data interval; skips the rest of the run if there were none."""
+    load_env()
+    from scripts.extraction.extract_listening_history import extract_all_users
+    history_files = extract_all_users(start=data_interval_start, end=data_interval_end)
+    if not any(history_files.values()):
+        raise AirflowSkipException("No tracks were played in this interval.")
+    return history_files
+
+
+def enrich_tracks(ti):
+    load_env()
+    from scripts.extraction.extract_track_features import extract_track_features
+    extract_track_features(history_files=get_history_files(ti))
+
+
+def enrich_artists(ti):
+    load_env()
+    from scripts.extraction.extract_artist_data import extract_artist_features
+    extract_artist_features(history_files=get_history_files(ti))
+
 
+def transform(ti):
+    load_env()
+    from scripts.transformation.transform_listening_history import transform_listening_history
+    history_files = get_history_files(ti)
+    transformed = transform_listening_history(history_files=history_files)
+    if len(transformed) < len(history_files):
+        raise ValueError(f"{len(history_files) - len(transformed)} batch(es) could not be transformed.")
+
+
+def validate(ti):
+    load_env()
+    from scripts.validation.validate_processed_data import validate_processed_data
+    batches = get_batches(ti)
+    validated = validate_processed_data(batches=batches)
+    if len(validated) < len(batches):
+        raise ValueError(f"{len(batches) - len(validated)} batch(es) failed validation.")
+
+
+def load(ti):
+    load_env()
+    from scripts.database.insert_spotify_data import insert_spotify_data
+    batches = get_batches(ti)
+    loaded = insert_spotify_data(batches=batches)
+    if len(loaded) < len(batches):
+        raise ValueError(f"{len(batches) - len(loaded)} batch(es) could not be loaded.")
 
-def test_spotify_connection():
-    """
-    Test the connection to Spotify API.
-    """
-    sp = connect_to_spotify_api()
-    print("Spotify connected successfully!")
 
 # Define default arguments for the DAG
 default_args = {
@@ -26,24 +101,48 @@ default_args = {
 with DAG(
     dag_id="spotify_workflow_dag",
     default_args=default_args,
-    description="A DAG to connect to Spotify API and fetch listening history",
-    schedule_interval=None,
-    start_date=datetime(2025, 1, 1),
-    catchup=False,
+    description="Extract, enrich, transform and load Spotify listening history",
+    schedule="@hourly",
+    start_date=START_DATE,
+    catchup=True,
+    max_active_runs=1,
     tags=["spotify", "api"],
 ) as dag:
 
-    # Task to test the Spotify connection
-    test_connection_task = PythonOperator(
-        task_id="test_spotify_connection",
-        python_callable=test_spotify_connection,
+    extract_task = PythonOperator(
+        task_id="extract_listening_history",
+        python_callable=extract,
+        pool=SPOTIFY_API_POOL,
+    )
+
+    # The two enrichment branches only depend on the extracted history, so they run in parallel
+    track_features_task = PythonOperator(
+        task_id="extract_track_features",
+        python_callable=enrich_tracks,
+        pool=SPOTIFY_API_POOL,
+    )
+
+    artist_details_task = PythonOperator(
+        task_id="extract_artist_details",
+        python_callable=enrich_artists,
+        pool=SPOTIFY_API_POOL,
+    )
+
+    transform_task = PythonOperator(
+        task_id="transform_listening_history",
+        python_callable=transform,
+    )
+
+    validate_task = PythonOperator(
+        task_id="validate_processed_data",
+        python_callable=validate,
     )
 
-    # Task to fetch listening history
-    fetch_history_task = PythonOperator(
-        task_id="fetch_listening_history",
-        python_callable=fetch_listening_history,
+    load_task = PythonOperator(
+        task_id="insert_spotify_data",
+        python_callable=load,
+        pool=SPOTIFY_DB_POOL,
     )
 
     # Set the task dependencies
-    test_connection_task >> fetch_history_task
+    extract_task >> [track_features_task, artist_details_task] >> transform_task >> validate_task >> load_task
@@ -0,0 +1,143 @@
+"""
+Ready-made reports over the processed Parquet files, run in-process with Arrow datasets instead of PostgreSQL.
+Each query reads only the columns it needs. Play-date ranges prune whole partition directories, and the user
+and artist-position filters are pushed down to the Parquet reader, which skips row groups their statistics rule out.
+
+Dates are UTC play dates ("YYYY-MM-DD", inclusive), as in the played_date partitions.
+"""
+import os
+import json
+from scripts.storage.partitions import DEFAULT_USER_ID, FACT_PARTITION, SNAPSHOT_PARTITION, list_partitions
+
+PROCESSED_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/processed"))
+LISTENING_HISTORY_DIR = os.path.join(PROCESSED_DATA_DIR, "listening_history_fact")
+LISTENING_HISTORY_ARTISTS_DIR = os.path.join(PROCESSED_DATA_DIR, "listening_history_artists")
+TRACK_DIMENSION_DIR = os.path.join(PROCESSED_DATA_DIR, "track_dimension")
+ARTIST_DIMENSION_DIR = os.path.join(PROCESSED_DATA_DIR, "artist_dimension")
+
+
+def list_parquet_files(base_dir, column, start=None, end=None):
+    """Lists the Parquet files of the partitions between start and end (inclusive), oldest partition first."""
+    return [os.path.join(path, f)
+            for _, path in list_partitions(base_dir, column, start, end)
+            for f in sorted(os.listdir(path)) if f.endswith(".parquet")]
+
+
+def scan_facts(base_dir, columns, start=None, end=None, user_id=None, filter=None):
+    """
+    Reads some columns of a fact table's partitions between start and end.
+
+    Args:
+        columns (list): The columns to read (the played_date partition column included).
+        user_id (str): Only read this user's plays.
+        filter (pyarrow.dataset.Expression): Another row filter, pushed down to the reader.
+
+    Returns:
+        pyarrow.Table: The matching rows.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    # Covers both fact tables. Declared rather than inferred, since plays transformed before users existed
+    # have no user_id column (read as null); only the projected columns are actually read
+    schema = pa.schema([(FACT_PARTITION, pa.string()), ("played_at", pa.string()), ("track_id", pa.string()),
+                        ("artist_ids", pa.string()), ("artist_id", pa.string()), ("artist_position", pa.int64()),
+                        ("user_id", pa.string())])
+
+    files = list_parquet_files(base_dir, FACT_PARTITION, start, end)
+    if not files:
+        return schema.empty_table().select(columns)
+    dataset = ds.dataset(files, schema=schema, format="parquet", partition_base_dir=base_dir,
+                         partitioning=ds.partitioning(pa.schema([(FACT_PARTITION, pa.string())]), flavor="hive"))
+
+    conditions = [filter] if filter is not None else []
+    if user_id is not None:
+        condition = ds.field("user_id") == user_id
+        conditions.append(condition | ds.field("user_id").is_null() if user_id == DEFAULT_USER_ID else condition)
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+def read_latest_dimension(base_dir, key, columns):
+    """Reads some columns of a dimension, keeping each row's most recent snapshot."""
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    frames = [pq.read_table(path, columns=columns).to_pandas()
+              for path in list_parquet_files(base_dir, SNAPSHOT_PARTITION)]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True).drop_duplicates(subset=[key], keep="last").reset_index(drop=True)
+
+
+def count_by(table, column):
+    """Returns the rows per value of a column as a DataFrame with the columns [column, "plays"]."""
+    counts = table.group_by(column).aggregate([(column, "count")]).to_pandas()
+    return counts.rename(columns={f"{column}_count": "plays"})[[column, "plays"]]
+
+
+def top_artists(limit=10, start=None, end=None, user_id=None):
+    """
+    Returns the most played artists (every credited artist of a play counts), with their names.
+
+    Returns:
+        pd.DataFrame: artist_id, artist_name, plays; most played first.
+    """
+    plays = scan_facts(LISTENING_HISTORY_ARTISTS_DIR, ["artist_id"], start, end, user_id)
+    counts = count_by(plays, "artist_id").sort_values(["plays", "artist_id"], ascending=[False, True]).head(limit)
+    names = read_latest_dimension(ARTIST_DIMENSION_DIR, "artist_id", ["artist_id", "artist_name"])
+    top = counts.merge(names, on="artist_id", how="left")
+    return top[["artist_id", "artist_name", "plays"]].reset_index(drop=True)
+
+
+def listening_time_per_day(start=None, end=None, user_id=None):
+    """
+    Returns the plays and the minutes listened per UTC day (a play counts for its track's full duration).
+
+    Returns:
+        pd.DataFrame: played_date, plays, minutes_played; oldest day first.
+    """
+    import pyarrow as pa
+
+    plays = scan_facts(LISTENING_HISTORY_DIR, [FACT_PARTITION, "track_id"], start, end, user_id)
+    durations = read_latest_dimension(TRACK_DIMENSION_DIR, "track_id", ["track_id", "duration_ms"])
+    durations = pa.Table.from_pandas(durations.astype({"duration_ms": "float64"}), preserve_index=False)
+
+    daily = (plays.join(durations, "track_id", join_type="left outer")
+             .group_by(FACT_PARTITION).aggregate([("track_id", "count"), ("duration_ms", "sum")]).to_pandas())
+    daily["minutes_played"] = (daily["duration_ms_sum"].fillna(0) / 60000).round(1)
+    daily = daily.rename(columns={"track_id_count": "plays"}).sort_values(FACT_PARTITION)
+    return daily[[FACT_PARTITION, "plays", "minutes_played"]].reset_index(drop=True)
+
+
+def genre_share(start=None, end=None, user_id=None, limit=None):
+    """
+    Returns each genre's share of the plays. Genres come from a play's primary artist (the only one with
+    artist details), and an artist with several genres counts for each, so shares can add up to more than 1.
+
+    Returns:
+        pd.DataFrame: genre, plays, share; most played first.
+    """
+    import pandas as pd
+    import pyarrow.dataset as ds
+
+    plays = scan_facts(LISTENING_HISTORY_ARTISTS_DIR, ["artist_id"], start, end, user_id,
+                       filter=ds.field("artist_position") == 1)
+    counts = count_by(plays, "artist_id")
+    artists = read_latest_dimension(ARTIST_DIMENSION_DIR, "artist_id", ["artist_id", "genres"])
+    artists["genre"] = [json.loads(genres) if genres else [] for genres in artists["genres"]]
+
+    genres = counts.merge(artists[["artist_id", "genre"]].explode("genre").dropna(), on="artist_id")
+    shares = genres.groupby("genre", as_index=False)["plays"].sum()
+    shares["share"] = (shares["plays"] / len(plays)).round(4) if len(plays) else pd.Series(dtype=float)
+    shares = shares.sort_values(["plays", "genre"], ascending=[False, True])
+    return (shares.head(limit) if limit else shares).reset_index(drop=True)
+
+
+REPORTS = {
+    "top-artists": top_artists,
+    "listening-time": listening_time_per_day,
+    "genre-share": genre_share,
+}
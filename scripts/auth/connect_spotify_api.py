@@ -1,44 +1,161 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import requests
 import spotipy
+from spotipy.cache_handler import CacheHandler
 from spotipy.oauth2 import SpotifyOAuth
-import os
-from dotenv import load_dotenv
+from scripts.auth.stub_spotify_client import StubSpotifyClient
+from scripts.auth.user_registry import get_user
+from scripts.env import load_env
+from scripts.storage.partitions import DEFAULT_USER_ID, user_path, write_json_atomic
+
+# Token caches live next to the stage watermarks (per user), which every Airflow worker shares
+TOKEN_CACHE_DIR = os.getenv("SPOTIFY_TOKEN_CACHE_DIR",
+                            os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/metadata")))
+
+# Keep-alive connections per host; enough for every fetch scheduler worker to hold one
+HTTP_POOL_SIZE = int(os.getenv("SPOTIFY_HTTP_POOL_SIZE", os.getenv("SPOTIFY_MAX_WORKERS", "8")))
+REQUEST_TIMEOUT = float(os.getenv("SPOTIFY_REQUEST_TIMEOUT", "10"))
+API_URL = os.getenv("SPOTIFY_API_URL")  # Web API base URL override, e.g. a local fake server for benchmarks
+
+_clients = {}
+_session = None
+_lock = threading.Lock()
+
+
+def get_spotify_config():
+    """
+    Reads the Spotify settings from the environment (and .env). Credentials are only required for the
+    real client, and are checked when the first client is built rather than on import.
+    """
+    load_env()
+    config = {
+        "client": os.getenv('SPOTIFY_CLIENT', 'spotipy'),  # "stub" for the offline client
+        "client_id": os.getenv('CLIENT_ID'),
+        "client_secret": os.getenv('CLIENT_SECRET'),
+        "redirect_uri": os.getenv('REDIRECT_URI'),
+    }
+    if config["client"] != 'stub' and not all([config["client_id"], config["client_secret"], config["redirect_uri"]]):
+        raise ValueError(
+            "Missing environment variables. Ensure CLIENT_ID, CLIENT_SECRET, and REDIRECT_URI are set in the .env file.")
+    return config
+
+
+class SharedTokenCache(CacheHandler):
+    """
+    Token cache shared by every process on the host (e.g. Airflow workers). The token is stored as JSON,
+    written atomically under an exclusive file lock, and kept in memory until it is about to expire, so
+    API calls do not read the file. An expiring token is re-read first, in case another process already
+    refreshed it. A refresh token from the user registry stands in until the first token is cached.
+    """
+
+    def __init__(self, path, scope=None, refresh_token=None):
+        self.path = path
+        self.scope = scope
+        self.refresh_token = refresh_token
+        self.token_info = None
+        self.mutex = threading.Lock()
+
+    def _file_lock(self, mode):
+        """Opens the lock file and locks it; closing the returned file releases the lock."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(f"{self.path}.lock", "a")
+        fcntl.flock(lock_file, mode)
+        return lock_file
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        with self._file_lock(fcntl.LOCK_SH):
+            with open(self.path, "r") as f:
+                return json.load(f)
+
+    def get_cached_token(self):
+        with self.mutex:
+            # spotipy refreshes tokens that expire within 60 seconds
+            if self.token_info is None or self.token_info.get("expires_at", 0) - time.time() < 60:
+                self.token_info = self._read() or self.token_info or self._seed()
+            return self.token_info
+
+    def _seed(self):
+        if not self.refresh_token:
+            return None
+        # Already expired, so spotipy exchanges the refresh token for an access token on first use
+        return {"access_token": None, "token_type": "Bearer", "expires_at": 0, "scope": self.scope,
+                "refresh_token": self.refresh_token}
 
-# Load environment variables from .env file
-env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.env"))
-load_dotenv(env_path)
+    def save_token_to_cache(self, token_info):
+        with self.mutex:
+            self.token_info = token_info
+            with self._file_lock(fcntl.LOCK_EX):
+                write_json_atomic(token_info, self.path)
 
-# Get credentials from environment variables
-CLIENT_ID = os.getenv('CLIENT_ID')
-CLIENT_SECRET = os.getenv('CLIENT_SECRET')
-REDIRECT_URI = os.getenv('REDIRECT_URI')
 
-# Check if the environment variables are loaded correctly
-if not CLIENT_ID or not CLIENT_SECRET or not REDIRECT_URI:
-    raise ValueError(
-        "Missing environment variables. Ensure CLIENT_ID, CLIENT_SECRET, and REDIRECT_URI are set in the .env file.")
+def get_session():
+    """
+    Returns the process-wide HTTP session: keep-alive connections pooled per host, and no urllib3
+    retries, so 429 responses (and their Retry-After header) reach the fetch scheduler.
+    """
+    global _session
+    if _session is None or _session.pid != os.getpid():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.pid = os.getpid()
+        _session = session
+    return _session
 
 
-def connect_to_spotify_api(scope="user-read-recently-played"):
+def connect_to_spotify_api(scope="user-read-recently-played", user_id=DEFAULT_USER_ID):
     """
-    Connect to Spotify API using OAuth.
+    Connect to Spotify API using OAuth. Clients are built once per user, scope and process, then reused.
 
     Args:
         scope (str): The scope of the access. Defaults to 'user-read-recently-played'.
+        user_id (str): The user whose token to use (see the user registry).
 
     Returns:
-        spotipy.Spotify: The authenticated Spotify API client.
-    """
-    # Initialize Spotipy with OAuth and provided scope
-    sp = spotipy.Spotify(
-        auth_manager=SpotifyOAuth(
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            redirect_uri=REDIRECT_URI,
-            scope=scope
-        )
-    )
-
-    return sp
+        spotipy.Spotify: The authenticated Spotify API client (a StubSpotifyClient if SPOTIFY_CLIENT=stub).
+    """
+    config = get_spotify_config()
+    key = (os.getpid(), config["client"], scope, user_id)
+    with _lock:
+        if key in _clients:
+            return _clients[key]
+
+        if config["client"] == 'stub':
+            sp = StubSpotifyClient()
+        else:
+            session = get_session()
+            # One token file per scope, since a token only covers the scopes it was granted
+            scope_name = re.sub(r"[^\w-]", "_", scope)
+            cache_path = os.path.join(user_path(TOKEN_CACHE_DIR, user_id), f"spotify_token_{scope_name}.json")
+            cache_handler = SharedTokenCache(cache_path, scope, get_user(user_id).get("refresh_token"))
+
+            # Initialize Spotipy with OAuth and provided scope
+            sp = spotipy.Spotify(
+                auth_manager=SpotifyOAuth(
+                    client_id=config["client_id"],
+                    client_secret=config["client_secret"],
+                    redirect_uri=config["redirect_uri"],
+                    scope=scope,
+                    cache_handler=cache_handler,
+                    requests_session=session,
+                    requests_timeout=REQUEST_TIMEOUT,
+                ),
+                requests_session=session,
+                requests_timeout=REQUEST_TIMEOUT,
+            )
+            if API_URL:
+                sp.prefix = API_URL
+
+        _clients[key] = sp
+        return sp
 
 
 def main():
@@ -0,0 +1,137 @@
+"""
+Offline stand-in for the Spotify Web API, used when SPOTIFY_CLIENT=stub (e.g. to test the DAG without
+credentials or network) and by the benchmarks. Every payload is deterministic for a given ID.
+"""
+import time
+from datetime import datetime, timezone
+
+STUB_START_MS = 1735689600000  # 2025-01-01 UTC
+STUB_PLAY_INTERVAL_MS = 180000  # One play every 3 minutes
+STUB_TRACK_COUNT = 3000
+
+
+def fake_artist(artist_id):
+    """Builds a deterministic artist object for the given ID."""
+    n = sum(map(ord, artist_id))
+    return {
+        "id": artist_id,
+        "name": f"Artist {artist_id}",
+        "type": "artist",
+        "popularity": n % 100,
+        "followers": {"href": None, "total": n * 37},
+        "genres": [f"genre-{n % 7}", f"genre-{n % 11}"],
+    }
+
+
+# Spotify returns ~185 market codes on every track and album object
+MARKETS = [a + b for a in "ABCDEFGHIJKLMNOPQRSTUVWXYZ" for b in "ABCDEFG"][:185]
+
+
+def fake_track(track_id):
+    """Builds a deterministic track object for the given ID, shaped like a full Spotify track."""
+    n = sum(map(ord, track_id))
+    artist_id = f"artist{n % 500:05d}"
+    album_id = f"album{n % 200:05d}"
+    artist = {
+        "external_urls": {"spotify": f"https://open.spotify.com/artist/{artist_id}"},
+        "href": f"https://api.spotify.com/v1/artists/{artist_id}",
+        "id": artist_id,
+        "name": f"Artist {artist_id}",
+        "type": "artist",
+        "uri": f"spotify:artist:{artist_id}",
+    }
+    return {
+        "album": {
+            "album_type": "album",
+            "artists": [artist],
+            "available_markets": MARKETS,
+            "external_urls": {"spotify": f"https://open.spotify.com/album/{album_id}"},
+            "href": f"https://api.spotify.com/v1/albums/{album_id}",
+            "id": album_id,
+            "images": [{"height": size, "url": f"https://i.scdn.co/image/{album_id}{size}", "width": size}
+                       for size in (640, 300, 64)],
+            "name": f"Album {n % 200}",
+            "release_date": "2024-01-01",
+            "release_date_precision": "day",
+            "total_tracks": 12,
+            "type": "album",
+            "uri": f"spotify:album:{album_id}",
+        },
+        "artists": [artist],
+        "available_markets": MARKETS,
+        "disc_number": 1,
+        "duration_ms": 120000 + n % 180000,
+        "explicit": n % 2 == 0,
+        "external_ids": {"isrc": f"USX{n:09d}"},
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+        "href": f"https://api.spotify.com/v1/tracks/{track_id}",
+        "id": track_id,
+        "is_local": False,
+        "name": f"Track {track_id}",
+        "popularity": n % 100,
+        "preview_url": None,
+        "track_number": n % 12 + 1,
+        "type": "track",
+        "uri": f"spotify:track:{track_id}",
+    }
+
+
+def fake_play(i, track_count=STUB_TRACK_COUNT, start_ms=STUB_START_MS):
+    """Builds the i-th recently-played item (one play every 3 minutes from 2025-01-01 UTC)."""
+    played_at = datetime.fromtimestamp((start_ms + i * STUB_PLAY_INTERVAL_MS) / 1000, tz=timezone.utc)
+    return {
+        "track": fake_track(f"track{i % track_count:06d}"),
+        "played_at": played_at.strftime("%Y-%m-%dT%H:%M:%S.") + f"{played_at.microsecond // 1000:03d}Z",
+        "context": {"type": "playlist", "href": "https://api.spotify.com/v1/playlists/fake",
+                    "external_urls": {"spotify": "https://open.spotify.com/playlist/fake"},
+                    "uri": "spotify:playlist:fake"},
+    }
+
+
+class StubSpotifyClient:
+    """
+    Implements the spotipy.Spotify methods the pipeline calls. The listening history is one play every
+    3 minutes from 2025-01-01 UTC up to the current time (or the first play_count plays).
+    """
+
+    def __init__(self, track_count=STUB_TRACK_COUNT, start_ms=STUB_START_MS, play_count=None):
+        self.track_count = track_count
+        self.start_ms = start_ms
+        self.play_count = play_count
+
+    def _play_index(self, timestamp_ms):
+        """Index of the last play at or before timestamp_ms (-1 if none)."""
+        return (timestamp_ms - self.start_ms) // STUB_PLAY_INTERVAL_MS
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        last = self._play_index(int(time.time() * 1000))
+        if self.play_count is not None:
+            last = min(last, self.play_count - 1)
+        if after is not None:
+            # The oldest plays after the cursor
+            first = max(self._play_index(after) + 1, 0)
+            indexes = range(first, min(first + limit, last + 1))
+            has_next = indexes.stop <= last
+        else:
+            # The most recent plays before the cursor
+            end = min(self._play_index(before - 1), last) if before is not None else last
+            indexes = range(max(end - limit + 1, 0), end + 1)
+            has_next = indexes.start > 0
+
+        # Spotify returns the most recent play first, with cursors to the newest and oldest play of the page
+        items = [fake_play(i, self.track_count, self.start_ms) for i in reversed(indexes)]
+        cursors, next_url = None, None
+        if items:
+            newest = self.start_ms + indexes[-1] * STUB_PLAY_INTERVAL_MS
+            oldest = self.start_ms + indexes[0] * STUB_PLAY_INTERVAL_MS
+            cursors = {"after": str(newest), "before": str(oldest)}
+            if has_next:
+                direction = f"after={newest}" if after is not None else f"before={oldest}"
+                next_url = f"https://api.spotify.com/v1/me/player/recently-played?{direction}&limit={limit}"
+        return {"items": items, "next": next_url, "cursors": cursors, "limit": limit}
+
+    def tracks(self, tracks):
+        return {"tracks": [fake_track(track_id) for track_id in tracks]}
+
+    def artists(self, artists):
+        return {"artists": [fake_artist(artist_id) for artist_id in artists]}
@@ -0,0 +1,42 @@
+import os
+import re
+import json
+from scripts.storage.partitions import DEFAULT_USER_ID
+
+# JSON list of users to extract, e.g. [{"user_id": "alice", "refresh_token": "..."}, {"user_id": "bob"}].
+# refresh_token seeds the user's token cache and can be left out once the user has authorized once.
+USERS_FILE = os.getenv("SPOTIFY_USERS_FILE",
+                       os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/metadata/users.json")))
+
+
+def load_users():
+    """
+    Reads the user registry. Without a registry the pipeline runs for the default user (the OAuth
+    identity in .env) only.
+
+    Returns:
+        list: One dict per user, each with at least a "user_id".
+    """
+    if not os.path.exists(USERS_FILE):
+        return [{"user_id": DEFAULT_USER_ID}]
+
+    with open(USERS_FILE, "r") as f:
+        users = json.load(f)
+
+    user_ids = [user.get("user_id") for user in users]
+    invalid = [user_id for user_id in user_ids if not isinstance(user_id, str) or not re.fullmatch(r"[\w-]+", user_id)]
+    if invalid:
+        raise ValueError(f"Invalid user_id(s) in {USERS_FILE}: {invalid}. Use letters, digits, '_' or '-'.")
+    if len(set(user_ids)) != len(user_ids):
+        raise ValueError(f"Duplicate user_id(s) in {USERS_FILE}.")
+    return users
+
+
+def get_user_ids():
+    """Returns the IDs of every registered user."""
+    return [user["user_id"] for user in load_users()]
+
+
+def get_user(user_id):
+    """Returns a user's registry entry ({"user_id": user_id} if the user is not registered)."""
+    return next((user for user in load_users() if user["user_id"] == user_id), {"user_id": user_id})
@@ -0,0 +1,120 @@
+"""
+Command-line entry point for every pipeline stage, e.g.:
+    python -m scripts.cli create-db
+    python -m scripts.cli extract --start 2025-01-01T00:00 --end 2025-01-01T01:00
+    python -m scripts.cli transform --mode stream
+    python -m scripts.cli report top-artists --start 2025-01-01 --limit 20
+
+Only the standard library is imported up front. .env is loaded and the stage's module imported once the
+stage is chosen, so each command only pays for the dependencies it uses (e.g. load never imports spotipy).
+"""
+import argparse
+from datetime import datetime, timezone
+from scripts.env import load_env
+
+
+def parse_datetime(value):
+    """Parses an ISO 8601 date or datetime; without a UTC offset, it is taken as UTC."""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def create_db(args):
+    from scripts.database.create_spotify_db import create_db, create_tables
+    create_db()
+    create_tables()
+
+
+def extract(args):
+    from scripts.extraction.extract_listening_history import extract_all_users
+    extract_all_users(start=args.start, end=args.end, workers=args.workers)
+
+
+def enrich_tracks(args):
+    from scripts.extraction.extract_track_features import extract_track_features
+    extract_track_features()
+
+
+def enrich_artists(args):
+    from scripts.extraction.extract_artist_data import extract_artist_features
+    extract_artist_features()
+
+
+def transform(args):
+    from scripts.transformation.transform_listening_history import transform_listening_history
+    transform_listening_history(mode=args.mode)
+
+
+def validate(args):
+    from scripts.validation.validate_processed_data import validate_processed_data
+    validate_processed_data()
+
+
+def load(args):
+    from scripts.database.insert_spotify_data import insert_spotify_data
+    insert_spotify_data(mode=args.mode, workers=args.workers, chunk_rows=args.chunk_rows)
+
+
+def report(args):
+    from scripts.analytics.query_processed_data import REPORTS
+    options = {"start": args.start, "end": args.end, "user_id": args.user}
+    if args.report != "listening-time":
+        options["limit"] = args.limit
+    result = REPORTS[args.report](**options)
+    if args.output is None:
+        print(result.to_string(index=False))
+    elif args.output.endswith(".parquet"):
+        result.to_parquet(args.output, index=False)
+    else:
+        result.to_csv(args.output, index=False)
+    if args.output is not None:
+        print(f"✅ Wrote {len(result)} rows to {args.output}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m scripts.cli", description="Run one stage of the Spotify ETL.")
+    stages = parser.add_subparsers(dest="stage", required=True)
+
+    stages.add_parser("create-db", help="Create the database and its tables").set_defaults(run=create_db)
+
+    stage = stages.add_parser("extract", help="Extract every registered user's listening history")
+    stage.add_argument("--start", type=parse_datetime, default=None, help="Start of the data interval (UTC)")
+    stage.add_argument("--end", type=parse_datetime, default=None, help="End of the data interval (exclusive)")
+    stage.add_argument("--workers", type=int, default=None, help="Users extracted at once")
+    stage.set_defaults(run=extract)
+
+    stages.add_parser("enrich-tracks", help="Fetch the track features of new batches").set_defaults(run=enrich_tracks)
+    stages.add_parser("enrich-artists", help="Fetch the artist details of new batches").set_defaults(run=enrich_artists)
+
+    stage = stages.add_parser("transform", help="Transform new batches into Parquet")
+    stage.add_argument("--mode", choices=["batch", "stream"], default=None)
+    stage.set_defaults(run=transform)
+
+    stages.add_parser("validate", help="Validate new processed batches").set_defaults(run=validate)
+
+    stage = stages.add_parser("load", help="Load validated batches into PostgreSQL")
+    stage.add_argument("--mode", choices=["copy", "row"], default=None)
+    stage.add_argument("--workers", type=int, default=None, help="Tables loaded at once")
+    stage.add_argument("--chunk-rows", type=int, default=None, help="Rows per commit, 0 for one commit per table")
+    stage.set_defaults(run=load)
+
+    stage = stages.add_parser("report", help="Run a report over the processed Parquet files, without the database")
+    stage.add_argument("report", choices=["top-artists", "listening-time", "genre-share"])
+    stage.add_argument("--start", default=None, help="First play date (YYYY-MM-DD, UTC)")
+    stage.add_argument("--end", default=None, help="Last play date (inclusive)")
+    stage.add_argument("--user", default=None, help="Only this user's plays")
+    stage.add_argument("--limit", type=int, default=10, help="Rows of top-artists and genre-share")
+    stage.add_argument("--output", default=None, help="Export to a .csv or .parquet file instead of printing")
+    stage.set_defaults(run=report)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # Before the stage's modules are imported, since they read their settings on import
+    load_env()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
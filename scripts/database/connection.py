@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from scripts.env import load_env
+
+# Pool settings
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "4"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    ThreadedConnectionPool that blocks (up to a timeout) instead of failing when every connection
+    is checked out, and records how long callers waited.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, **connect_kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.stats_lock = threading.Lock()
+        self.stats = {"checkouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def getconn(self):
+        start = time.perf_counter()
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolError(f"No database connection available after {self.timeout}s")
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+        waited = time.perf_counter() - start
+        with self.stats_lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        try:
+            self.pool.putconn(conn, close=close or conn.closed != 0)
+        finally:
+            self.slots.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+def get_db_config(dbname=None):
+    """
+    Reads the connection settings from the environment (and .env).
+
+    Args:
+        dbname (str): Database to connect to. Defaults to DB_NAME.
+    """
+    load_env()
+    config = {
+        "dbname": dbname or os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "host": os.getenv("DB_HOST"),
+        "port": int(os.getenv("DB_PORT", "5432")),
+    }
+    if not all(config.values()):
+        raise ValueError("Environment variables DB_USER, DB_PASSWORD, DB_HOST and DB_NAME must be set.")
+    statement_timeout_ms = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 disables the timeout
+    if statement_timeout_ms:
+        config["options"] = f"-c statement_timeout={statement_timeout_ms}"
+    return config
+
+
+def get_pool(dbname=None):
+    """
+    Returns the process-wide pool for a database, creating it on first use. A forked worker gets
+    its own pool, so connections are set up once per worker rather than once per task.
+    """
+    config = get_db_config(dbname)
+    key = config["dbname"]
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, **config)
+            _pools[key] = pool
+        return pool
+
+
+@contextmanager
+def connection(dbname=None, autocommit=False):
+    """
+    Borrows a pooled connection. Uncommitted work is rolled back if the block raises, and the
+    connection is returned to the pool either way.
+
+    Usage:
+        with connection() as conn:
+            ...
+            conn.commit()
+    """
+    pool = get_pool(dbname)
+    conn = pool.getconn()
+    broken = False
+    try:
+        conn.autocommit = autocommit
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            if not conn.closed:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+        pool.putconn(conn, close=broken)
+
+
+def get_pool_stats():
+    """Returns checkout count and pool wait times per database for this process."""
+    with _pools_lock:
+        return {dbname: dict(pool.stats) for dbname, pool in _pools.items()}
+
+
+def close_pools():
+    """Closes every pooled connection of this process."""
+    with _pools_lock:
+        for pool in _pools.values():
+            if pool.pid == os.getpid():
+                pool.closeall()
+        _pools.clear()
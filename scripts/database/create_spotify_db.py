@@ -1,123 +1,336 @@
 import os
-import psycopg2
-from psycopg2.errors import OperationalError, DuplicateDatabase
-from dotenv import load_dotenv
+from scripts.database.connection import connection
 
-# Load environment variables from .env file
-load_dotenv(dotenv_path="../.env")
+DB_NAME = "spotify_db"
 
+# Also keep every version of the dimension rows in <table>_history (slowly changing dimension, type 2)
+DIMENSION_HISTORY = os.getenv("DIMENSION_HISTORY", "false").lower() == "true"
 
-def get_db_connection(dbname, user, password, host, port=5432):
+
+def create_db():
     """
-    Establish a connection to the PostgreSQL database.
+    Create the 'spotify_db' database if it doesn't already exist.
     """
     try:
-        return psycopg2.connect(
-            dbname=dbname,
-            user=user,
-            password=password,
-            host=host,
-            port=port
-        )
-    except OperationalError as e:
-        print(f"Error connecting to database '{dbname}': {e}")
+        # Connect to the default 'postgres' database first (CREATE DATABASE cannot run in a transaction)
+        with connection("postgres", autocommit=True) as conn:
+            cursor = conn.cursor()
+
+            # Create 'spotify_db' if it does not exist
+            cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (DB_NAME,))
+            if cursor.fetchone() is None:
+                cursor.execute(f"CREATE DATABASE {DB_NAME};")
+                print(f"Database '{DB_NAME}' created successfully.")
+            else:
+                print(f"Database '{DB_NAME}' already exists.")
+            cursor.close()
+
+    except Exception as e:
+        print(f"Error creating database: {e}")
         raise
 
 
-def create_db():
+# Tables in creation order
+TABLE_STATEMENTS = [
+    # Artists Table (genres is a JSON array, indexed below for containment queries; row_hash is the
+    # loader's hash of the other columns, so unchanged rows are not sent again)
     """
-    Create the 'spotify_db' database if it doesn't already exist.
+    CREATE TABLE IF NOT EXISTS artists (
+        artist_id VARCHAR PRIMARY KEY,
+        artist_name TEXT NOT NULL,
+        genres JSONB,
+        followers INT,
+        popularity INT,
+        row_hash TEXT
+    );
+    """,
+    # Tracks Table (Fixing the incorrect foreign key reference)
+    """
+    CREATE TABLE IF NOT EXISTS tracks (
+        track_id VARCHAR PRIMARY KEY,
+        track_name TEXT NOT NULL,
+        album_name TEXT,
+        popularity INT,
+        duration_ms INT,
+        album_release_date TEXT,
+        explicit BOOLEAN,
+        row_hash TEXT
+    );
+    """,
+    # Listening History Table (artist_ids is kept as the denormalized, comma-separated list; user_id is
+    # last so positional inserts of the original columns still work)
     """
-    db_user = os.getenv('DB_USER')
-    db_password = os.getenv('DB_PASSWORD')
-    db_host = os.getenv('DB_HOST')
+    CREATE TABLE IF NOT EXISTS listening_history (
+        played_at TIMESTAMPTZ NOT NULL,
+        track_id VARCHAR NOT NULL,
+        artist_ids TEXT NOT NULL,
+        user_id VARCHAR NOT NULL DEFAULT 'default',
+        FOREIGN KEY (track_id) REFERENCES tracks(track_id),
+        UNIQUE (user_id, track_id, played_at)
+    );
+    """,
+    # Play-to-artist bridge: one row per artist of every play (artist_position 1 is the primary artist). Its
+    # foreign key to listening_history is added by the migrations, once listening_history has a user_id
+    """
+    CREATE TABLE IF NOT EXISTS listening_history_artists (
+        played_at TIMESTAMPTZ NOT NULL,
+        track_id VARCHAR NOT NULL,
+        artist_id VARCHAR NOT NULL,
+        artist_position SMALLINT NOT NULL,
+        user_id VARCHAR NOT NULL DEFAULT 'default',
+        PRIMARY KEY (user_id, played_at, track_id, artist_id)
+    );
+    """,
+    # Daily rollups for dashboards, maintained incrementally by the loader (play_date is the UTC date)
+    """
+    CREATE TABLE IF NOT EXISTS daily_track_plays (
+        play_date DATE NOT NULL,
+        track_id VARCHAR NOT NULL,
+        plays INT NOT NULL,
+        ms_played BIGINT NOT NULL,
+        user_id VARCHAR NOT NULL DEFAULT 'default',
+        PRIMARY KEY (user_id, play_date, track_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_artist_plays (
+        play_date DATE NOT NULL,
+        artist_id VARCHAR NOT NULL,
+        plays INT NOT NULL,
+        user_id VARCHAR NOT NULL DEFAULT 'default',
+        PRIMARY KEY (user_id, play_date, artist_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_genre_plays (
+        play_date DATE NOT NULL,
+        genre TEXT NOT NULL,
+        plays INT NOT NULL,
+        user_id VARCHAR NOT NULL DEFAULT 'default',
+        PRIMARY KEY (user_id, play_date, genre)
+    );
+    """,
+    # Dimension history: one row per version, current while valid_to is NULL (filled when DIMENSION_HISTORY=true)
+    """
+    CREATE TABLE IF NOT EXISTS artists_history (
+        LIKE artists INCLUDING DEFAULTS,
+        valid_from TIMESTAMPTZ NOT NULL,
+        valid_to TIMESTAMPTZ,
+        PRIMARY KEY (artist_id, valid_from)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tracks_history (
+        LIKE tracks INCLUDING DEFAULTS,
+        valid_from TIMESTAMPTZ NOT NULL,
+        valid_to TIMESTAMPTZ,
+        PRIMARY KEY (track_id, valid_from)
+    );
+    """,
+]
 
-    if not all([db_user, db_password, db_host]):
-        raise ValueError("Environment variables DB_USER, DB_PASSWORD, and DB_HOST must be set.")
 
-    try:
-        # Connect to the default 'postgres' database first
-        conn = psycopg2.connect(
-            dbname="postgres", user=db_user, password=db_password, host=db_host
-        )
-        conn.autocommit = True
-        cursor = conn.cursor()
-
-        # Create 'spotify_db' if it does not exist
-        cursor.execute("SELECT 1 FROM pg_database WHERE datname = 'spotify_db';")
-        if cursor.fetchone() is None:
-            cursor.execute("CREATE DATABASE spotify_db;")
-            print("Database 'spotify_db' created successfully.")
-        else:
-            print("Database 'spotify_db' already exists.")
+def set_primary_key(table, columns):
+    """Returns a statement that replaces a table's primary key unless it already includes user_id."""
+    return f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = '{table}'::regclass AND i.indisprimary AND a.attname = 'user_id'
+        ) THEN
+            ALTER TABLE {table} DROP CONSTRAINT {table}_pkey, ADD PRIMARY KEY ({columns});
+        END IF;
+    END $$;
+    """
 
-    except Exception as e:
-        print(f"Error creating database: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+
+# Brings databases created before multi-user support and row hashes up to date; existing rows belong to the
+# default user, and rows without a hash are sent (and hashed) once by the next load
+MIGRATION_STATEMENTS = [
+    "ALTER TABLE artists ADD COLUMN IF NOT EXISTS row_hash TEXT;",
+    "ALTER TABLE tracks ADD COLUMN IF NOT EXISTS row_hash TEXT;",
+    "ALTER TABLE artists_history ADD COLUMN IF NOT EXISTS row_hash TEXT;",
+    "ALTER TABLE tracks_history ADD COLUMN IF NOT EXISTS row_hash TEXT;",
+    "ALTER TABLE listening_history ADD COLUMN IF NOT EXISTS user_id VARCHAR NOT NULL DEFAULT 'default';",
+    "CREATE UNIQUE INDEX IF NOT EXISTS listening_history_user_id_track_id_played_at_key "
+    "ON listening_history (user_id, track_id, played_at);",
+    "ALTER TABLE listening_history_artists ADD COLUMN IF NOT EXISTS user_id VARCHAR NOT NULL DEFAULT 'default';",
+    "ALTER TABLE listening_history_artists DROP CONSTRAINT IF EXISTS listening_history_artists_track_id_played_at_fkey;",
+    "ALTER TABLE listening_history DROP CONSTRAINT IF EXISTS listening_history_track_id_played_at_key;",
+    set_primary_key("listening_history_artists", "user_id, played_at, track_id, artist_id"),
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                       WHERE conname = 'listening_history_artists_user_id_track_id_played_at_fkey') THEN
+            ALTER TABLE listening_history_artists ADD FOREIGN KEY (user_id, track_id, played_at)
+                REFERENCES listening_history(user_id, track_id, played_at) ON DELETE CASCADE;
+        END IF;
+    END $$;
+    """,
+] + [
+    statement
+    for table, columns in [("daily_track_plays", "user_id, play_date, track_id"),
+                           ("daily_artist_plays", "user_id, play_date, artist_id"),
+                           ("daily_genre_plays", "user_id, play_date, genre")]
+    for statement in [f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS user_id VARCHAR NOT NULL DEFAULT 'default';",
+                      set_primary_key(table, columns)]
+]
+
+INDEX_STATEMENTS = [
+    # Plays arrive in played_at order, so a BRIN index prunes time ranges at a fraction of a B-tree's size
+    "CREATE INDEX IF NOT EXISTS listening_history_played_at_brin ON listening_history USING BRIN (played_at);",
+    # Per-artist queries over a time range
+    "CREATE INDEX IF NOT EXISTS listening_history_artists_artist_idx "
+    "ON listening_history_artists (artist_id, played_at);",
+    # Per-genre queries (genres @> '["rock"]')
+    "CREATE INDEX IF NOT EXISTS artists_genres_gin ON artists USING GIN (genres jsonb_path_ops);",
+]
+
+# Fills the bridge from artist_ids for plays loaded before it existed (no-op once it has rows)
+BACKFILL_ARTISTS_STATEMENT = """
+    INSERT INTO listening_history_artists (played_at, track_id, artist_id, artist_position, user_id)
+    SELECT h.played_at, h.track_id, a.artist_id, a.artist_position, h.user_id
+    FROM listening_history h
+    CROSS JOIN LATERAL unnest(string_to_array(NULLIF(h.artist_ids, ''), ','))
+        WITH ORDINALITY AS a(artist_id, artist_position)
+    WHERE NOT EXISTS (SELECT 1 FROM listening_history_artists)
+    ON CONFLICT DO NOTHING;
+"""
+
+
+# Rollup refreshes: each one adds the rows of {new_rows} (the rows a load just inserted into "source")
+# to the counts already in "table"
+ROLLUPS = [
+    {
+        "table": "daily_track_plays",
+        "source": "listening_history",
+        "statement": """
+            INSERT INTO daily_track_plays (user_id, play_date, track_id, plays, ms_played)
+            SELECT n.user_id, (n.played_at AT TIME ZONE 'UTC')::date, n.track_id, count(*),
+                   coalesce(sum(t.duration_ms), 0)
+            FROM {new_rows} n
+            LEFT JOIN tracks t ON t.track_id = n.track_id
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, play_date, track_id) DO UPDATE
+            SET plays = daily_track_plays.plays + EXCLUDED.plays,
+                ms_played = daily_track_plays.ms_played + EXCLUDED.ms_played;
+        """,
+    },
+    {
+        "table": "daily_artist_plays",
+        "source": "listening_history_artists",
+        "statement": """
+            INSERT INTO daily_artist_plays (user_id, play_date, artist_id, plays)
+            SELECT n.user_id, (n.played_at AT TIME ZONE 'UTC')::date, n.artist_id, count(*)
+            FROM {new_rows} n
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, play_date, artist_id) DO UPDATE
+            SET plays = daily_artist_plays.plays + EXCLUDED.plays;
+        """,
+    },
+    # Genres come from the primary artist (the only one with artist details), so each play counts once per genre
+    {
+        "table": "daily_genre_plays",
+        "source": "listening_history_artists",
+        "statement": """
+            INSERT INTO daily_genre_plays (user_id, play_date, genre, plays)
+            SELECT n.user_id, (n.played_at AT TIME ZONE 'UTC')::date, g.genre, count(*)
+            FROM {new_rows} n
+            JOIN artists a ON a.artist_id = n.artist_id
+            CROSS JOIN LATERAL jsonb_array_elements_text(a.genres) AS g(genre)
+            WHERE n.artist_position = 1
+            GROUP BY 1, 2, 3
+            ON CONFLICT (user_id, play_date, genre) DO UPDATE
+            SET plays = daily_genre_plays.plays + EXCLUDED.plays;
+        """,
+    },
+]
+
+
+# History refreshes (DIMENSION_HISTORY=true): each one closes the current version of every row in {new_rows}
+# (the rows a load just inserted or changed in "source") and adds the new version
+HISTORY = [
+    {
+        "table": "artists_history",
+        "source": "artists",
+        "statement": """
+            WITH closed AS (
+                UPDATE artists_history h SET valid_to = now()
+                FROM {new_rows} n
+                WHERE h.artist_id = n.artist_id AND h.valid_to IS NULL
+            )
+            INSERT INTO artists_history (artist_id, artist_name, genres, followers, popularity, row_hash, valid_from)
+            SELECT n.artist_id, n.artist_name, n.genres, n.followers, n.popularity, n.row_hash, now()
+            FROM {new_rows} n;
+        """,
+    },
+    {
+        "table": "tracks_history",
+        "source": "tracks",
+        "statement": """
+            WITH closed AS (
+                UPDATE tracks_history h SET valid_to = now()
+                FROM {new_rows} n
+                WHERE h.track_id = n.track_id AND h.valid_to IS NULL
+            )
+            INSERT INTO tracks_history (track_id, track_name, album_name, popularity, duration_ms, album_release_date,
+                                        explicit, row_hash, valid_from)
+            SELECT n.track_id, n.track_name, n.album_name, n.popularity, n.duration_ms, n.album_release_date,
+                   n.explicit, n.row_hash, now()
+            FROM {new_rows} n;
+        """,
+    },
+]
+
+
+def get_rollups(source):
+    """Returns the rollup refresh statements fed by a table."""
+    return [rollup["statement"] for rollup in ROLLUPS if rollup["source"] == source]
+
+
+def get_history(source):
+    """Returns the history refresh statements fed by a table (none unless DIMENSION_HISTORY is enabled)."""
+    if not DIMENSION_HISTORY:
+        return []
+    return [history["statement"] for history in HISTORY if history["source"] == source]
 
 
 def create_tables():
     """
-    Create tables in the 'spotify_db' database.
+    Create tables and indexes in the 'spotify_db' database.
     """
-    db_user = os.getenv('DB_USER')
-    db_password = os.getenv('DB_PASSWORD')
-    db_host = os.getenv('DB_HOST')
-
-    if not all([db_user, db_password, db_host]):
-        raise ValueError("Environment variables DB_USER, DB_PASSWORD, and DB_HOST must be set.")
-
     try:
         # Now connect to the newly created 'spotify_db'
-        conn = get_db_connection('spotify_db', db_user, db_password, db_host)
-        cursor = conn.cursor()
-
-        # Create Artists Table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS artists (
-                artist_id VARCHAR PRIMARY KEY,
-                artist_name TEXT NOT NULL,
-                genres JSONB,
-                followers INT,
-                popularity INT
-            );
-        """)
-
-        # Create Tracks Table (Fixing the incorrect foreign key reference)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS tracks (
-                track_id VARCHAR PRIMARY KEY,
-                track_name TEXT NOT NULL,
-                album_name TEXT,
-                popularity INT,
-                duration_ms INT,
-                album_release_date TEXT,
-                explicit BOOLEAN
-            );
-        """)
-
-        # Create Listening History Table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS listening_history (
-                played_at TIMESTAMPTZ NOT NULL,
-                track_id VARCHAR NOT NULL,
-                artist_ids TEXT NOT NULL,
-                FOREIGN KEY (track_id) REFERENCES tracks(track_id),
-                UNIQUE (track_id, played_at)
-            );
-        """)
-
-        conn.commit()
-        print("Tables created successfully.")
+        with connection(DB_NAME) as conn:
+            cursor = conn.cursor()
+
+            for statement in TABLE_STATEMENTS + MIGRATION_STATEMENTS + INDEX_STATEMENTS:
+                cursor.execute(statement)
+
+            cursor.execute(BACKFILL_ARTISTS_STATEMENT)
+            if cursor.rowcount:
+                print(f"Backfilled {cursor.rowcount} rows into listening_history_artists.")
+
+            # Build empty rollups from the full history (and empty dimension histories from the current rows)
+            # once; the loader keeps them up to date from then on
+            for rollup in ROLLUPS + (HISTORY if DIMENSION_HISTORY else []):
+                cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {rollup['table']});")
+                if not cursor.fetchone()[0]:
+                    cursor.execute(rollup["statement"].format(new_rows=rollup["source"]))
+                    if cursor.rowcount:
+                        print(f"Backfilled {cursor.rowcount} rows into {rollup['table']}.")
+
+            conn.commit()
+            cursor.close()
+            print("Tables created successfully.")
 
     except Exception as e:
+        # The pooled connection is rolled back before it is returned; re-raised so a failed upgrade fails the task
         print(f"Error creating tables: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+        raise
 
 
 if __name__ == '__main__':
@@ -1,93 +1,393 @@
+import io
 import os
 import json
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import pandas as pd
 import psycopg2
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv(dotenv_path="../../.env")
+from scripts.database.connection import connection, get_db_config, get_pool_stats
+from scripts.auth.user_registry import get_user_ids
+from scripts.database.create_spotify_db import get_history, get_rollups
+from scripts.monitoring import metrics
+from scripts.storage.partitions import DEFAULT_USER_ID, get_user_id, user_path
+from scripts.storage.watermarks import get_watermark, advance_watermark, batch_key, list_batch_files
 
 # Set up processed data directory
 PROCESSED_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/processed"))
+BATCHES_DIR = os.path.join(PROCESSED_DATA_DIR, "_batches")  # One manifest per transformed batch (per user)
+
+# Load mode: "copy" streams each table through COPY FROM STDIN, "row" keeps the per-row INSERT fallback
+LOAD_MODE = os.getenv("LOAD_MODE", "copy")
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", "3"))  # Tables loaded concurrently, each on its own connection
+LOAD_CHUNK_ROWS = int(os.getenv("LOAD_CHUNK_ROWS", "50000"))  # Rows per commit; 0 commits each table at once
+
+# Errors caused by the rows themselves; the chunk is split to isolate them instead of failing the table
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+# Tables with their dependencies (listening_history references tracks, the artist bridge references plays).
+# Dimensions are upserted: rows are hashed, and only rows whose hash differs from the stored one are sent.
+TABLES = [
+    {
+        "table": "artists",
+        "dataset": "artist_dimension",
+        "columns": ["artist_id", "artist_name", "genres", "followers", "popularity"],
+        "int_columns": ["followers", "popularity"],
+        "conflict": ["artist_id"],
+        "upsert": True,
+        "depends_on": [],
+    },
+    {
+        "table": "tracks",
+        "dataset": "track_dimension",
+        "columns": ["track_id", "track_name", "album_name", "popularity", "duration_ms", "album_release_date",
+                    "explicit"],
+        "int_columns": ["popularity", "duration_ms"],
+        "conflict": ["track_id"],
+        "upsert": True,
+        "depends_on": [],
+    },
+    {
+        "table": "listening_history",
+        "dataset": "listening_history_fact",
+        "columns": ["played_at", "track_id", "artist_ids", "user_id"],
+        "int_columns": [],
+        "conflict": ["user_id", "track_id", "played_at"],
+        "depends_on": ["tracks"],
+    },
+    {
+        "table": "listening_history_artists",
+        "dataset": "listening_history_artists",
+        "columns": ["played_at", "track_id", "artist_id", "artist_position", "user_id"],
+        "int_columns": ["artist_position"],
+        "conflict": ["user_id", "played_at", "track_id", "artist_id"],
+        "depends_on": ["listening_history", "artists"],  # The genre rollup reads artists
+    },
+]
+
+
+def get_pending_batches():
+    """
+    Finds every user's manifests of processed batches newer than the user's load watermark, oldest first.
+    Only batches that passed validation (up to the user's validation watermark) are returned.
+    """
+    batches = []
+    for user_id in get_user_ids():
+        validated = get_watermark("validation", user_id=user_id)
+        if validated is None:
+            continue
+        batches += [batch for batch in list_batch_files(user_path(BATCHES_DIR, user_id), "", ".json",
+                                                        after=get_watermark("load", user_id=user_id))
+                    if batch_key(batch) <= validated]
+    return sorted(batches, key=batch_key)
+
+
+def read_processed_table(spec, manifest):
+    """Reads the partition files a batch manifest lists for a table and replaces NaN with None."""
+    files = [os.path.join(PROCESSED_DATA_DIR, f) for f in manifest.get(spec["dataset"], [])]
+    if not files:
+        return pd.DataFrame(columns=spec["columns"])
+    with metrics.timer("file_read", format="parquet", table=spec["table"]):
+        df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+    if "user_id" in spec["columns"] and "user_id" not in df:
+        # Batches transformed before users existed belong to the default user
+        df["user_id"] = DEFAULT_USER_ID
+    return df.where(pd.notna(df), None)
+
+
+def get_load_columns(spec):
+    """Returns the columns a table is loaded with (upserted tables also store each row's hash)."""
+    return spec["columns"] + ["row_hash"] if spec.get("upsert") else spec["columns"]
+
+
+def get_followups(table):
+    """Returns the statements run on the rows a chunk wrote: rollup refreshes, then history refreshes."""
+    return [("db_rollup", statement) for statement in get_rollups(table)] + \
+           [("db_history", statement) for statement in get_history(table)]
+
+
+def to_load_frame(spec, df):
+    """Selects the columns to load, with nullable ints as Int64 (Parquet stores them as floats)."""
+    frame = df[get_load_columns(spec)].copy()
+    for column in spec["int_columns"]:
+        frame[column] = frame[column].astype("Int64")
+    return frame
+
+
+def hash_rows(spec, df):
+    """Returns the MD5 of every row's columns, so a row is only sent again once one of its values changes."""
+    values = to_load_frame({**spec, "upsert": False}, df).astype(str)
+    joined = values.iloc[:, 0].str.cat([values[column] for column in values.columns[1:]], sep="\x1f")
+    return [hashlib.md5(row.encode("utf-8")).hexdigest() for row in joined]
+
+
+def select_changed_rows(conn, spec, df):
+    """
+    Hashes a dimension's rows and drops the ones whose hash matches the stored row, so only new and
+    changed rows are sent. Rows repeated in the batch are loaded once, with their last values.
+    """
+    table = spec["table"]
+    key = spec["conflict"][0]
+    df = df.drop_duplicates(subset=spec["conflict"], keep="last").reset_index(drop=True)
+    df["row_hash"] = hash_rows(spec, df)
+
+    with metrics.timer("db_hash_lookup", table=table), conn.cursor() as cursor:
+        cursor.execute(f"SELECT {key}, row_hash FROM {table} WHERE {key} = ANY(%s);", (df[key].tolist(),))
+        stored = dict(cursor.fetchall())
+    conn.rollback()  # End the read-only transaction before the chunks start theirs
+
+    changed = df["row_hash"].to_numpy() != df[key].map(stored).to_numpy()
+    return df[changed].reset_index(drop=True)
+
+
+def insert_statement(spec, source):
+    """
+    Builds the INSERT for a table from a SELECT or VALUES clause: ON CONFLICT DO NOTHING, or for upserted
+    tables ON CONFLICT DO UPDATE of the rows whose hash changed. For tables that feed rollups or a history,
+    the rows actually written are also captured in the temporary new_<table> table.
+    """
+    table = spec["table"]
+    load_columns = get_load_columns(spec)
+    columns = ", ".join(load_columns)
+    conflict = ", ".join(spec["conflict"])
+
+    if spec.get("upsert"):
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in load_columns
+                            if column not in spec["conflict"])
+        on_conflict = f"DO UPDATE SET {updates} WHERE {table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash"
+    else:
+        on_conflict = "DO NOTHING"
+
+    insert = f"INSERT INTO {table} ({columns}) {source} ON CONFLICT ({conflict}) {on_conflict}"
+    if not get_followups(table):
+        return f"{insert};"
+    return (f"WITH inserted AS ({insert} RETURNING {columns}) "
+            f"INSERT INTO new_{table} ({columns}) SELECT {columns} FROM inserted;")
+
+
+def copy_rows(cursor, spec, df):
+    """
+    Streams a DataFrame into a temporary staging table with COPY FROM STDIN and merges it
+    into the target table with a single INSERT ... SELECT ... ON CONFLICT.
+
+    Returns the number of rows inserted (or updated) in the target table.
+    """
+    table = spec["table"]
+    staging = f"staging_{table}"
+    columns = ", ".join(get_load_columns(spec))
+
+    # COPY needs "12", not "12.0"
+    frame = to_load_frame(spec, df)
+
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False, na_rep="\\N")
+    buffer.seek(0)
+
+    cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;")
+    with metrics.timer("db_copy", table=table):
+        cursor.copy_expert(f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    with metrics.timer("db_merge", table=table):
+        cursor.execute(insert_statement(spec, f"SELECT {columns} FROM {staging}"))
+    return cursor.rowcount
+
 
-def insert_spotify_data():
-    """Inserts Spotify data from Parquet files into a PostgreSQL database."""
-    
-    # Retrieve database credentials
-    db_user = os.getenv('DB_USER')
-    db_password = os.getenv('DB_PASSWORD')
-    db_host = os.getenv('DB_HOST')
-    db_name = os.getenv('DB_NAME')
+def insert_rows(cursor, spec, df):
+    """
+    Inserts a DataFrame one row at a time (fallback for when COPY is unavailable).
+
+    Returns the number of rows inserted (or updated) in the target table.
+    """
+    load_columns = get_load_columns(spec)
+    statement = insert_statement(spec, f"VALUES ({', '.join(['%s'] * len(load_columns))})")
+
+    # The values COPY sends: ints as ints, missing values as NULL and empty strings as empty strings
+    frame = to_load_frame(spec, df).astype(object)
+    frame = frame.where(frame.notna(), None)
+
+    inserted = 0
+    for values in frame.itertuples(index=False, name=None):
+        with metrics.timer("db_insert_row", table=spec["table"]):
+            cursor.execute(statement, values)
+        inserted += cursor.rowcount
+    return inserted
+
+
+def load_chunk(conn, load_rows, spec, df):
+    """
+    Loads and commits one chunk of rows, adding the rows it wrote to the table's rollups and history in
+    the same transaction (so every row is counted exactly once). If the database rejects a row (bad data
+    or a constraint violation), the chunk is rolled back and split in half until the offending rows
+    are isolated, so the rest of the chunk still commits.
+
+    Returns:
+        tuple: (rows inserted, list of (row, error) for every rejected row)
+    """
+    try:
+        table = spec["table"]
+        followups = get_followups(table)
+        with conn.cursor() as cursor:
+            if followups:
+                cursor.execute(f"CREATE TEMP TABLE new_{table} (LIKE {table}) ON COMMIT DROP;")
+            inserted = load_rows(cursor, spec, df)
+            for operation, statement in followups:
+                with metrics.timer(operation, table=table):
+                    cursor.execute(statement.format(new_rows=f"new_{table}"))
+        with metrics.timer("db_commit", table=table):
+            conn.commit()
+        return inserted, []
+    except ROW_ERRORS as e:
+        conn.rollback()
+        if len(df) == 1:
+            return 0, [(df.iloc[0].to_dict(), e)]
+        middle = len(df) // 2
+        inserted_first, rejected_first = load_chunk(conn, load_rows, spec, df.iloc[:middle])
+        inserted_second, rejected_second = load_chunk(conn, load_rows, spec, df.iloc[middle:])
+        return inserted_first + inserted_second, rejected_first + rejected_second
+
+
+def load_table(spec, manifest, load_rows, mode, chunk_rows):
+    """
+    Loads one table of a batch on its own pooled connection, committing every chunk_rows rows.
+    Upserted tables only send the rows that are new or changed.
+
+    Returns:
+        tuple: (rows inserted or updated, list of rejected rows)
+    """
+    table = spec["table"]
+    df = read_processed_table(spec, manifest)
+    read = len(df)
+
+    inserted, rejected = 0, []
+    start = time.perf_counter()
+    with connection() as conn:
+        if spec.get("upsert") and read:
+            df = select_changed_rows(conn, spec, df)
+        step = chunk_rows or max(len(df), 1)
+        for offset in range(0, len(df), step):
+            chunk_inserted, chunk_rejected = load_chunk(conn, load_rows, spec, df.iloc[offset:offset + step])
+            inserted += chunk_inserted
+            rejected += chunk_rejected
+    elapsed = time.perf_counter() - start
+    metrics.count("rows", read, table=table, direction="in")
+    metrics.count("rows", read - len(df), table=table, direction="unchanged")
+    metrics.count("rows", inserted, table=table, direction="out")
+    metrics.count("rows", len(rejected), table=table, direction="rejected")
+
+    rows_per_second = read / elapsed if elapsed > 0 else float("inf")
+    print(f"{table}: {read} rows read, {len(df)} sent, {inserted} written, {len(rejected)} rejected in "
+          f"{elapsed:.2f}s ({rows_per_second:,.0f} rows/s, mode={mode})")
+    for row, error in rejected:
+        print(f"⚠️ Rejected {table} row {row}: {str(error).strip()}")
+    return inserted, rejected
+
+
+def load_batch(manifest, load_rows, mode, workers, chunk_rows):
+    """
+    Loads the tables of one batch concurrently. A table starts as soon as every table it depends
+    on has committed, and is skipped if one of them failed.
+
+    Returns:
+        bool: True if every table loaded (rejected rows aside).
+    """
+    pending = list(TABLES)
+    running = {}
+    done, failed = set(), set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for spec in list(pending):
+                if any(dependency in failed for dependency in spec["depends_on"]):
+                    print(f"❌ Skipping '{spec['table']}': a table it depends on failed to load.")
+                    failed.add(spec["table"])
+                    pending.remove(spec)
+                elif all(dependency in done for dependency in spec["depends_on"]):
+                    future = executor.submit(load_table, spec, manifest, load_rows, mode, chunk_rows)
+                    running[future] = spec
+                    pending.remove(spec)
+
+            if not running:
+                # Remaining tables depend on tables that are not in TABLES
+                for spec in pending:
+                    print(f"❌ Skipping '{spec['table']}': unknown dependency {spec['depends_on']}.")
+                    failed.add(spec["table"])
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)["table"]
+                try:
+                    future.result()
+                    done.add(table)
+                except psycopg2.Error as db_err:
+                    print(f"❌ Database Error while loading '{table}': {db_err}")
+                    failed.add(table)
+                except Exception as e:
+                    print(f"❌ Unexpected Error while loading '{table}': {e}")
+                    failed.add(table)
+
+    return not failed
+
+
+@metrics.stage("load")
+def insert_spotify_data(mode=None, workers=None, chunk_rows=None, batches=None):
+    """
+    Inserts every validated processed batch newer than the load watermark into a PostgreSQL database.
+    Independent tables load concurrently on separate connections and commit in chunks; rows the
+    database rejects are skipped and reported. A user's watermark advances once every table of their
+    batch has loaded. If a table fails, that user's remaining batches wait and the batch is retried on
+    the next run (already committed chunks are skipped by ON CONFLICT and the row hashes); other users go on.
+
+    Args:
+        mode (str): "copy" for the bulk COPY loader or "row" for per-row inserts. Defaults to LOAD_MODE.
+        workers (int): Tables loaded concurrently. Defaults to LOAD_WORKERS.
+        chunk_rows (int): Rows per commit, 0 for one commit per table. Defaults to LOAD_CHUNK_ROWS.
+        batches (list): Load these batch manifests instead (e.g. the batch of an Airflow run).
+
+    Returns:
+        list: The batch manifests loaded.
+    """
+    mode = mode or LOAD_MODE
+    if mode not in ("copy", "row"):
+        raise ValueError(f"Unknown load mode '{mode}'. Expected 'copy' or 'row'.")
+    load_rows = copy_rows if mode == "copy" else insert_rows
+    workers = workers or LOAD_WORKERS
+    chunk_rows = LOAD_CHUNK_ROWS if chunk_rows is None else chunk_rows
 
     # Ensure all credentials are available
-    if not all([db_user, db_password, db_host, db_name]):
+    try:
+        get_db_config()
+    except ValueError:
         raise SystemExit("Error: Missing database environment variables.")
 
-    try:
-        # Establish database connection
-        conn = psycopg2.connect(
-            dbname=db_name,
-            user=db_user,
-            password=db_password,
-            host=db_host
-        )
-        cursor = conn.cursor()
-
-        # ✅ Insert data from artist_dimension.parquet
-        artist_df = pd.read_parquet(os.path.join(PROCESSED_DATA_DIR, "artist_dimension.parquet"))
-        artist_df = artist_df.where(pd.notna(artist_df), None)  # Replace NaN with None
-
-        for _, row in artist_df.iterrows():
-            genres_str = row["genres"] if row["genres"] else None  # Use the comma-separated string directly
-            cursor.execute("""
-                INSERT INTO artists (artist_id, artist_name, genres, followers, popularity)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (artist_id) DO NOTHING;
-            """, (row["artist_id"], row["artist_name"], genres_str, row["followers"], row["popularity"]))
-
-        # ✅ Insert data from track_dimension.parquet
-        track_df = pd.read_parquet(os.path.join(PROCESSED_DATA_DIR, "track_dimension.parquet"))
-        track_df = track_df.where(pd.notna(track_df), None)
-
-        for _, row in track_df.iterrows():
-            cursor.execute("""
-                INSERT INTO tracks (track_id, track_name, album_name, popularity, duration_ms, album_release_date, explicit)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (track_id) DO NOTHING;
-            """, (
-                row["track_id"], row["track_name"], row["album_name"], row["popularity"],
-                row["duration_ms"], row["album_release_date"], row["explicit"]
-            ))
-
-        # ✅ Insert data from listening_history_fact.parquet
-        listening_history_df = pd.read_parquet(os.path.join(PROCESSED_DATA_DIR, "listening_history_fact.parquet"))
-        listening_history_df = listening_history_df.where(pd.notna(listening_history_df), None)
-
-        for _, row in listening_history_df.iterrows():
-            artist_ids_str = row["artist_ids"] if row["artist_ids"] else None  # Use the comma-separated string directly
-            cursor.execute("""
-                INSERT INTO listening_history (played_at, track_id, artist_ids)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (played_at, track_id) DO NOTHING;
-            """, (row["played_at"], row["track_id"], artist_ids_str))
-
-        # Commit changes
-        conn.commit()
-        print("✅ Data inserted successfully.")
-
-    except psycopg2.Error as db_err:
-        print(f"❌ Database Error: {db_err}, {row}")
-        if conn:
-            conn.rollback()
-    except Exception as e:
-        print(f"❌ Unexpected Error: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
+    if batches is None:
+        batches = get_pending_batches()
+    if not batches:
+        print("No new processed batches to load.")
+        return []
+
+    loaded, blocked_users = [], set()
+    for batch in batches:
+        user_id = get_user_id(batch)
+        if user_id in blocked_users:
+            continue
+        with open(batch, "r") as f:
+            manifest = json.load(f)
+
+        if not load_batch(manifest, load_rows, mode, workers, chunk_rows):
+            print(f"❌ Batch {os.path.basename(batch)} of {user_id} failed; stopping for {user_id} until the next run.")
+            blocked_users.add(user_id)
+            continue
+
+        # Every table has committed, so move the user's watermark past this batch
+        advance_watermark("load", batch_key(batch), user_id)
+        loaded.append(batch)
+        print(f"✅ Batch {os.path.basename(batch)} inserted successfully.")
+
+    for dbname, stats in get_pool_stats().items():
+        print(f"Connection pool '{dbname}': {stats['checkouts']} checkouts, "
+              f"{stats['wait_seconds']:.2f}s waiting (max {stats['max_wait_seconds']:.2f}s)")
+    return loaded
+
 
 if __name__ == "__main__":
     insert_spotify_data()
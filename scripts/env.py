@@ -0,0 +1,18 @@
+import os
+
+# The project's .env file (Spotify and database credentials, settings), at the project root
+ENV_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.env"))
+
+_loaded = False
+
+
+def load_env():
+    """
+    Loads ENV_FILE into the environment once per process; variables that are already set win. Entry points
+    call it before importing a stage, since modules read their settings from the environment on import.
+    """
+    global _loaded
+    if not _loaded:
+        from dotenv import load_dotenv
+        load_dotenv(ENV_FILE)
+        _loaded = True
@@ -0,0 +1,92 @@
+import os
+import json
+import shutil
+import threading
+from scripts.storage.partitions import atomic_write
+from scripts.storage.raw_sink import strip_raw_extension
+
+PARTIAL_DIR = "_partial"  # Next to the history file; batch listings only look at files, so it is never picked up
+
+
+class BatchCheckpoint:
+    """
+    The results of an enrichment's ID batches (e.g. the track features of one history file), persisted as
+    each batch completes, so a retried run only fetches the IDs no finished batch covered.
+
+    Layout:
+        <directory>/batch_<n>.jsonl  The records of batch n, one per line, written atomically.
+        <directory>/manifest.jsonl   One line per finished batch, {"batch": n, "ids": [...]}, appended once
+                                     its file is on disk. A partly written last line is dropped (that
+                                     batch is fetched again).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, "manifest.jsonl")
+        self.lock = threading.Lock()
+        self.batches = len(self.read_manifest(truncate=True))
+
+    def read_manifest(self, truncate=False):
+        """Returns the manifest entries of every finished batch, optionally cutting a torn last line off the file."""
+        if not os.path.exists(self.manifest_file):
+            return []
+        entries, valid_bytes = [], 0
+        with open(self.manifest_file, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    entry = None
+                if entry is None:
+                    break  # Cut off by a crash while appending
+                entries.append(entry)
+                valid_bytes += len(line)
+        if truncate:
+            with open(self.manifest_file, "r+b") as f:
+                f.truncate(valid_bytes)
+        return entries
+
+    def get_batch_file(self, index):
+        return os.path.join(self.directory, f"batch_{index:05d}.jsonl")
+
+    def done_ids(self):
+        """Returns the IDs every finished batch covered."""
+        return {entity_id for entry in self.read_manifest() for entity_id in entry["ids"]}
+
+    def iter_records(self):
+        """Yields the records of every finished batch, so partial results can be read while a run is going."""
+        for entry in self.read_manifest():
+            with open(self.get_batch_file(entry["batch"]), "r") as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def save(self, ids, records):
+        """Persists the records fetched for one batch of IDs. Safe to call from concurrent fetch workers."""
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            index = self.batches
+
+            def write(tmp_path):
+                with open(tmp_path, "w") as f:
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+            atomic_write(self.get_batch_file(index), write)
+
+            with open(self.manifest_file, "a") as f:
+                f.write(json.dumps({"batch": index, "ids": list(ids)}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.batches += 1
+
+    def clear(self):
+        """Removes the checkpoint once the complete result is saved."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.batches = 0
+
+
+def get_checkpoint(history_file, dataset):
+    """
+    Returns the checkpoint of an enrichment of a history file, e.g. get_checkpoint(f, "track_features"),
+    in <history file dir>/_partial/<dataset>_<from>_to_<to>/.
+    """
+    name = os.path.basename(strip_raw_extension(history_file)).replace("listening_history", dataset)
+    return BatchCheckpoint(os.path.join(os.path.dirname(history_file), PARTIAL_DIR, name))
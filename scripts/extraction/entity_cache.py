@@ -0,0 +1,155 @@
+import os
+import json
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+CACHE_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/metadata/entity_cache.sqlite"))
+CACHE_ENABLED = os.getenv("ENTITY_CACHE_ENABLED", "true").lower() == "true"
+
+# Volatile fields (popularity, followers) expire sooner than static ones (names, genres, album data)
+VOLATILE_TTL = float(os.getenv("ENTITY_CACHE_VOLATILE_TTL_HOURS", "24")) * 3600
+STATIC_TTL = float(os.getenv("ENTITY_CACHE_STATIC_TTL_DAYS", "30")) * 86400
+
+# TTL in seconds per top-level response field; "default" covers every field not listed
+FIELD_TTLS = {
+    "artist": {"popularity": VOLATILE_TTL, "followers": VOLATILE_TTL, "default": STATIC_TTL},
+    "track": {"popularity": VOLATILE_TTL, "default": STATIC_TTL},
+}
+
+
+class EntityCache:
+    """
+    SQLite-backed cache of Spotify artist and track responses.
+
+    Every top-level field of a response carries its own fetch time, so an entry is stale as soon
+    as any of its fields is older than that field's TTL.
+    """
+
+    def __init__(self, path=None, ttls=None):
+        self.path = path or CACHE_FILE
+        self.ttls = ttls or FIELD_TTLS
+        self.stats = {}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entities (
+                    entity_type TEXT NOT NULL,
+                    entity_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL,
+                    PRIMARY KEY (entity_type, entity_id)
+                );
+            """)
+
+    @contextmanager
+    def _connect(self):
+        """Runs one transaction (committed, or rolled back if it raises), then closes the connection."""
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            with conn:
+                yield conn
+
+    def _counters(self, entity_type):
+        return self.stats.setdefault(entity_type, {"hits": 0, "misses": 0, "stale": 0})
+
+    def is_fresh(self, entity_type, fetched_at, now=None):
+        """Checks each field's fetch time against its TTL."""
+        now = now or time.time()
+        ttls = self.ttls.get(entity_type, {})
+        default_ttl = ttls.get("default", STATIC_TTL)
+        return all(now - fetched < ttls.get(field, default_ttl) for field, fetched in fetched_at.items())
+
+    def get_many(self, entity_type, ids):
+        """
+        Looks up entities by ID.
+
+        Returns:
+            tuple: (list of fresh cached payloads, list of IDs that are missing or stale)
+        """
+        rows = {}
+        with self._connect() as conn:
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                placeholders = ", ".join(["?"] * len(chunk))
+                rows.update({
+                    entity_id: (payload, fetched_at)
+                    for entity_id, payload, fetched_at in conn.execute(
+                        f"SELECT entity_id, payload, fetched_at FROM entities "
+                        f"WHERE entity_type = ? AND entity_id IN ({placeholders})",
+                        [entity_type, *chunk],
+                    )
+                })
+
+        counters = self._counters(entity_type)
+        now = time.time()
+        cached, missing = [], []
+        for entity_id in ids:
+            if entity_id not in rows:
+                counters["misses"] += 1
+                missing.append(entity_id)
+                continue
+            payload, fetched_at = rows[entity_id]
+            if self.is_fresh(entity_type, json.loads(fetched_at), now):
+                counters["hits"] += 1
+                cached.append(json.loads(payload))
+            else:
+                counters["stale"] += 1
+                missing.append(entity_id)
+        return cached, missing
+
+    def put_many(self, entity_type, entities, fields=None):
+        """
+        Stores API responses. Fields already cached but absent from the new payload keep their
+        previous value and fetch time.
+
+        Args:
+            fields (list): Restricts the update to these top-level fields. Defaults to all fields.
+        """
+        entities = [entity for entity in entities if entity and entity.get("id")]
+        if not entities:
+            return
+
+        now = time.time()
+        with self._connect() as conn:
+            for entity in entities:
+                row = conn.execute(
+                    "SELECT payload, fetched_at FROM entities WHERE entity_type = ? AND entity_id = ?",
+                    (entity_type, entity["id"]),
+                ).fetchone()
+                payload, fetched_at = (json.loads(row[0]), json.loads(row[1])) if row else ({}, {})
+                for field in fields or entity.keys():
+                    if field in entity:
+                        payload[field] = entity[field]
+                        fetched_at[field] = now
+                conn.execute(
+                    "INSERT OR REPLACE INTO entities (entity_type, entity_id, payload, fetched_at) VALUES (?, ?, ?, ?)",
+                    (entity_type, entity["id"], json.dumps(payload), json.dumps(fetched_at)),
+                )
+
+    def log_stats(self, entity_type, batch_size=50):
+        """Prints hit/miss counters and an estimate of the API calls the cache saved."""
+        counters = self._counters(entity_type)
+        lookups = sum(counters.values())
+        hit_rate = counters["hits"] / lookups * 100 if lookups else 0.0
+        calls_without_cache = -(-lookups // batch_size)
+        calls_with_cache = -(-(counters["misses"] + counters["stale"]) // batch_size)
+        print(f"{entity_type} cache: {counters['hits']} hits, {counters['misses']} misses, "
+              f"{counters['stale']} stale ({hit_rate:.1f}% hit rate, "
+              f"{calls_without_cache - calls_with_cache} API calls saved)")
+
+
+def fetch_with_cache(entity_type, ids, fetch, cache=None):
+    """
+    Returns payloads for the given IDs, calling fetch(ids) only for IDs that are missing
+    from the cache or stale.
+    """
+    if not CACHE_ENABLED and cache is None:
+        return fetch(ids)
+
+    cache = cache or EntityCache()
+    cached, missing = cache.get_many(entity_type, ids)
+    fetched = fetch(missing) if missing else []
+    cache.put_many(entity_type, fetched)
+    cache.log_stats(entity_type)
+    return cached + fetched
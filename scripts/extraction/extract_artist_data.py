@@ -1,65 +1,93 @@
 import os
-import json
-import time
 from scripts.auth.connect_spotify_api import connect_to_spotify_api
-from scripts.extraction.extract_track_features import get_latest_listening_history_file
+from scripts.extraction.checkpoints import get_checkpoint
+from scripts.extraction.extract_track_features import get_pending_listening_history_files
+from scripts.extraction.fetch_scheduler import get_scheduler, make_batches
+from scripts.extraction.entity_cache import fetch_with_cache
+from scripts.monitoring import metrics
+from scripts.storage.watermarks import advance_watermark, batch_key
+from scripts.storage.partitions import DEFAULT_USER_ID, get_user_id
+from scripts.storage.raw_sink import get_raw_format, read_raw_records, strip_raw_extension, write_raw
 
 RAW_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/raw/spotify_api"))
 
 
 def extract_raw_listening_history(file_path):
-    """Extracts raw listening history data from the JSON file."""
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    return data
+    """Extracts raw listening history data from the raw file (any raw format)."""
+    return read_raw_records(file_path)
 
 
-def fetch_artist_details(artist_ids):
-    """Fetches artist details using the Spotify API in batches of 50."""
-    scope = "user-read-recently-played"
-    sp = connect_to_spotify_api(scope=scope)
+def fetch_artist_details(artist_ids, sp=None, checkpoint=None, user_id=DEFAULT_USER_ID):
+    """
+    Fetches artist details using the Spotify API in concurrent batches of 50, with the token of the user
+    whose history is enriched. With a checkpoint, every batch is saved to it as soon as it is fetched.
+    """
+    if sp is None:
+        scope = "user-read-recently-played"
+        sp = connect_to_spotify_api(scope=scope, user_id=user_id)
 
-    artist_data = []
     batch_size = 50  # Spotify API allows up to 50 artists per request
+    batches = make_batches(artist_ids, batch_size)
 
-    for i in range(0, len(artist_ids), batch_size):
-        batch = artist_ids[i:i + batch_size]
-        try:
-            response = sp.artists(batch)
-            for artist in response["artists"]:
-                artist_data.append(artist)
-        except Exception as e:
-            print(f"Error fetching batch starting at index {i}: {e}")
+    def fetch_batch(batch):
+        artists = sp.artists(batch)["artists"]
+        if checkpoint is not None:
+            checkpoint.save(batch, artists)
+        return artists
 
-        time.sleep(1)  # Avoid rate-limiting
+    # The shared scheduler handles concurrency, rate limiting and retries
+    responses = get_scheduler().map(fetch_batch, batches, endpoint="artists")
 
-    return artist_data
+    return [artist for response in responses for artist in response]
 
 
 def save_artist_details_as_json(artist_data, history_file):
-    """Saves artist details to a JSON file."""
-    os.makedirs(RAW_DATA_DIR, exist_ok=True)
-    file_name = os.path.basename(history_file).replace("listening_history", "artist_details")
-    output_file = os.path.join(RAW_DATA_DIR, file_name)
-
-    with open(output_file, 'w') as f:
-        json.dump(artist_data, f, indent=4)
+    """Saves artist details next to the history file, in the same raw format."""
+    file_name = os.path.basename(strip_raw_extension(history_file)).replace("listening_history", "artist_details")
+    output_file = write_raw(artist_data, os.path.join(os.path.dirname(history_file), file_name),
+                            "artist_details", raw_format=get_raw_format(history_file))
     print(f"Artist details saved to {output_file}")
 
 
-def extract_artist_features():
-    """Main function to extract and save artist details."""
-    history_file = get_latest_listening_history_file()
-    listening_history = extract_raw_listening_history(history_file)
-
-    # Extract unique Artist IDs from the raw listening history
-    artist_ids = list({track["track"]["artists"][0]["id"] for track in listening_history if "track" in track})
-
-    # Fetch artist details using the extracted Artist IDs
-    artist_data = fetch_artist_details(artist_ids)
-
-    # Save the artist details to a JSON file
-    save_artist_details_as_json(artist_data, history_file)
+@metrics.stage("artist_details")
+def extract_artist_features(history_files=None):
+    """
+    Main function to extract and save artist details for every history file not enriched yet.
+
+    Args:
+        history_files (list): Enrich these history files instead (e.g. the batch of an Airflow run).
+    """
+    if history_files is None:
+        history_files = get_pending_listening_history_files("artist_details")
+    if not history_files:
+        print("No new listening history files to extract artist details for.")
+        return
+
+    for history_file in history_files:
+        listening_history = extract_raw_listening_history(history_file)
+        user_id = get_user_id(history_file)
+
+        # Extract unique Artist IDs from the raw listening history
+        artist_ids = list({track["track"]["artists"][0]["id"] for track in listening_history if "track" in track})
+
+        # Batches a failed attempt already fetched are read back instead of being fetched again
+        checkpoint = get_checkpoint(history_file, "artist_details")
+        done = checkpoint.done_ids()
+        resumed = list(checkpoint.iter_records())
+        if done:
+            print(f"Resuming artist details of {os.path.basename(history_file)}: {len(done)} artists already fetched")
+
+        # Fetch artist details for Artist IDs that are not cached (or are stale)
+        def fetch(ids):
+            return fetch_artist_details(ids, checkpoint=checkpoint, user_id=user_id)
+        artist_data = resumed + fetch_with_cache("artist", [i for i in artist_ids if i not in done], fetch)
+
+        # Save the artist details to a JSON file, then move the watermark past this history file
+        save_artist_details_as_json(artist_data, history_file)
+        checkpoint.clear()
+        metrics.count("rows", len(listening_history), table="listening_history", direction="in")
+        metrics.count("rows", len(artist_data), table="artist_details", direction="out")
+        advance_watermark("artist_details", batch_key(history_file), user_id)
 
 
 if __name__ == "__main__":
@@ -1,83 +1,223 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from scripts.auth.connect_spotify_api import connect_to_spotify_api
+from scripts.auth.user_registry import get_user_ids
+from scripts.extraction.extract_track_features import (TRACK_FEATURES_SOURCE, derive_track_features,
+                                                       save_track_features_as_json)
+from scripts.extraction.fetch_scheduler import get_scheduler
+from scripts.monitoring import metrics
+from scripts.storage.watermarks import get_watermark, set_watermark
+from scripts.storage.partitions import DEFAULT_USER_ID, RAW_PARTITION, partition_path, user_path
+from scripts.storage.raw_sink import RAW_EXTENSIONS, RAW_FORMAT, iter_raw_records, write_raw
 
-LAST_EXTRACTION_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/metadata/last_extraction.txt"))
 RAW_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/raw/spotify_api"))
 
-def get_last_extraction_timestamp():
+# Users extracted concurrently by extract_all_users (they all share the fetch scheduler's rate limit)
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "8"))
+
+# An extraction in progress flushes each page to <user's raw dir>/_partial/, which batch listings skip
+PARTIAL_DIR = "_partial"
+
+def get_last_extraction_timestamp(user_id=DEFAULT_USER_ID):
     """
-    Reads the last extraction timestamp from a file.
-    If the file doesn't exist, return the start of 2025.
+    Reads a user's extraction watermark (max played_at already extracted, in milliseconds).
+    If the stage has never run, return the start of 2025.
     """
-    if os.path.exists(LAST_EXTRACTION_FILE):
-        with open(LAST_EXTRACTION_FILE, "r") as f:
-            return int(f.read().strip())  # Convert string timestamp to integer (milliseconds)
+    watermark = get_watermark("extraction", user_id=user_id)
+    if watermark is not None:
+        return int(watermark)  # Convert string timestamp to integer (milliseconds)
     return int(datetime(2025, 1, 1).timestamp() * 1000)  # Default: Start of 2025
 
-def save_last_extraction_timestamp(timestamp):
-    """Saves the last extraction timestamp to a file."""
-    os.makedirs(os.path.dirname(LAST_EXTRACTION_FILE), exist_ok=True)
-    with open(LAST_EXTRACTION_FILE, "w") as f:
-        f.write(str(timestamp))
+def save_last_extraction_timestamp(timestamp, user_id=DEFAULT_USER_ID):
+    """Saves a user's extraction watermark (milliseconds)."""
+    set_watermark("extraction", timestamp, user_id)
 
-def extract_listening_history():
+def get_played_at_timestamps(items):
+    """
+    Returns the played_at of recently-played items in milliseconds, parsed in one vectorized call
+    (with or without fractional seconds).
+    """
+    import pandas as pd
+
+    played_at = pd.to_datetime([item["played_at"] for item in items], utc=True, format="ISO8601")
+    return played_at.asi8 // 1_000_000
+
+def get_partial_file(user_id, from_timestamp, end_timestamp):
+    """Returns the JSON Lines file an extraction flushes its pages to until it completes."""
+    name = f"listening_history_{from_timestamp}_to_{end_timestamp or 'now'}.jsonl"
+    return os.path.join(user_path(RAW_DATA_DIR, user_id), PARTIAL_DIR, name)
+
+def recover_partial_file(path):
+    """
+    Reads back what an interrupted extraction flushed, truncating a last line that was only partly written.
+    Plays are written oldest first, so the last one on disk is the most recent.
+
+    Returns:
+        tuple: (plays on disk, played_at of the most recent one in milliseconds, or None)
+    """
+    if not os.path.exists(path):
+        return 0, None
+
+    plays, last_record, valid_bytes = 0, None, 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line) if line.endswith(b"\n") else None
+            except ValueError:
+                record = None
+            if record is None:
+                break
+            plays, last_record, valid_bytes = plays + 1, record, valid_bytes + len(line)
+    with open(path, "r+b") as f:
+        f.truncate(valid_bytes)
+    return plays, int(get_played_at_timestamps([last_record])[0]) if last_record else None
+
+def publish_partial_file(partial_file, base_path):
+    """Moves a completed extraction into the raw sink (in RAW_FORMAT) and returns the raw file."""
+    if RAW_FORMAT == "jsonl":
+        output_file = base_path + RAW_EXTENSIONS["jsonl"]
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        os.replace(partial_file, output_file)
+        metrics.record_bytes_written(output_file, format="jsonl")
+        return output_file
+
+    # Converted one record at a time, so memory does not grow with the number of plays
+    output_file = write_raw(iter_raw_records(partial_file), base_path, "listening_history")
+    os.remove(partial_file)
+    return output_file
+
+@metrics.stage("extraction")
+def extract_listening_history(start=None, end=None, user_id=DEFAULT_USER_ID):
     """
     Extract all tracks played since the last extraction timestamp and save raw data.
+
+    Pages are requested with the cursor of the previous one until the API reports no next page, and each
+    page is flushed to disk as it arrives. If the extraction is interrupted, re-running the same interval
+    resumes after the last play on disk, so at most one page is fetched again.
+
+    Args:
+        start (datetime): Optional start of a data interval (e.g. an Airflow run's). When given, only
+            plays in [start, end) are extracted and the file is named after the interval, so re-running
+            an interval rewrites the same batch instead of adding a new one.
+        end (datetime): End of the data interval (exclusive). Defaults to now.
+        user_id (str): The user to extract, with their own token and watermark.
+
+    Returns:
+        str: The raw file written, or None if no tracks were fetched.
     """
-    last_extraction_timestamp = get_last_extraction_timestamp()
-    print(f"Last extraction timestamp: {last_extraction_timestamp}")
+    last_extraction_timestamp = get_last_extraction_timestamp(user_id)
+    print(f"Last extraction timestamp for {user_id}: {last_extraction_timestamp}")
+
+    # The API's "after" cursor is exclusive
+    from_timestamp = int(start.timestamp() * 1000) - 1 if start is not None else last_extraction_timestamp
+    end_timestamp = int(end.timestamp() * 1000) if end is not None else None
+
+    # Like pandas in get_played_at_timestamps, only imported once an extraction runs, so importing this
+    # module (e.g. for extract_all_users) stays within its import budget
+    import numpy as np
 
     scope = "user-read-recently-played"
-    sp = connect_to_spotify_api(scope=scope)
+    sp = connect_to_spotify_api(scope=scope, user_id=user_id)
 
-    raw_data = []
     limit = 50
-    latest_timestamp = last_extraction_timestamp  # Set it to last_extraction_timestamp initially
+    partial_file = get_partial_file(user_id, from_timestamp, end_timestamp)
+    plays, resumed_timestamp = recover_partial_file(partial_file)
+    if plays:
+        print(f"Resuming the extraction of {user_id} after {plays} tracks already on disk")
+    latest_timestamp = max(from_timestamp, resumed_timestamp or from_timestamp)  # Most recent play on disk
+    cursor = latest_timestamp
+
+    os.makedirs(os.path.dirname(partial_file), exist_ok=True)
+    with open(partial_file, "a") as partial:
+        while True:
+            # Convert milliseconds to datetime
+            cursor_dt = datetime.fromtimestamp(cursor / 1000, tz=timezone.utc)
+            print(f"Fetching data after timestamp: {cursor_dt.strftime('%Y-%m-%d %H:%M:%S')}")
+
+            # Fetch tracks from Spotify API, within the shared rate limit and retry policy
+            response = get_scheduler().run_batch(lambda after: sp.current_user_recently_played(limit=limit, after=after),
+                                                 f"{user_id} recently played", cursor, "recently_played")
+            items = response["items"]
+            played_at = get_played_at_timestamps(items)
+            in_interval = played_at < end_timestamp if end_timestamp is not None else np.ones(len(items), dtype=bool)
+            page = [items[i] for i in np.argsort(played_at, kind="stable") if in_interval[i]]
+
+            if page:
+                # Oldest first, so a page cut short by a crash only loses its most recent plays
+                partial.write("".join(json.dumps(item, separators=(",", ":")) + "\n" for item in page))
+                partial.flush()
+                os.fsync(partial.fileno())
+                plays += len(page)
+                latest_timestamp = max(latest_timestamp, int(played_at[in_interval].max()))
+                print(f"Fetched {len(page)} tracks for {user_id}")
+            else:
+                print(f"No new tracks since {cursor_dt.strftime('%Y-%m-%d %H:%M:%S')}")
+
+            # Stop once the API has no next page, or the rest of the page was played after the interval
+            if not page or len(page) < len(items) or not response.get("next"):
+                break
+            cursor = int(response["cursors"]["after"]) if response.get("cursors") else latest_timestamp
+
+    metrics.count("rows", plays, table="listening_history", direction="out")
+    if plays:
+        # Name to and from date of extraction
+        from_dt = start or datetime.fromtimestamp(last_extraction_timestamp / 1000, tz=timezone.utc)
+        to_dt = end or datetime.now(timezone.utc)
+        from_date = from_dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H-%M-%S')
+        to_date = to_dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H-%M-%S')
 
-    while True:
-        # Convert milliseconds to datetime
-        timestamp_dt = datetime.fromtimestamp(latest_timestamp / 1000, tz=timezone.utc)
-        print(f"Fetching data after timestamp: {timestamp_dt.strftime('%Y-%m-%d %H:%M:%S')}")
+        # Save raw data (in RAW_FORMAT) in the partition of the extraction date
+        partition_dir = partition_path(user_path(RAW_DATA_DIR, user_id), RAW_PARTITION, to_date[:10])
+        output_file = publish_partial_file(partial_file,
+                                           os.path.join(partition_dir, f"listening_history_{from_date}_to_{to_date}"))
 
-        # Fetch tracks from Spotify API
-        response = sp.current_user_recently_played(limit=limit, after=latest_timestamp)
+        print(f"Data saved to {output_file}")
 
-        if not response["items"]:
-            print(f"No new tracks since {timestamp_dt.strftime('%Y-%m-%d %H:%M:%S')}")
-            break  # Stop if no new tracks are returned
+        # The payload already holds the full track objects, so write the track features without an API pass
+        if TRACK_FEATURES_SOURCE == "history":
+            save_track_features_as_json(derive_track_features(iter_raw_records(output_file)), output_file)
 
-        for item in response["items"]:
-            # Append the entire raw item data
-            raw_data.append(item)
+        # Resume the next run after the most recent play, only once the raw file is on disk
+        save_last_extraction_timestamp(max(latest_timestamp, get_last_extraction_timestamp(user_id)), user_id)
+        return output_file
 
-            # Update latest timestamp (most recent song played)
-            played_at_timestamp = int(
-                datetime.strptime(item["played_at"], "%Y-%m-%dT%H:%M:%S.%fZ")
-                .replace(tzinfo=timezone.utc)
-                .timestamp() * 1000  # Convert to milliseconds
-            )
-            latest_timestamp = max(latest_timestamp, played_at_timestamp)
+    os.remove(partial_file)
+    print(f"No tracks were fetched for {user_id}.")
+    return None
 
-        # No pagination condition: Keep going even if fewer than 50 items are returned
-        print(f"Fetched {len(response['items'])} tracks")
 
-    if raw_data:
-        # Save raw data to JSON
-        os.makedirs(RAW_DATA_DIR, exist_ok=True)
+@metrics.stage("extraction")
+def extract_all_users(start=None, end=None, workers=None):
+    """
+    Extracts the listening history of every registered user concurrently. Each user has their own token
+    and watermark, and every request goes through the shared fetch scheduler, so throughput grows with
+    workers until the API quota is reached. One user's failure does not stop the others.
 
-        # Name to and from date of extraction
-        from_date = datetime.fromtimestamp(last_extraction_timestamp / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H-%M-%S')
-        to_date = datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
-        output_file = os.path.join(RAW_DATA_DIR, f"listening_history_{from_date}_to_{to_date}.json")
-        # Save raw data as JSON
-        with open(output_file, 'w') as f:
-            json.dump(raw_data, f, indent=4)
+    Args:
+        start, end (datetime): Optional data interval, as in extract_listening_history.
+        workers (int): Users extracted at once. Defaults to EXTRACTION_WORKERS.
 
-        print(f"Data saved to {output_file}")
+    Returns:
+        dict: The raw file written per user (None if the user played nothing).
 
-        # Save the latest timestamp to track progress
-        # save_last_extraction_timestamp(to_date)
-    else:
-        print("No tracks were fetched.")
+    Raises:
+        RuntimeError: If any user failed, once every other user has finished.
+    """
+    user_ids = get_user_ids()
+    with ThreadPoolExecutor(max_workers=max(min(workers or EXTRACTION_WORKERS, len(user_ids)), 1)) as pool:
+        futures = {user_id: pool.submit(extract_listening_history, start, end, user_id) for user_id in user_ids}
+
+    files, failed = {}, []
+    for user_id, future in futures.items():
+        try:
+            files[user_id] = future.result()
+        except Exception as e:
+            print(f"❌ Extraction failed for {user_id}: {e}")
+            failed.append(user_id)
+
+    print(f"Extracted {sum(f is not None for f in files.values())} batch(es) for {len(user_ids)} user(s)")
+    if failed:
+        raise RuntimeError(f"Extraction failed for {len(failed)} user(s): {failed}")
+    return files
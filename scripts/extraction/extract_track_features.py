@@ -1,67 +1,144 @@
 import os
-import json
-from datetime import datetime
 from scripts.auth.connect_spotify_api import connect_to_spotify_api
+from scripts.extraction.checkpoints import get_checkpoint
+from scripts.extraction.fetch_scheduler import get_scheduler, make_batches
+from scripts.monitoring import metrics
+from scripts.extraction.entity_cache import CACHE_ENABLED, EntityCache, fetch_with_cache
+from scripts.storage.watermarks import advance_watermark, batch_key, list_batch_files, list_pending_batch_files
+from scripts.storage.partitions import DEFAULT_USER_ID, RAW_PARTITION, get_user_id
+from scripts.storage.raw_sink import RAW_EXTENSIONS, get_raw_format, read_raw_records, strip_raw_extension, write_raw
 
 RAW_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/raw/spotify_api"))
 
+# Where track features come from: "api" fetches every track again with sp.tracks, "history" takes the full
+# track objects the recently-played payload already carries and writes them at extraction time
+TRACK_FEATURES_SOURCE = os.getenv("TRACK_FEATURES_SOURCE", "api")
+
 
 def get_latest_listening_history_file():
     """Finds the most recent listening history file."""
-    files = [f for f in os.listdir(RAW_DATA_DIR) if f.startswith("listening_history_") and f.endswith(".json")]
+    files = list_batch_files(RAW_DATA_DIR, "listening_history_", tuple(RAW_EXTENSIONS.values()), partition_column=RAW_PARTITION)
     if not files:
         raise FileNotFoundError("No listening history file found.")
-    latest_file = max(files, key=lambda f: datetime.strptime(f.split("_")[-1].split(".")[0], "%Y-%m-%dT%H-%M-%S"))
-    return os.path.join(RAW_DATA_DIR, latest_file)
+    return files[-1]
+
+
+def get_pending_listening_history_files(stage):
+    """Finds every user's listening history files newer than the user's watermark for a stage, oldest first."""
+    return list_pending_batch_files(stage, RAW_DATA_DIR, "listening_history_", tuple(RAW_EXTENSIONS.values()),
+                                    partition_column=RAW_PARTITION)
 
 
 def extract_raw_listening_history(file_path):
-    """Extracts raw listening history data from the JSON file."""
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    return data
+    """Extracts raw listening history data from the raw file (any raw format)."""
+    return read_raw_records(file_path)
 
 
-def fetch_track_features(track_ids):
-    """Fetch track features using the Spotify API."""
-    scope = "user-library-read"
-    sp = connect_to_spotify_api(scope=scope)
+def fetch_track_features(track_ids, sp=None, checkpoint=None, user_id=DEFAULT_USER_ID):
+    """
+    Fetch track features using the Spotify API in concurrent batches of 50, with the token of the user
+    whose history is enriched. With a checkpoint, every batch is saved to it as soon as it is fetched.
+    """
+    if sp is None:
+        scope = "user-library-read"
+        sp = connect_to_spotify_api(scope=scope, user_id=user_id)
 
-    track_features = []
     batch_size = 50
-    for i in range(0, len(track_ids), batch_size):
-        batch = track_ids[i:i + batch_size]
-        response = sp.tracks(batch)
-        for track in response["tracks"]:
-            track_features.append(track)
+    batches = make_batches(track_ids, batch_size)
+
+    def fetch_batch(batch):
+        tracks = sp.tracks(batch)["tracks"]
+        if checkpoint is not None:
+            checkpoint.save(batch, tracks)
+        return tracks
+
+    # The shared scheduler handles concurrency, rate limiting and retries
+    responses = get_scheduler().map(fetch_batch, batches, endpoint="tracks")
+
+    return [track for response in responses for track in response]
+
+
+def derive_track_features(listening_history):
+    """
+    Returns the unique track objects of a recently-played payload. They are the same full track objects
+    sp.tracks returns (album, duration, explicit, popularity), so no API call is needed.
+    """
+    tracks = {}
+    for item in listening_history:
+        track = item.get("track")
+        if track and track.get("id"):
+            tracks[track["id"]] = track
+    track_features = list(tracks.values())
+
+    # Keep the entity cache warm for runs that still fetch from the API
+    if CACHE_ENABLED:
+        EntityCache().put_many("track", track_features)
     return track_features
 
 
-def save_track_features_as_json(track_features, history_file):
-    """Saves track features to a JSON file."""
-    os.makedirs(RAW_DATA_DIR, exist_ok=True)
-
+def get_track_features_file(history_file):
+    """Returns the track features file that belongs to a history file."""
     file_name = os.path.basename(history_file).replace("listening_history", "track_features")
-    output_file = os.path.join(RAW_DATA_DIR, file_name)
+    return os.path.join(os.path.dirname(history_file), file_name)
 
-    with open(output_file, 'w') as f:
-        json.dump(track_features, f, indent=4)
-    print(f"Track features saved to {output_file}")
-
-
-def extract_track_features():
-    """Main function to extract and save track features."""
-    history_file = get_latest_listening_history_file()
-    listening_history = extract_raw_listening_history(history_file)
 
-    # Extract unique Track IDs from the raw listening history
-    track_ids = list({track["track"]["id"] for track in listening_history if "track" in track})
+def save_track_features_as_json(track_features, history_file):
+    """Saves track features next to the history file, in the same raw format."""
+    output_file = write_raw(track_features, strip_raw_extension(get_track_features_file(history_file)),
+                            "track_features", raw_format=get_raw_format(history_file))
+    print(f"Track features saved to {output_file}")
 
-    # Fetch track features using the extracted Track IDs
-    track_features = fetch_track_features(track_ids)
 
-    # Save the track features to a JSON file
-    save_track_features_as_json(track_features, history_file)
+@metrics.stage("track_features")
+def extract_track_features(history_files=None):
+    """
+    Main function to extract and save track features for every history file not enriched yet.
+
+    Args:
+        history_files (list): Enrich these history files instead (e.g. the batch of an Airflow run).
+    """
+    if history_files is None:
+        history_files = get_pending_listening_history_files("track_features")
+    if not history_files:
+        print("No new listening history files to extract track features for.")
+        return
+
+    for history_file in history_files:
+        if TRACK_FEATURES_SOURCE == "history":
+            # Normally written by the extraction already; derive them here for batches extracted before
+            if not os.path.exists(get_track_features_file(history_file)):
+                listening_history = extract_raw_listening_history(history_file)
+                track_features = derive_track_features(listening_history)
+                save_track_features_as_json(track_features, history_file)
+                metrics.count("rows", len(listening_history), table="listening_history", direction="in")
+                metrics.count("rows", len(track_features), table="track_features", direction="out")
+            advance_watermark("track_features", batch_key(history_file), get_user_id(history_file))
+            continue
+
+        listening_history = extract_raw_listening_history(history_file)
+        user_id = get_user_id(history_file)
+
+        # Extract unique Track IDs from the raw listening history
+        track_ids = list({track["track"]["id"] for track in listening_history if "track" in track})
+
+        # Batches a failed attempt already fetched are read back instead of being fetched again
+        checkpoint = get_checkpoint(history_file, "track_features")
+        done = checkpoint.done_ids()
+        resumed = list(checkpoint.iter_records())
+        if done:
+            print(f"Resuming track features of {os.path.basename(history_file)}: {len(done)} tracks already fetched")
+
+        # Fetch track features for Track IDs that are not cached (or are stale)
+        def fetch(ids):
+            return fetch_track_features(ids, checkpoint=checkpoint, user_id=user_id)
+        track_features = resumed + fetch_with_cache("track", [i for i in track_ids if i not in done], fetch)
+
+        # Save the track features to a JSON file, then move the watermark past this history file
+        save_track_features_as_json(track_features, history_file)
+        checkpoint.clear()
+        metrics.count("rows", len(listening_history), table="listening_history", direction="in")
+        metrics.count("rows", len(track_features), table="track_features", direction="out")
+        advance_watermark("track_features", batch_key(history_file), user_id)
 
 
 if __name__ == "__main__":
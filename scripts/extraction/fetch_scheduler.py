@@ -0,0 +1,147 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from spotipy.exceptions import SpotifyException
+from scripts.monitoring import metrics
+
+# Scheduler settings (shared by every extractor in the process)
+RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "5"))  # Requests per second
+BURST = int(os.getenv("SPOTIFY_BURST", "10"))  # Requests allowed back-to-back
+MAX_WORKERS = int(os.getenv("SPOTIFY_MAX_WORKERS", "8"))
+MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "5"))
+BACKOFF_BASE = float(os.getenv("SPOTIFY_BACKOFF_BASE", "1"))  # Seconds
+BACKOFF_MAX = float(os.getenv("SPOTIFY_BACKOFF_MAX", "30"))  # Seconds
+
+
+class TokenBucket:
+    """Thread-safe token bucket that can be paused by a Retry-After response."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stops handing out tokens for the given number of seconds and drains the bucket."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0
+
+
+def get_retry_after(error):
+    """Returns the Retry-After delay (seconds) of a rate-limited response, if the API sent one."""
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def is_retryable(error):
+    """Rate limits, server errors and network failures are retried; anything else is not."""
+    if isinstance(error, SpotifyException):
+        status = error.http_status or 0  # None for some transport errors
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def make_batches(ids, batch_size):
+    """Splits a list of IDs into batches of at most batch_size."""
+    return [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+
+class FetchScheduler:
+    """
+    Runs API batches concurrently on a thread pool while a shared token bucket keeps the
+    request rate within the API quota. Failed batches are retried with jittered backoff.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=BURST, max_workers=MAX_WORKERS, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def run_batch(self, fetch_batch, index, batch, endpoint="api"):
+        """
+        Fetches a single batch, retrying retryable errors until max_retries is reached. Every attempt
+        is timed and counted under the endpoint's name.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            metrics.count("api_calls", endpoint=endpoint)
+            if attempt:
+                metrics.count("api_retries", endpoint=endpoint)
+            try:
+                with metrics.timer("api_request", endpoint=endpoint):
+                    return fetch_batch(batch)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    print(f"Batch {index} failed after {attempt + 1} attempt(s): {e}")
+                    raise
+
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    # Hold every worker back, then spread the restart so they don't all fire at once
+                    self.bucket.pause(retry_after)
+                    delay = random.uniform(0, self.backoff_base)
+                else:
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                print(f"Retrying batch {index} (attempt {attempt + 2}/{self.max_retries + 1}) in {delay:.2f}s: {e}")
+                time.sleep(delay)
+
+    def map(self, fetch_batch, batches, endpoint="api"):
+        """
+        Runs fetch_batch over every batch concurrently.
+
+        Returns the results in the same order as the batches. Raises the error of the first batch
+        that could not be fetched after all retries.
+        """
+        if not batches:
+            return []
+
+        pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches)))
+        try:
+            futures = [pool.submit(self.run_batch, fetch_batch, i, batch, endpoint) for i, batch in enumerate(batches)]
+            return [future.result() for future in futures]
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Returns the process-wide scheduler so all extractors share one rate limit."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FetchScheduler()
+        return _scheduler
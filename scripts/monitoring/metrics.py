@@ -0,0 +1,177 @@
+import os
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Each stage run writes <METRICS_DIR>/spotify_etl_<stage>.prom (point node_exporter's textfile collector at
+# METRICS_DIR) and appends a JSON summary line to METRICS_LOG_FILE
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/metrics")))
+METRICS_LOG_FILE = os.getenv("METRICS_LOG_FILE", os.path.join(METRICS_DIR, "metrics.jsonl"))
+# Also log one JSON line per timed operation (every API batch, file, chunk and statement)
+METRICS_LOG_EVENTS = os.getenv("METRICS_LOG_EVENTS", "false").lower() == "true"
+
+PREFIX = "spotify_etl"
+
+# Prometheus name: (type, help). Every value covers the last run of a stage.
+METRICS = {
+    "operation_seconds": ("summary", "Time spent in an operation during the last run of the stage."),
+    "operation_errors": ("gauge", "Operations that raised during the last run of the stage."),
+    "rows": ("gauge", "Rows read (direction=in), written (direction=out), rejected (direction=rejected) or "
+                      "skipped as unchanged (direction=unchanged) during the last run of the stage."),
+    "api_calls": ("gauge", "Spotify API requests sent during the last run of the stage, retries included."),
+    "api_retries": ("gauge", "Spotify API requests retried during the last run of the stage."),
+    "bytes_written": ("gauge", "Bytes written to files during the last run of the stage."),
+    "stage_seconds": ("gauge", "Duration of the last run of the stage."),
+    "stage_success": ("gauge", "1 if the last run of the stage succeeded, 0 if it raised."),
+    "stage_last_run_timestamp_seconds": ("gauge", "When the last run of the stage finished (Unix time)."),
+}
+
+_lock = threading.Lock()
+_values = {}  # (name, labels) -> value
+_timers = {}  # (operation, labels) -> {"count", "sum", "max"}
+_current_stage = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def count(name, value=1, **labels):
+    """Adds value to a counter of the current stage, e.g. count("rows", 500, table="tracks", direction="out")."""
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        key = _key(name, {"stage": _current_stage or "none", **labels})
+        _values[key] = _values.get(key, 0) + value
+
+
+def log_event(event):
+    """Appends one structured JSON line to METRICS_LOG_FILE."""
+    line = json.dumps({"time": datetime.now(timezone.utc).isoformat(), **event}, default=str)
+    os.makedirs(os.path.dirname(METRICS_LOG_FILE), exist_ok=True)
+    with _lock, open(METRICS_LOG_FILE, "a") as f:
+        f.write(line + "\n")
+
+
+@contextmanager
+def timer(operation, **labels):
+    """
+    Times a block as one occurrence of an operation, e.g. timer("db_statement", table="tracks").
+    A block that raises is also counted in operation_errors.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    labels = {"stage": _current_stage or "none", "operation": operation, **labels}
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            stats = _timers.setdefault(_key("operation_seconds", labels), {"count": 0, "sum": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["sum"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            if failed:
+                key = _key("operation_errors", labels)
+                _values[key] = _values.get(key, 0) + 1
+        if METRICS_LOG_EVENTS:
+            log_event({"event": "operation", **labels, "seconds": round(elapsed, 6), "error": failed})
+
+
+def record_bytes_written(path, **labels):
+    """Counts the size of a file that was just written."""
+    if METRICS_ENABLED and os.path.exists(path):
+        count("bytes_written", os.path.getsize(path), **labels)
+
+
+def snapshot():
+    """Returns the metrics recorded so far as {"counters": [...], "timers": [...]} with their labels."""
+    with _lock:
+        counters = [{"name": name, **dict(labels), "value": value} for (name, labels), value in sorted(_values.items())]
+        timers = [{**dict(labels), "count": stats["count"], "seconds": round(stats["sum"], 6),
+                   "max_seconds": round(stats["max"], 6)}
+                  for (_, labels), stats in sorted(_timers.items())]
+    return {"counters": counters, "timers": timers}
+
+
+def _format_labels(labels):
+    def escape(value):
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+def to_prometheus():
+    """Renders the recorded metrics in the Prometheus text exposition format."""
+    samples = {name: [] for name in METRICS}
+    with _lock:
+        for (name, labels), value in _values.items():
+            samples.setdefault(name, []).append(f"{PREFIX}_{name}{_format_labels(labels)} {value}")
+        for (name, labels), stats in _timers.items():
+            samples[name].append(f"{PREFIX}_{name}_sum{_format_labels(labels)} {stats['sum']:.6f}")
+            samples[name].append(f"{PREFIX}_{name}_count{_format_labels(labels)} {stats['count']}")
+
+    lines = []
+    for name, lines_of_metric in samples.items():
+        if not lines_of_metric:
+            continue
+        metric_type, help_text = METRICS.get(name, ("gauge", name))
+        lines += [f"# HELP {PREFIX}_{name} {help_text}", f"# TYPE {PREFIX}_{name} {metric_type}"]
+        lines += sorted(lines_of_metric)
+    return "\n".join(lines) + "\n"
+
+
+def export(stage_name):
+    """Writes the stage's Prometheus textfile and logs its metrics as one JSON line."""
+    # Written through a temporary file, since the collector may read it at any time
+    path = os.path.join(METRICS_DIR, f"{PREFIX}_{stage_name}.prom")
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        f.write(to_prometheus())
+    os.replace(f"{path}.tmp", path)
+    log_event({"event": "stage", "stage": stage_name, **snapshot()})
+
+
+def reset():
+    """Clears every recorded metric."""
+    with _lock:
+        _values.clear()
+        _timers.clear()
+
+
+@contextmanager
+def stage(name):
+    """
+    Runs a block as one run of a pipeline stage: metrics recorded inside it are labelled with the stage,
+    and exported (then cleared) when it ends. A stage started inside another one is part of the outer run.
+    """
+    global _current_stage
+    if not METRICS_ENABLED or _current_stage is not None:
+        yield
+        return
+
+    reset()
+    _current_stage = name
+    start = time.perf_counter()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        count("stage_seconds", round(time.perf_counter() - start, 6))
+        count("stage_success", int(succeeded))
+        count("stage_last_run_timestamp_seconds", int(time.time()))
+        _current_stage = None
+        try:
+            export(name)
+        except OSError as e:
+            print(f"⚠️ Could not export the metrics of '{name}': {e}")
+        reset()
@@ -0,0 +1,143 @@
+import os
+import json
+from scripts.monitoring import metrics
+
+# Partition columns of the storage layout (Hive-style <column>=<YYYY-MM-DD> directories)
+RAW_PARTITION = "extracted_date"  # Raw API responses, by extraction (batch) date
+FACT_PARTITION = "played_date"  # listening_history_fact, by UTC play date
+SNAPSHOT_PARTITION = "snapshot_date"  # Dimension snapshots, by extraction (batch) date
+USER_PARTITION = "user_id"  # Raw files, batch manifests and watermarks of each user in a multi-user deployment
+
+# User of single-user deployments; its files stay where they were before users existed
+DEFAULT_USER_ID = "default"
+
+
+def partition_path(base_dir, column, value):
+    """Returns the directory of a partition, e.g. <base_dir>/played_date=2025-01-01."""
+    return os.path.join(base_dir, f"{column}={value}")
+
+
+def user_path(base_dir, user_id=DEFAULT_USER_ID):
+    """Returns a user's directory, <base_dir>/user_id=<user_id>, or base_dir itself for the default user."""
+    if user_id == DEFAULT_USER_ID:
+        return base_dir
+    return partition_path(base_dir, USER_PARTITION, user_id)
+
+
+def get_user_id(path):
+    """Returns the user a file belongs to, from the user_id=<user_id> directory in its path."""
+    prefix = f"{USER_PARTITION}="
+    for part in reversed(os.path.normpath(path).split(os.sep)):
+        if part.startswith(prefix):
+            return part[len(prefix):]
+    return DEFAULT_USER_ID
+
+
+def list_partitions(base_dir, column, start=None, end=None):
+    """
+    Lists the partitions of a dataset in order, pruned to start <= value <= end (inclusive, either
+    bound optional) from the directory names alone.
+
+    Returns:
+        list: (value, path) tuples.
+    """
+    if not os.path.isdir(base_dir):
+        return []
+    prefix = f"{column}="
+    partitions = []
+    for name in os.listdir(base_dir):
+        if not name.startswith(prefix):
+            continue
+        value = name[len(prefix):]
+        if (start is None or value >= start) and (end is None or value <= end):
+            partitions.append((value, os.path.join(base_dir, name)))
+    return sorted(partitions)
+
+
+def get_file_format(path):
+    """Returns a file's format label for metrics, e.g. "parquet" or "jsonl.zst"."""
+    name = os.path.basename(path)
+    return name.split(".", 1)[1] if "." in name else "none"
+
+
+def atomic_write(path, write):
+    """
+    Writes a file through a temporary file in the same directory and renames it into place,
+    so readers never see a partially written file.
+
+    Args:
+        write (callable): Called with the temporary path to write to.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    file_format = get_file_format(path)
+    try:
+        with metrics.timer("file_write", format=file_format):
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        metrics.record_bytes_written(path, format=file_format)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_json_atomic(data, path, **kwargs):
+    """Dumps data as JSON to path atomically."""
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, **kwargs)
+    atomic_write(path, write)
+
+
+def write_parquet_atomic(df, path):
+    """Writes a DataFrame (or Arrow table) as Parquet to path atomically."""
+    # pandas and pyarrow are imported on first use, since every stage (and the DAG) imports this module
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if isinstance(df, pa.Table):
+        atomic_write(path, lambda tmp_path: pq.write_table(df, tmp_path))
+    else:
+        atomic_write(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+
+
+def write_partitioned_parquet(df, base_dir, column, values, file_name):
+    """
+    Splits a DataFrame by partition value and writes each part atomically to
+    <base_dir>/<column>=<value>/<file_name>. Only the partitions present in the data are touched.
+
+    Args:
+        values (pd.Series): Partition value of every row.
+
+    Returns:
+        list: The files written.
+    """
+    files = []
+    for value, part in df.groupby(values.to_numpy(), sort=True):
+        path = os.path.join(partition_path(base_dir, column, value), file_name)
+        write_parquet_atomic(part.reset_index(drop=True), path)
+        files.append(path)
+    return files
+
+
+def read_partitioned_parquet(base_dir, column, start=None, end=None, columns=None, files=None):
+    """
+    Reads the Parquet files of the partitions between start and end (inclusive). Partitions outside
+    the range are never opened.
+
+    Args:
+        columns (list): Only read these columns.
+        files (list): Only read these file names within each partition.
+
+    Returns:
+        pd.DataFrame: The rows of every selected partition (empty if there are none).
+    """
+    import pandas as pd
+
+    paths = []
+    for _, path in list_partitions(base_dir, column, start, end):
+        names = sorted(f for f in os.listdir(path) if f.endswith(".parquet"))
+        paths.extend(os.path.join(path, f) for f in names if files is None or f in files)
+    if not paths:
+        return pd.DataFrame(columns=columns)
+    return pd.concat([pd.read_parquet(path, columns=columns) for path in paths], ignore_index=True)
@@ -0,0 +1,201 @@
+import io
+import os
+import json
+from functools import lru_cache
+from itertools import islice
+from scripts.monitoring import metrics
+from scripts.storage.partitions import atomic_write
+
+# Raw format for new extractions: "json" (pretty-printed array), "jsonl.zst" (zstd-compressed
+# newline-delimited JSON) or "parquet" (only the fields the pipeline uses, projected at extraction time)
+RAW_FORMAT = os.getenv("RAW_FORMAT", "json")
+RAW_EXTENSIONS = {
+    "json": ".json",
+    "jsonl": ".jsonl",
+    "jsonl.zst": ".jsonl.zst",
+    "parquet": ".parquet",
+}
+ZSTD_LEVEL = int(os.getenv("RAW_ZSTD_LEVEL", "3"))
+PARQUET_BATCH_SIZE = 10000  # Records per row group when writing raw Parquet
+
+@lru_cache(maxsize=None)
+def get_raw_schema(dataset):
+    """Returns the fields kept for a raw dataset ("listening_history", "track_features" or "artist_details") in Parquet."""
+    # pyarrow is only imported by the stages that read or write Parquet
+    import pyarrow as pa
+
+    album = pa.struct([
+        ("id", pa.string()),
+        ("name", pa.string()),
+        ("release_date", pa.string()),
+    ])
+    artists = pa.list_(pa.struct([("id", pa.string()), ("name", pa.string())]))
+    track = pa.struct([
+        ("id", pa.string()),
+        ("name", pa.string()),
+        ("popularity", pa.int64()),
+        ("duration_ms", pa.int64()),
+        ("explicit", pa.bool_()),
+        ("album", album),
+        ("artists", artists),
+    ])
+    schemas = {
+        "listening_history": pa.schema([("played_at", pa.string()), ("track", track)]),
+        "track_features": pa.schema(list(zip(track.names, [field.type for field in track]))),
+        "artist_details": pa.schema([
+            ("id", pa.string()),
+            ("name", pa.string()),
+            ("popularity", pa.int64()),
+            ("followers", pa.struct([("total", pa.int64())])),
+            ("genres", pa.list_(pa.string())),
+        ]),
+    }
+    return schemas[dataset]
+
+
+def get_raw_format(path):
+    """Returns the raw format of a file from its extension."""
+    for raw_format, extension in sorted(RAW_EXTENSIONS.items(), key=lambda item: -len(item[1])):
+        if path.endswith(extension):
+            return raw_format
+    raise ValueError(f"Unknown raw file format: {path}")
+
+
+def strip_raw_extension(path):
+    """Removes the raw format extension (e.g. ".jsonl.zst") from a path."""
+    return path[:-len(RAW_EXTENSIONS[get_raw_format(path)])]
+
+
+def write_raw(records, base_path, dataset, raw_format=RAW_FORMAT):
+    """
+    Writes raw API records atomically in the given format. Records are consumed one at a time, so an
+    iterator (e.g. iter_raw_records of another file) is written without being loaded into memory.
+
+    Args:
+        records (iterable): The records to write.
+        base_path (str): Output path without extension.
+        dataset (str): "listening_history", "track_features" or "artist_details" (selects the Parquet schema).
+
+    Returns:
+        str: The path written.
+    """
+    path = base_path + RAW_EXTENSIONS[raw_format]
+
+    def write(tmp_path):
+        if raw_format == "json":
+            # Same output as json.dump(records, f, indent=4), one record at a time
+            with open(tmp_path, "w") as f:
+                separator = "[\n    "
+                for record in records:
+                    f.write(separator + json.dumps(record, indent=4).replace("\n", "\n    "))
+                    separator = ",\n    "
+                f.write("[]" if separator == "[\n    " else "\n]")
+        elif raw_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            schema = get_raw_schema(dataset)
+            present = (r for r in records if r is not None)
+            with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+                while True:
+                    batch = list(islice(present, PARQUET_BATCH_SIZE))
+                    if not batch:
+                        break  # A file without row groups still holds the schema
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+        else:
+            import zstandard
+
+            with open(tmp_path, "wb") as f:
+                out = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f) if raw_format == "jsonl.zst" else f
+                for record in records:
+                    out.write((json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
+                if out is not f:
+                    out.close()
+
+    atomic_write(path, write)
+    return path
+
+
+def _iter_lines(path):
+    if path.endswith(".zst"):
+        import zstandard
+
+        with open(path, "rb") as f:
+            yield from io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f), encoding="utf-8")
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from f
+
+
+def iter_raw_records(path):
+    """Yields raw records one at a time from any raw format, without loading the whole file."""
+    raw_format = get_raw_format(path)
+    if raw_format == "json":
+        import ijson
+
+        with open(path, "rb") as f:
+            yield from ijson.items(f, "item", use_float=True)
+    elif raw_format == "parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        for line in _iter_lines(path):
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_raw_records(path):
+    """Reads every raw record of a file as a list of dicts."""
+    raw_format = get_raw_format(path)
+    with metrics.timer("file_read", format=raw_format):
+        if raw_format == "json":
+            with open(path, "r") as f:
+                return json.load(f)
+        return list(iter_raw_records(path))
+
+
+def flatten_arrow(table):
+    """
+    Flattens nested struct columns into "parent.child" columns (the same names pd.json_normalize
+    produces) and converts to pandas. List columns stay Arrow-backed so the transform can use list kernels.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    while any(pa.types.is_struct(field.type) for field in table.schema):
+        table = table.flatten()
+    return table.to_pandas(types_mapper=lambda t: pd.ArrowDtype(t) if pa.types.is_list(t) else None)
+
+
+def iter_raw_frames(path, chunk_size):
+    """Yields flattened DataFrames of at most chunk_size raw records."""
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if get_raw_format(path) == "parquet":
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield flatten_arrow(pa.Table.from_batches([batch]))
+        return
+
+    chunk = []
+    for record in iter_raw_records(path):
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield pd.json_normalize(chunk)
+            chunk = []
+    if chunk:
+        yield pd.json_normalize(chunk)
+
+
+def read_raw_frame(path):
+    """Reads a whole raw file as a flattened DataFrame."""
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    if get_raw_format(path) == "parquet":
+        with metrics.timer("file_read", format="parquet"):
+            return flatten_arrow(pq.read_table(path))
+    return pd.json_normalize(read_raw_records(path))
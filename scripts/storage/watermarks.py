@@ -0,0 +1,98 @@
+import os
+from scripts.auth.user_registry import get_user_ids
+from scripts.storage.partitions import DEFAULT_USER_ID, atomic_write, list_partitions, user_path
+
+METADATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/metadata"))
+
+# One durable watermark per stage and user (data/metadata/user_id=<user_id>/ for every user but the default)
+WATERMARK_FILES = {
+    "extraction": "last_extraction.txt",  # Max played_at (ms) returned by the API
+    "track_features": "last_track_features.txt",  # Batch key of the last enriched history file
+    "artist_details": "last_artist_details.txt",
+    "transform": "last_transform.txt",  # Batch key of the last transformed history file
+    "validation": "last_validation.txt",  # Batch key of the last validated processed batch
+    "load": "last_load.txt",  # Batch key of the last loaded processed batch
+}
+
+
+def get_watermark_file(stage, user_id=DEFAULT_USER_ID):
+    """Returns the path of a stage's watermark file for a user."""
+    if stage not in WATERMARK_FILES:
+        raise ValueError(f"Unknown stage '{stage}'. Expected one of {sorted(WATERMARK_FILES)}.")
+    return os.path.join(user_path(METADATA_DIR, user_id), WATERMARK_FILES[stage])
+
+
+def get_watermark(stage, default=None, user_id=DEFAULT_USER_ID):
+    """Reads a stage's watermark, or returns default if the stage has never run."""
+    path = get_watermark_file(stage, user_id)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            value = f.read().strip()
+        if value:
+            return value
+    return default
+
+
+def set_watermark(stage, value, user_id=DEFAULT_USER_ID):
+    """Saves a stage's watermark atomically (temp file + rename) so a crash never leaves it half-written."""
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write(str(value))
+    atomic_write(get_watermark_file(stage, user_id), write)
+
+
+def advance_watermark(stage, value, user_id=DEFAULT_USER_ID):
+    """
+    Moves a batch stage's watermark forward to value. Re-running an older batch (e.g. clearing an
+    earlier Airflow run) never moves it back.
+    """
+    current = get_watermark(stage, user_id=user_id)
+    if current is None or str(value) > current:
+        set_watermark(stage, value, user_id)
+
+
+def batch_key(file_name):
+    """
+    Returns the batch key of a raw or processed file, i.e. the "to" timestamp in
+    <prefix>_<from>_to_<to>.<ext>. Keys are YYYY-MM-DDTHH-MM-SS strings, so they sort chronologically.
+    """
+    return os.path.basename(file_name).split("_")[-1].split(".")[0]
+
+
+def list_batch_files(directory, prefix, extension, after=None, partition_column=None):
+    """
+    Lists files named <prefix><from>_to_<to><extension> in chronological order.
+
+    Args:
+        extension (str | tuple): File extension(s) to match.
+        after (str): Only return files whose batch key is greater than this watermark.
+        partition_column (str): Also look inside <directory>/<partition_column>=<YYYY-MM-DD>/ partitions.
+            Partitions dated before the watermark are skipped without being listed.
+    """
+    if not os.path.isdir(directory):
+        return []
+    directories = [directory]
+    if partition_column:
+        start = after[:10] if after else None
+        directories += [path for _, path in list_partitions(directory, partition_column, start=start)]
+
+    files = [
+        os.path.join(d, f) for d in directories for f in os.listdir(d)
+        if f.startswith(prefix) and f.endswith(extension) and os.path.isfile(os.path.join(d, f))
+    ]
+    files = sorted(files, key=batch_key)
+    if after is not None:
+        files = [f for f in files if batch_key(f) > after]
+    return files
+
+
+def list_pending_batch_files(stage, directory, prefix, extension, partition_column=None):
+    """
+    Lists every registered user's batch files (in the user's directory under directory) newer than the
+    user's watermark for a stage, oldest first. Arguments as in list_batch_files.
+    """
+    files = []
+    for user_id in get_user_ids():
+        files += list_batch_files(user_path(directory, user_id), prefix, extension,
+                                  after=get_watermark(stage, user_id=user_id), partition_column=partition_column)
+    return sorted(files, key=batch_key)
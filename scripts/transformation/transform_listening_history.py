@@ -1,69 +1,422 @@
 import os
 import pandas as pd
+import numpy as np
 import json
-from scripts.extraction.extract_track_features import get_latest_listening_history_file
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from functools import partial
+from itertools import chain
+from operator import itemgetter
+from scripts.monitoring import metrics
+from scripts.storage.watermarks import advance_watermark, batch_key, list_pending_batch_files
+from scripts.storage.raw_sink import RAW_EXTENSIONS, iter_raw_frames, read_raw_frame, strip_raw_extension
+from scripts.storage.partitions import (DEFAULT_USER_ID, FACT_PARTITION, RAW_PARTITION, SNAPSHOT_PARTITION, get_user_id,
+                                        partition_path, user_path, write_json_atomic, write_parquet_atomic,
+                                        write_partitioned_parquet)
 
 # Define directories (aligned with Docker-mounted volumes)
 RAW_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/raw/spotify_api"))
 PROCESSED_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/processed"))
 
+# Processed layout: one directory per table, partitioned by date, plus one manifest per batch
+LISTENING_HISTORY_DIR = os.path.join(PROCESSED_DATA_DIR, "listening_history_fact")  # played_date=YYYY-MM-DD/
+LISTENING_HISTORY_ARTISTS_DIR = os.path.join(PROCESSED_DATA_DIR, "listening_history_artists")  # played_date=YYYY-MM-DD/
+TRACK_DIMENSION_DIR = os.path.join(PROCESSED_DATA_DIR, "track_dimension")  # snapshot_date=YYYY-MM-DD/
+ARTIST_DIMENSION_DIR = os.path.join(PROCESSED_DATA_DIR, "artist_dimension")  # snapshot_date=YYYY-MM-DD/
+BATCHES_DIR = os.path.join(PROCESSED_DATA_DIR, "_batches")  # user_id=<user_id>/ for every user but the default
+
+# Transform mode: "batch" loads each raw file at once, "stream" parses and writes fixed-size chunks
+TRANSFORM_MODE = os.getenv("TRANSFORM_MODE", "batch")
+CHUNK_SIZE = int(os.getenv("TRANSFORM_CHUNK_SIZE", "10000"))
+
+# Output schemas, fixed so every streamed chunk lands in the same Parquet file
+LISTENING_HISTORY_SCHEMA = pa.schema([
+    ("played_at", pa.string()),
+    ("track_id", pa.string()),
+    ("artist_ids", pa.string()),
+    ("user_id", pa.string()),
+])
+LISTENING_HISTORY_ARTISTS_SCHEMA = pa.schema([
+    ("played_at", pa.string()),
+    ("track_id", pa.string()),
+    ("artist_id", pa.string()),
+    ("artist_position", pa.int64()),
+    ("user_id", pa.string()),
+])
+TRACK_DIMENSION_SCHEMA = pa.schema([
+    ("track_id", pa.string()),
+    ("track_name", pa.string()),
+    ("popularity", pa.int64()),
+    ("duration_ms", pa.int64()),
+    ("album_release_date", pa.string()),
+    ("explicit", pa.bool_()),
+    ("album_name", pa.string()),
+])
+ARTIST_DIMENSION_SCHEMA = pa.schema([
+    ("artist_id", pa.string()),
+    ("artist_name", pa.string()),
+    ("popularity", pa.int64()),
+    ("followers", pa.int64()),
+    ("genres", pa.string()),
+])
+
 
 def read_json_file(file_path):
-    """Reads a JSON file and returns it as a Pandas DataFrame."""
+    """
+    Reads a raw file (JSON, JSON Lines, zstd JSON Lines or projected Parquet) and returns it as a
+    flattened Pandas DataFrame.
+    """
     if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return pd.json_normalize(data)
+        return read_raw_frame(file_path)
     return pd.DataFrame()
 
 
-def transform_listening_history():
+def iter_json_chunks(file_path, chunk_size=CHUNK_SIZE):
+    """Yields flattened DataFrames of at most chunk_size records from a raw file."""
+    return iter_raw_frames(file_path, chunk_size)
+
+
+def to_arrow_list(values, field=None):
     """
-    Reads raw listening history JSON files, extracts key features, and saves as Parquet.
+    Converts a column of lists into an Arrow list<string> array in one pass.
+
+    Args:
+        values: A pandas Series of Python lists (non-lists become null), an Arrow-backed Series
+            (e.g. read from Parquet raw files) or an Arrow list array.
+        field (str): When the list elements are dicts/structs, the key to keep from each element.
     """
-    # Fetch the latest history files
-    latest_history = get_latest_listening_history_file()
-    track_features = latest_history.replace("listening_history", "track_features")
-    artist_features = latest_history.replace("listening_history", "artist_features")
+    if isinstance(values, pd.Series) and isinstance(values.dtype, pd.ArrowDtype):
+        values = pa.array(values.array)
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        lists = values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+        flat = pc.list_flatten(lists)
+        if field:
+            flat = pc.struct_field(flat, field)
+        lengths = pc.fill_null(pc.list_value_length(lists), 0).to_numpy()
+        is_list = lists.is_valid().to_numpy(zero_copy_only=False)
+    else:
+        items = values.to_numpy(dtype=object)
+        is_list = np.fromiter((isinstance(x, list) for x in items), dtype=bool, count=len(items))
+        lists = items[is_list]
+        lengths = np.zeros(len(items), dtype=np.int64)
+        lengths[is_list] = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+        flat = chain.from_iterable(lists)
+        if field:
+            flat = map(itemgetter(field), flat)
+        flat = pa.array(list(flat), type=pa.string())
 
-    # Read the JSON files into Pandas DataFrames
-    df_history = read_json_file(os.path.join(RAW_DATA_DIR, latest_history))
-    df_track = read_json_file(os.path.join(RAW_DATA_DIR, track_features))
-    df_artist = read_json_file(os.path.join(RAW_DATA_DIR, artist_features))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return pa.LargeListArray.from_arrays(pa.array(offsets), flat.cast(pa.string()), mask=pa.array(~is_list))
 
-    if df_history.empty or df_track.empty or df_artist.empty:
-        print("One or more required files are missing or empty. Exiting.")
-        return
 
-    # Extract key features for Listening History Fact Table
-    listening_history_df = df_history[["played_at", "track.id", "track.artists"]].copy()
+def to_pandas_strings(array, like):
+    """Converts an Arrow string array to an object Series (nulls become None), keeping the index of `like`."""
+    index = like.index if isinstance(like, pd.Series) else None
+    return pd.Series(array.to_numpy(zero_copy_only=False), index=index, dtype=object)
+
+
+def join_artist_ids(artists):
+    """Joins the artist IDs of every play into a comma-separated string ("" when there are none)."""
+    if isinstance(artists, pd.Series) and not isinstance(artists.dtype, pd.ArrowDtype):
+        # From Python dicts, one C-level join per row is cheaper than converting to Arrow first
+        get_id = itemgetter("id")
+        return pd.Series([",".join(map(get_id, x)) if isinstance(x, list) else "" for x in artists.to_numpy(dtype=object)],
+                         index=artists.index, dtype=object)
+
+    lists = to_arrow_list(artists, field="id")
+    joined = pc.fill_null(pc.binary_join(lists, ","), "")
+    return to_pandas_strings(joined, artists)
+
+
+def genres_to_json(genres):
+    """
+    Serializes every genres list exactly as json.dumps would (None for non-lists). Each distinct
+    genre is escaped once and the lists are then joined with Arrow kernels.
+    """
+    lists = to_arrow_list(genres)
+    encoded = pc.dictionary_encode(pc.list_flatten(lists))
+    escaped_genres = pa.array([json.dumps(genre) for genre in encoded.dictionary.to_pylist()], type=pa.string())
+    escaped = pc.fill_null(pc.take(escaped_genres, encoded.indices), "null")
+    escaped_lists = pa.LargeListArray.from_arrays(lists.offsets, escaped, mask=lists.is_null())
+
+    joined = pc.binary_join_element_wise("[", pc.binary_join(escaped_lists, ", "), "]", "")
+    return to_pandas_strings(joined, genres)
+
+
+def build_listening_history_fact(df_history, user_id=DEFAULT_USER_ID):
+    """Extracts key features for the Listening History Fact Table."""
+    listening_history_df = df_history.reindex(columns=["played_at", "track.id", "track.artists"])
     listening_history_df.rename(columns={"track.id": "track_id", "track.artists": "artist_ids"}, inplace=True)
-    listening_history_df["artist_ids"] = listening_history_df["artist_ids"].apply(
-        lambda x: ",".join([artist["id"] for artist in x]) if isinstance(x, list) else "")
+    listening_history_df["artist_ids"] = join_artist_ids(listening_history_df["artist_ids"])
+    listening_history_df["user_id"] = user_id
+    return listening_history_df
+
+
+def build_listening_history_artists(df_history, user_id=DEFAULT_USER_ID):
+    """Extracts one row per artist of every play for the play-to-artist bridge table."""
+    lists = to_arrow_list(df_history.reindex(columns=["track.artists"])["track.artists"], field="id")
+    plays = pc.list_parent_indices(lists).to_numpy()
+    offsets = lists.offsets.to_numpy()
 
-    # Save as Parquet
-    listening_history_df.to_parquet(os.path.join(PROCESSED_DATA_DIR, "listening_history_fact.parquet"), index=False)
+    bridge_df = pd.DataFrame({
+        "played_at": df_history.reindex(columns=["played_at"])["played_at"].to_numpy(dtype=object)[plays],
+        "track_id": df_history.reindex(columns=["track.id"])["track.id"].to_numpy(dtype=object)[plays],
+        "artist_id": pc.list_flatten(lists).to_numpy(zero_copy_only=False),
+        # 1 is the primary artist, in the order Spotify lists them
+        "artist_position": np.arange(1, len(plays) + 1) - offsets[plays],
+        "user_id": user_id,
+    })
+    return bridge_df
 
-    # Extract dimensional features for Track Dimension Table
-    track_dimension_df = df_track[
-        ["id", "name", "popularity", "duration_ms", "album.release_date", "explicit", "album.name"]]
+
+def build_track_dimension(df_track):
+    """Extracts dimensional features for the Track Dimension Table."""
+    track_dimension_df = df_track.reindex(
+        columns=["id", "name", "popularity", "duration_ms", "album.release_date", "explicit", "album.name"])
     track_dimension_df.rename(columns={"id": "track_id", "name": "track_name", "album.name": "album_name", 'album.release_date': 'album_release_date'},
                               inplace=True)
-    track_dimension_df.to_parquet(os.path.join(PROCESSED_DATA_DIR, "track_dimension.parquet"), index=False)
+    return track_dimension_df
+
 
-    # Extract dimensional features for Artist Dimension Table
-    artist_dimension_df = df_artist[["id", "name", "popularity", "followers.total", "genres"]]
+def build_artist_dimension(df_artist):
+    """Extracts dimensional features for the Artist Dimension Table."""
+    artist_dimension_df = df_artist.reindex(columns=["id", "name", "popularity", "followers.total", "genres"])
     artist_dimension_df.rename(columns={"id": "artist_id", "name": "artist_name", "popularity": "popularity",
                                         "followers.total": "followers"}, inplace=True)
-    
+
     # Convert the genres list to a JSON string
-    artist_dimension_df["genres"] = artist_dimension_df["genres"].apply(lambda x: json.dumps(x) if isinstance(x, list) else None)
-    
-    artist_dimension_df.to_parquet(os.path.join(PROCESSED_DATA_DIR, "artist_dimension.parquet"), index=False)
+    artist_dimension_df["genres"] = genres_to_json(artist_dimension_df["genres"])
+    return artist_dimension_df
+
+
+def stream_to_parquet(input_file, build, schema, output_file, chunk_size=CHUNK_SIZE, partition_values=None,
+                      table_name=None):
+    """
+    Flattens a raw JSON file chunk by chunk and appends each chunk to its output Parquet file
+    as a row group, so peak memory is bounded by chunk_size rather than by the file size.
+    Files are written under a temporary name and renamed into place once complete.
+
+    Args:
+        output_file (callable): Maps a partition value (None when unpartitioned) to an output path.
+        partition_values (callable): Returns the partition value of every row of a built chunk.
+        table_name (str): The output table, for metrics.
+
+    Returns:
+        dict: Rows written per output file.
+    """
+    writers, rows = {}, {}
+    try:
+        for chunk in iter_json_chunks(input_file, chunk_size):
+            with metrics.timer("dataframe_transform", table=table_name):
+                df = build(chunk)[schema.names]
+            metrics.count("rows", len(chunk), table=table_name, direction="in")
+            parts = df.groupby(partition_values(df).to_numpy(), sort=False) if partition_values else [(None, df)]
+            for value, part in parts:
+                path = output_file(value)
+                if path not in writers:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    writers[path] = pq.ParquetWriter(f"{path}.tmp", schema)
+                    rows[path] = 0
+                table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+                with metrics.timer("file_write", format="parquet"):
+                    writers[path].write_table(table)
+                rows[path] += table.num_rows
+        for path, writer in writers.items():
+            writer.close()
+            os.replace(f"{path}.tmp", path)
+            metrics.record_bytes_written(path, format="parquet")
+            metrics.count("rows", rows[path], table=table_name, direction="out")
+    finally:
+        for path, writer in writers.items():
+            if writer.is_open:
+                writer.close()
+            if os.path.exists(f"{path}.tmp"):
+                os.remove(f"{path}.tmp")
+    return rows
+
+
+def get_raw_feature_files(history_file):
+    """Returns the track features and artist details files extracted alongside a history file."""
+    directory, file_name = os.path.split(history_file)
+    track_features = os.path.join(directory, file_name.replace("listening_history", "track_features"))
+    artist_features = os.path.join(directory, file_name.replace("listening_history", "artist_details"))
+    return track_features, artist_features
+
+
+def get_batch_name(history_file):
+    """Returns the batch name of a history file, i.e. "<from>_to_<to>"."""
+    return os.path.basename(strip_raw_extension(history_file))[len("listening_history_"):]
+
+
+def get_output_name(history_file):
+    """
+    Returns the Parquet file name of a batch within each partition: "<batch>.parquet", prefixed with
+    the user ID for every user but the default, so users sharing a partition never collide.
+    """
+    user_id = get_user_id(history_file)
+    prefix = "" if user_id == DEFAULT_USER_ID else f"{user_id}_"
+    return f"{prefix}{get_batch_name(history_file)}.parquet"
+
+
+def get_manifest_file(history_file):
+    """Returns the manifest of a batch, <BATCHES_DIR>[/user_id=<user_id>]/<batch>.json."""
+    return os.path.join(user_path(BATCHES_DIR, get_user_id(history_file)), f"{get_batch_name(history_file)}.json")
+
+
+def played_dates(df):
+    """Returns the UTC play date (YYYY-MM-DD) of every fact row."""
+    return df["played_at"].str[:10]
+
+
+def write_batch_manifest(history_file, files):
+    """
+    Records the processed files of a batch in its manifest (see get_manifest_file), relative to
+    PROCESSED_DATA_DIR. It is written last, so the loader only ever sees complete batches.
+    """
+    manifest = {table: sorted(os.path.relpath(f, PROCESSED_DATA_DIR) for f in paths) for table, paths in files.items()}
+    write_json_atomic(manifest, get_manifest_file(history_file), indent=4)
+
+
+def transform_history_file_streaming(history_file, chunk_size=CHUNK_SIZE):
+    """
+    Streams one batch of raw JSON files into the partitioned Parquet outputs in fixed-size chunks.
+
+    Returns True if the batch was transformed.
+    """
+    track_features, artist_features = get_raw_feature_files(history_file)
+
+    inputs = [history_file, track_features, artist_features]
+    if not all(os.path.exists(os.path.join(RAW_DATA_DIR, f)) for f in inputs):
+        print("One or more required files are missing or empty. Exiting.")
+        return False
+
+    file_name = get_output_name(history_file)
+    snapshot_date = batch_key(history_file)[:10]
+    user_id = get_user_id(history_file)
+    outputs = [
+        ("listening_history_fact", history_file, partial(build_listening_history_fact, user_id=user_id),
+         LISTENING_HISTORY_SCHEMA,
+         lambda value: os.path.join(partition_path(LISTENING_HISTORY_DIR, FACT_PARTITION, value), file_name),
+         played_dates),
+        ("listening_history_artists", history_file, partial(build_listening_history_artists, user_id=user_id),
+         LISTENING_HISTORY_ARTISTS_SCHEMA,
+         lambda value: os.path.join(partition_path(LISTENING_HISTORY_ARTISTS_DIR, FACT_PARTITION, value), file_name),
+         played_dates),
+        ("track_dimension", track_features, build_track_dimension, TRACK_DIMENSION_SCHEMA,
+         lambda _: os.path.join(partition_path(TRACK_DIMENSION_DIR, SNAPSHOT_PARTITION, snapshot_date), file_name),
+         None),
+        ("artist_dimension", artist_features, build_artist_dimension, ARTIST_DIMENSION_SCHEMA,
+         lambda _: os.path.join(partition_path(ARTIST_DIMENSION_DIR, SNAPSHOT_PARTITION, snapshot_date), file_name),
+         None),
+    ]
+    files = {}
+    for table, input_file, build, schema, output_file, partition_values in outputs:
+        rows = stream_to_parquet(os.path.join(RAW_DATA_DIR, input_file), build, schema, output_file, chunk_size,
+                                 partition_values, table)
+        files[table] = list(rows)
+        print(f"{sum(rows.values())} rows streamed to {len(rows)} {table} partition(s) (chunk size {chunk_size})")
+
+    write_batch_manifest(history_file, files)
+    return True
+
+
+def build_table(table_name, build, df, *args):
+    """Runs a build function on a whole batch, timed and with its rows in and out counted."""
+    with metrics.timer("dataframe_transform", table=table_name):
+        built = build(df, *args)
+    metrics.count("rows", len(df), table=table_name, direction="in")
+    metrics.count("rows", len(built), table=table_name, direction="out")
+    return built
+
+
+def transform_history_file(history_file):
+    """
+    Transforms one batch of raw JSON files (history + track features + artist details) into
+    partitioned Parquet: the fact table by played_date, the dimensions by snapshot_date.
+
+    Returns True if the batch was transformed.
+    """
+    track_features, artist_features = get_raw_feature_files(history_file)
+
+    # Read the JSON files into Pandas DataFrames
+    df_history = read_json_file(os.path.join(RAW_DATA_DIR, history_file))
+    df_track = read_json_file(os.path.join(RAW_DATA_DIR, track_features))
+    df_artist = read_json_file(os.path.join(RAW_DATA_DIR, artist_features))
+
+    if df_history.empty or df_track.empty or df_artist.empty:
+        print("One or more required files are missing or empty. Exiting.")
+        return False
+
+    file_name = get_output_name(history_file)
+    snapshot_date = batch_key(history_file)[:10]
+    user_id = get_user_id(history_file)
+
+    # Save as Parquet, touching only the play dates present in this batch
+    listening_history_df = build_table("listening_history_fact", build_listening_history_fact, df_history, user_id)
+    listening_history_files = write_partitioned_parquet(listening_history_df, LISTENING_HISTORY_DIR, FACT_PARTITION,
+                                                        played_dates(listening_history_df), file_name)
+    artists_df = build_table("listening_history_artists", build_listening_history_artists, df_history, user_id)
+    artists_files = write_partitioned_parquet(artists_df, LISTENING_HISTORY_ARTISTS_DIR, FACT_PARTITION,
+                                              played_dates(artists_df), file_name)
+
+    track_dimension_file = os.path.join(partition_path(TRACK_DIMENSION_DIR, SNAPSHOT_PARTITION, snapshot_date), file_name)
+    write_parquet_atomic(build_table("track_dimension", build_track_dimension, df_track), track_dimension_file)
+
+    artist_dimension_file = os.path.join(partition_path(ARTIST_DIMENSION_DIR, SNAPSHOT_PARTITION, snapshot_date), file_name)
+    write_parquet_atomic(build_table("artist_dimension", build_artist_dimension, df_artist), artist_dimension_file)
+
+    write_batch_manifest(history_file, {
+        "listening_history_fact": listening_history_files,
+        "listening_history_artists": artists_files,
+        "track_dimension": [track_dimension_file],
+        "artist_dimension": [artist_dimension_file],
+    })
+
+    print(f"Data transformed and saved to {len(listening_history_files)} partition(s) of {LISTENING_HISTORY_DIR}")
+    print(f"Track dimension data saved to {track_dimension_file}")
+    print(f"Artist dimension data saved to {artist_dimension_file}")
+    return True
+
+
+@metrics.stage("transform")
+def transform_listening_history(mode=None, history_files=None):
+    """
+    Transforms every raw listening history batch newer than the transform watermark, oldest first,
+    and saves each one as Parquet.
+
+    Args:
+        mode (str): "batch" or "stream". Defaults to TRANSFORM_MODE.
+        history_files (list): Transform these history files instead (e.g. the batch of an Airflow run).
+
+    Returns:
+        list: The history files transformed.
+    """
+    mode = mode or TRANSFORM_MODE
+    if mode not in ("batch", "stream"):
+        raise ValueError(f"Unknown transform mode '{mode}'. Expected 'batch' or 'stream'.")
+    transform = transform_history_file_streaming if mode == "stream" else transform_history_file
+
+    if history_files is None:
+        history_files = list_pending_batch_files("transform", RAW_DATA_DIR, "listening_history_",
+                                                 tuple(RAW_EXTENSIONS.values()), partition_column=RAW_PARTITION)
+    if not history_files:
+        print("No new listening history files to transform.")
+        return []
 
-    print(f"Data transformed and saved to {PROCESSED_DATA_DIR}/listening_history_fact.parquet")
-    print(f"Track dimension data saved to {PROCESSED_DATA_DIR}/track_dimension.parquet")
-    print(f"Artist dimension data saved to {PROCESSED_DATA_DIR}/artist_dimension.parquet")
+    transformed, blocked_users = [], set()
+    for history_file in history_files:
+        user_id = get_user_id(history_file)
+        if user_id in blocked_users:
+            continue
+        # Stop at a user's first batch that is not fully extracted yet; it is retried on the next run
+        if not transform(history_file):
+            blocked_users.add(user_id)
+            continue
+        advance_watermark("transform", batch_key(history_file), user_id)
+        transformed.append(history_file)
+    return transformed
 
 
 # Only run when script is executed directly
@@ -0,0 +1,253 @@
+import os
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scripts.auth.user_registry import get_user_ids
+from scripts.monitoring import metrics
+from scripts.storage.partitions import atomic_write, get_user_id, user_path, write_parquet_atomic
+from scripts.storage.watermarks import advance_watermark, batch_key, get_watermark, list_batch_files
+
+PROCESSED_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data/processed"))
+BATCHES_DIR = os.path.join(PROCESSED_DATA_DIR, "_batches")  # One manifest per transformed batch (per user)
+QUARANTINE_DIR = os.path.join(PROCESSED_DATA_DIR, "_quarantine")  # <batch>.jsonl of rejected rows (per user)
+
+# A batch with a larger share of rejected rows in any table fails instead of loading what is left
+MAX_REJECTED_FRACTION = float(os.getenv("VALIDATION_MAX_REJECTED_FRACTION", "0.1"))
+
+INT_MAX = 2 ** 31 - 1
+
+# What the database accepts from each processed table, checked in this order (referenced tables first):
+# column kinds, columns that must not be null (required: nor empty), integer bounds, and references to
+# the rows of another table of the same batch that passed
+TABLES = [
+    {
+        "table": "track_dimension",
+        "columns": {"track_id": "string", "track_name": "string", "album_name": "string", "popularity": "int",
+                    "duration_ms": "int", "album_release_date": "string", "explicit": "bool"},
+        "required": ["track_id", "track_name"],
+        "not_null": [],
+        "bounds": {"popularity": (0, 100), "duration_ms": (0, INT_MAX)},
+        "references": [],
+    },
+    {
+        "table": "artist_dimension",
+        "columns": {"artist_id": "string", "artist_name": "string", "genres": "string", "followers": "int",
+                    "popularity": "int"},
+        "required": ["artist_id", "artist_name"],
+        "not_null": [],
+        "bounds": {"followers": (0, INT_MAX), "popularity": (0, 100)},
+        "references": [],
+    },
+    {
+        "table": "listening_history_fact",
+        "columns": {"played_at": "timestamp", "track_id": "string", "artist_ids": "string", "user_id": "string"},
+        "required": ["played_at", "track_id", "user_id"],
+        "not_null": ["artist_ids"],
+        "bounds": {},
+        "references": [("unknown_track", ["track_id"], "track_dimension", ["track_id"])],
+    },
+    {
+        "table": "listening_history_artists",
+        "columns": {"played_at": "timestamp", "track_id": "string", "artist_id": "string", "artist_position": "int",
+                    "user_id": "string"},
+        "required": ["played_at", "track_id", "artist_id", "user_id"],
+        "not_null": ["artist_position"],
+        "bounds": {"artist_position": (1, 32767)},
+        "references": [("orphan_play", ["user_id", "track_id", "played_at"], "listening_history_fact",
+                        ["user_id", "track_id", "played_at"])],
+    },
+]
+
+# pandas dtypes (pd.api.types.infer_dtype) each column kind may be stored as
+ACCEPTED_DTYPES = {
+    "string": {"string", "empty"},
+    "timestamp": {"string", "empty"},
+    "int": {"integer", "floating", "mixed-integer-float", "empty"},
+    "bool": {"boolean", "empty"},
+}
+
+
+def get_pending_batches():
+    """Finds every user's manifests of processed batches newer than the user's validation watermark, oldest first."""
+    batches = []
+    for user_id in get_user_ids():
+        batches += list_batch_files(user_path(BATCHES_DIR, user_id), "", ".json",
+                                    after=get_watermark("validation", user_id=user_id))
+    return sorted(batches, key=batch_key)
+
+
+def get_quarantine_file(batch):
+    """Returns the quarantine file of a batch manifest, <QUARANTINE_DIR>[/user_id=<user_id>]/<batch>.jsonl."""
+    name = os.path.splitext(os.path.basename(batch))[0]
+    return os.path.join(user_path(QUARANTINE_DIR, get_user_id(batch)), f"{name}.jsonl")
+
+
+def read_table_files(files):
+    """Reads a table's files into one DataFrame indexed by (file position, row), so rows can be written back."""
+    if not files:
+        return pd.DataFrame()
+    with metrics.timer("file_read", format="parquet"):
+        return pd.concat([pd.read_parquet(f) for f in files], keys=range(len(files)))
+
+
+def check_schema(spec, df):
+    """
+    Checks that every expected column is present and stored as a compatible type.
+
+    Raises:
+        ValueError: If the table does not have the expected schema, since none of its rows could load.
+    """
+    missing = [column for column in spec["columns"] if column not in df]
+    if missing:
+        raise ValueError(f"{spec['table']} is missing column(s) {missing}")
+    wrong = {column: dtype for column, kind in spec["columns"].items()
+             if (dtype := pd.api.types.infer_dtype(df[column], skipna=True)) not in ACCEPTED_DTYPES[kind]}
+    if wrong:
+        raise ValueError(f"{spec['table']} has column(s) of unexpected type: {wrong}")
+
+
+def find_invalid_rows(spec, df, valid_rows):
+    """
+    Runs a table's row checks, each over whole columns at once.
+
+    Args:
+        valid_rows (dict): The rows that passed of the tables already checked, by table.
+
+    Returns:
+        pd.Series: The first check every row failed (None for rows that passed).
+    """
+    failed = pd.Series(None, index=df.index, dtype=object)
+
+    def record(check, mask):
+        failed[mask & failed.isna()] = check
+
+    for column in spec["required"]:
+        record(f"missing_{column}", df[column].isna() | (df[column].astype(str) == ""))
+    for column in spec["not_null"]:
+        record(f"missing_{column}", df[column].isna())
+    for column, kind in spec["columns"].items():
+        if kind == "timestamp":
+            parsed = pd.to_datetime(df[column], utc=True, errors="coerce", format="ISO8601")
+            record(f"invalid_{column}", df[column].notna() & parsed.isna())
+    for column, (low, high) in spec["bounds"].items():
+        values = pd.to_numeric(df[column], errors="coerce")
+        record(f"invalid_{column}", df[column].notna() & ~(values.between(low, high) & (values % 1 == 0)))
+    for check, columns, table, referenced_columns in spec["references"]:
+        referenced = valid_rows.get(table)
+        if referenced is None or referenced.empty:
+            record(check, pd.Series(True, index=df.index))
+            continue
+        keys = pd.MultiIndex.from_frame(df[columns].astype(str))
+        known = pd.MultiIndex.from_frame(referenced[referenced_columns].astype(str))
+        record(check, pd.Series(~keys.isin(known), index=df.index))
+    return failed
+
+
+def write_clean_files(files, df, failed):
+    """Rewrites the files that held rejected rows with only their valid rows, keeping each file's schema."""
+    for position in sorted(set(failed[failed.notna()].index.get_level_values(0))):
+        path = files[position]
+        rows = df.loc[position][failed.loc[position].isna().to_numpy()]
+        table = pa.Table.from_pandas(rows.reset_index(drop=True), schema=pq.read_schema(path), preserve_index=False)
+        write_parquet_atomic(table, path)
+
+
+def write_quarantine(batch, rejected):
+    """Writes the rejected rows of a batch as JSON Lines: {"table", "check", "row"}."""
+    lines = [json.dumps({"table": table, "check": check, "row": row}, default=str)
+             for table, _, df, failed in rejected
+             for check, row in zip(failed[failed.notna()], df[failed.notna()].to_dict(orient="records"))]
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+    atomic_write(get_quarantine_file(batch), write)
+
+
+def validate_batch(batch):
+    """
+    Validates the processed tables of one batch manifest. Rejected rows are written to the batch's
+    quarantine file and removed from the processed files, so the load only sees rows the database accepts.
+    Nothing is rewritten unless the whole batch passes.
+
+    Returns:
+        bool: True if the batch passed (possibly with rows quarantined).
+    """
+    with open(batch, "r") as f:
+        manifest = json.load(f)
+
+    valid_rows, rejected = {}, []
+    for spec in TABLES:
+        table = spec["table"]
+        files = [os.path.join(PROCESSED_DATA_DIR, f) for f in manifest.get(table, [])]
+        df = read_table_files(files)
+        if df.empty:
+            valid_rows[table] = df
+            continue
+
+        try:
+            check_schema(spec, df)
+        except ValueError as e:
+            print(f"❌ {os.path.basename(batch)}: {e}")
+            return False
+        with metrics.timer("validation_checks", table=table):
+            failed = find_invalid_rows(spec, df, valid_rows)
+        valid_rows[table] = df[failed.isna()]
+
+        rejected_rows = int(failed.notna().sum())
+        metrics.count("rows", len(df), table=table, direction="in")
+        metrics.count("rows", len(df) - rejected_rows, table=table, direction="out")
+        metrics.count("rows", rejected_rows, table=table, direction="rejected")
+        if rejected_rows:
+            print(f"⚠️ {table}: {rejected_rows} of {len(df)} rows rejected "
+                  f"({failed.value_counts().to_dict()})")
+            if rejected_rows > MAX_REJECTED_FRACTION * len(df):
+                print(f"❌ {os.path.basename(batch)}: more than {MAX_REJECTED_FRACTION:.0%} of {table} is invalid.")
+                return False
+            rejected.append((table, files, df, failed))
+
+    if rejected:
+        write_quarantine(batch, rejected)
+        for _, files, df, failed in rejected:
+            write_clean_files(files, df, failed)
+        print(f"Rejected rows of {os.path.basename(batch)} quarantined in {get_quarantine_file(batch)}")
+    return True
+
+
+@metrics.stage("validation")
+def validate_processed_data(batches=None):
+    """
+    Validates every processed batch newer than the validation watermark, oldest first, before it is
+    loaded. Checks cover the schema, nulls, types and references between the tables of a batch, and run
+    over whole columns. A batch that fails (wrong schema, or too many invalid rows) stops its user's
+    later batches until the next run; other users go on.
+
+    Args:
+        batches (list): Validate these batch manifests instead (e.g. the batch of an Airflow run).
+
+    Returns:
+        list: The batch manifests that passed.
+    """
+    if batches is None:
+        batches = get_pending_batches()
+    if not batches:
+        print("No new processed batches to validate.")
+        return []
+
+    validated, blocked_users = [], set()
+    for batch in batches:
+        user_id = get_user_id(batch)
+        if user_id in blocked_users:
+            continue
+        if not validate_batch(batch):
+            blocked_users.add(user_id)
+            continue
+        advance_watermark("validation", batch_key(batch), user_id)
+        validated.append(batch)
+        print(f"✅ Batch {os.path.basename(batch)} validated.")
+    return validated
+
+
+if __name__ == "__main__":
+    validate_processed_data()
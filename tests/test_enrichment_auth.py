@@ -0,0 +1,63 @@
+import json
+import os
+import pytest
+from scripts.extraction import extract_artist_data, extract_track_features
+from scripts.monitoring import metrics
+from scripts.storage import watermarks
+
+
+class RecordingClient:
+    """Answers tracks/artists requests with minimal objects."""
+
+    def tracks(self, ids):
+        return {"tracks": [{"id": i} for i in ids]}
+
+    def artists(self, ids):
+        return {"artists": [{"id": i} for i in ids]}
+
+
+@pytest.fixture
+def clients(monkeypatch, tmp_path):
+    """Records the (scope, user_id) of every client the enrichment asks for, and keeps state in tmp_path."""
+    requested = []
+
+    def connect_to_spotify_api(scope="user-read-recently-played", user_id="default"):
+        requested.append((scope, user_id))
+        return RecordingClient()
+
+    for module in (extract_track_features, extract_artist_data):
+        monkeypatch.setattr(module, "connect_to_spotify_api", connect_to_spotify_api)
+        monkeypatch.setattr(module, "fetch_with_cache", lambda entity, ids, fetch: fetch(ids) if ids else [])
+    monkeypatch.setattr(watermarks, "METADATA_DIR", str(tmp_path / "metadata"))
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    return requested
+
+
+def write_history(tmp_path, user_dir):
+    """Writes a one-play history file under a user's raw directory and returns its path."""
+    directory = tmp_path / "raw" / user_dir / "extracted_date=2025-01-02"
+    os.makedirs(directory)
+    path = directory / "listening_history_2025-01-01T00-00-00_to_2025-01-02T00-00-00.json"
+    play = {"played_at": "2025-01-01T10:00:00.000Z", "track": {"id": "track1", "artists": [{"id": "artist1"}]}}
+    path.write_text(json.dumps([play]))
+    return str(path)
+
+
+@pytest.mark.parametrize("user_dir, user_id", [("", "default"), ("user_id=alice", "alice")])
+def test_enrichment_uses_the_token_of_the_history_files_user(clients, tmp_path, user_dir, user_id):
+    history_file = write_history(tmp_path, user_dir)
+
+    extract_track_features.extract_track_features([history_file])
+    extract_artist_data.extract_artist_features([history_file])
+
+    assert clients == [("user-library-read", user_id), ("user-read-recently-played", user_id)]
+    assert watermarks.get_watermark("track_features", user_id=user_id) is not None
+    assert watermarks.get_watermark("artist_details", user_id=user_id) is not None
+
+
+def test_users_of_one_run_each_get_their_own_client(clients, tmp_path):
+    history_files = [write_history(tmp_path, "user_id=alice"), write_history(tmp_path, "user_id=bob")]
+
+    extract_track_features.extract_track_features(history_files)
+
+    assert [user_id for _, user_id in clients] == ["alice", "bob"]
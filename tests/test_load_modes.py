@@ -0,0 +1,100 @@
+import csv
+import os
+import pandas as pd
+import psycopg2
+import pytest
+from scripts.database import insert_spotify_data
+from scripts.database.connection import get_db_config
+from scripts.database.create_spotify_db import TABLE_STATEMENTS
+
+TRACKS = pd.DataFrame({
+    "track_id": ["t1", "t2", "t3"],
+    "track_name": ["One", "", "Three"],
+    "album_name": ["", None, "Album"],
+    "popularity": [12.0, float("nan"), 0.0],  # Parquet stores nullable ints as floats
+    "duration_ms": [180000.0, 200000.0, float("nan")],
+    "album_release_date": ["2020-01-01", "", None],
+    "explicit": [True, False, None],
+})
+PLAYS = pd.DataFrame({
+    "played_at": ["2025-01-01T10:00:00+00:00", "2025-01-01T11:00:00+00:00", "2025-01-01T12:00:00+00:00"],
+    "track_id": ["t1", "t2", "t3"],
+    "artist_ids": ["a1,a2", "", "a3"],
+    "user_id": ["default", "default", "alice"],
+})
+
+
+def get_spec(table):
+    return next(spec for spec in insert_spotify_data.TABLES if spec["table"] == table)
+
+
+def prepare(table, df):
+    """Returns the rows as the loader has them: NaN replaced with None, and hashed for upserted tables."""
+    spec = get_spec(table)
+    df = df.where(pd.notna(df), None)
+    if spec.get("upsert"):
+        df["row_hash"] = insert_spotify_data.hash_rows(spec, df)
+    return spec, df
+
+
+class RecordingCursor:
+    """Keeps the rows each load mode sends, as the text Postgres would parse."""
+
+    def __init__(self):
+        self.rows = []
+        self.rowcount = 1
+
+    def execute(self, statement, values=None):
+        if values is not None:
+            self.rows.append(tuple(None if value is None else str(value) for value in values))
+
+    def copy_expert(self, statement, buffer):
+        self.rows += [tuple(None if value == "\\N" else value for value in row) for row in csv.reader(buffer)]
+
+
+@pytest.mark.parametrize("table, df", [("tracks", TRACKS), ("listening_history", PLAYS)])
+def test_copy_and_row_modes_send_the_same_values(table, df):
+    spec, df = prepare(table, df)
+    copied, inserted = RecordingCursor(), RecordingCursor()
+
+    insert_spotify_data.copy_rows(copied, spec, df)
+    insert_spotify_data.insert_rows(inserted, spec, df)
+
+    assert copied.rows == inserted.rows
+    if table == "listening_history":
+        assert [row[2] for row in inserted.rows] == ["a1,a2", "", "a3"]  # Empty artist_ids stay empty, not NULL
+
+
+@pytest.mark.skipif(not os.getenv("TEST_DB_NAME"), reason="Set TEST_DB_NAME (and the DB_* settings) to a scratch "
+                                                          "database to run the load against PostgreSQL")
+def test_copy_and_row_modes_load_the_same_tables():
+    conn = psycopg2.connect(**get_db_config(os.getenv("TEST_DB_NAME")))
+    tables = {}
+    try:
+        for mode, load_rows in (("copy", insert_spotify_data.copy_rows), ("row", insert_spotify_data.insert_rows)):
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS test_load_{mode} CASCADE; CREATE SCHEMA test_load_{mode};")
+                cursor.execute(f"SET search_path TO test_load_{mode};")
+                for statement in TABLE_STATEMENTS:
+                    cursor.execute(statement)
+            conn.commit()
+
+            for table, df in (("tracks", TRACKS), ("listening_history", PLAYS)):
+                spec, df = prepare(table, df)
+                inserted, rejected = insert_spotify_data.load_chunk(conn, load_rows, spec, df)
+                assert (inserted, rejected) == (len(df), [])
+
+            with conn.cursor() as cursor:
+                tables[mode] = {}
+                for table in ("tracks", "listening_history", "daily_track_plays"):
+                    cursor.execute(f"SELECT * FROM {table} ORDER BY 1, 2;")
+                    tables[mode][table] = cursor.fetchall()
+            conn.rollback()
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA IF EXISTS test_load_copy CASCADE; DROP SCHEMA IF EXISTS test_load_row CASCADE;")
+        conn.commit()
+        conn.close()
+
+    assert tables["copy"] == tables["row"]
+    assert tables["copy"]["listening_history"][1][2] == ""